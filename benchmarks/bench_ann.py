@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# Add src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from IVFIndex import IVFIndex
+from utils import _l2_normalize
+
+
+def synthetic_embeddings(n, dim, n_clusters, seed=0):
+    """Clustered random embeddings, closer to real image embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, n_clusters, size=n)
+    return centers[labels] + 0.5 * rng.normal(size=(n, dim)).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recall@K and QPS of the IVF index against exact search.')
+    parser.add_argument('--n', type=int, default=50000, help='Number of embeddings.')
+    parser.add_argument('--dim', type=int, default=2048, help='Embedding dimension.')
+    parser.add_argument('--clusters', type=int, default=500, help='Number of synthetic clusters.')
+    parser.add_argument('--queries', type=int, default=200, help='Number of queries.')
+    parser.add_argument('--k', type=int, default=10, help='K for recall@K.')
+    parser.add_argument('--n-probe', type=int, nargs='+', default=[1, 4, 8, 16, 32], help='n_probe values to sweep.')
+    args = parser.parse_args()
+
+    embeddings = synthetic_embeddings(args.n, args.dim, args.clusters)
+    normalized = _l2_normalize(embeddings)
+    query_ids = np.random.default_rng(1).choice(args.n, size=min(args.queries, args.n), replace=False)
+
+    # Exact ground truth (self excluded)
+    t0 = time.perf_counter()
+    similarities = normalized[query_ids] @ normalized.T
+    similarities[np.arange(len(query_ids)), query_ids] = -np.inf
+    exact = np.argpartition(-similarities, args.k - 1, axis=1)[:, :args.k]
+    exact_qps = len(query_ids) / (time.perf_counter() - t0)
+    print(f"exact: {exact_qps:.1f} QPS (batched)")
+
+    t0 = time.perf_counter()
+    index = IVFIndex.build(embeddings)
+    print(f"build: {time.perf_counter() - t0:.2f}s, {len(index.centroids)} lists")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index.save(os.path.join(tmp, 'embeddings.parquet.ivf'))
+        t0 = time.perf_counter()
+        index = IVFIndex.load(os.path.join(tmp, 'embeddings.parquet.ivf'), mmap=True)
+        print(f"load (mmap): {(time.perf_counter() - t0) * 1000:.1f}ms")
+
+        for n_probe in args.n_probe:
+            hits = 0
+            t0 = time.perf_counter()
+            for row, query_id in enumerate(query_ids):
+                indices, _ = index.search(embeddings[query_id], N=args.k, n_probe=n_probe, exclude=query_id)
+                hits += len(np.intersect1d(indices, exact[row]))
+            elapsed = time.perf_counter() - t0
+            print(f"n_probe={n_probe}: recall@{args.k}={hits / (len(query_ids) * args.k):.3f}, {len(query_ids) / elapsed:.1f} QPS")
+        del index
+
+
+if __name__ == '__main__':
+    main()
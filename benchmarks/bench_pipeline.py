@@ -0,0 +1,266 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT, 'src'))
+
+STAGES = ('exif_map', 'map_images', 'process_images', 'embed', 'similar_images')
+PLACES = [(41.3874, 2.1686), (48.8566, 2.3522), (51.5072, -0.1276), (-33.4489, -70.6693), (35.6762, 139.6503)]
+
+
+def _dms(x):
+    x = abs(x)
+    d = int(x)
+    m = int((x - d) * 60)
+    return (float(d), float(m), round(((x - d) * 60 - m) * 60, 2))
+
+
+def _save_jpeg(path, rng, datetime_str=None, lat_long=None):
+    from PIL import Image
+    image = Image.fromarray(rng.integers(0, 255, size=(48, 64, 3), dtype=np.uint8))
+    exif = Image.Exif()
+    exif[0x0110] = 'Synthetic'
+    # Exif and GPS IFDs are always present, so that tags can be added to them (the exif library cannot create them)
+    exif.get_ifd(0x8769)[0xA001] = 1
+    exif.get_ifd(0x8825)[0x0000] = b'\x02\x02\x00\x00'
+    if datetime_str is not None:
+        exif[0x0132] = datetime_str
+        exif.get_ifd(0x8769)[0x9003] = datetime_str
+    if lat_long is not None:
+        gps = exif.get_ifd(0x8825)
+        gps[1], gps[2] = ('N' if lat_long[0] >= 0 else 'S'), _dms(lat_long[0])
+        gps[3], gps[4] = ('E' if lat_long[1] >= 0 else 'W'), _dms(lat_long[1])
+    image.save(path, exif=exif, quality=85)
+
+
+def generate_images(folder, n, seed=0):
+    """
+    `n` camera pictures with date and gps exif data (trips of ~20 pictures to a few cities) in `folder/gps`,
+    and `n` WhatsApp-named pictures without them in `folder/wa`. Existing data is reused.
+    """
+    done_marker = os.path.join(folder, 'images.done')
+    if os.path.exists(done_marker):
+        return
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(folder, 'gps'), exist_ok=True)
+    os.makedirs(os.path.join(folder, 'wa'), exist_ok=True)
+    t = datetime.datetime(2023, 1, 1, 8)
+    for i in range(n):
+        t += datetime.timedelta(minutes=int(rng.integers(1, 90)))
+        lat, long = PLACES[(i // 20) % len(PLACES)]
+        _save_jpeg(os.path.join(folder, 'gps', f'IMG_{i:07d}.jpg'), rng, t.strftime('%Y:%m:%d %H:%M:%S'),
+                   (lat + rng.normal() * 0.005, long + rng.normal() * 0.005))
+        # Both WhatsApp naming schemes, plus a few names without a date
+        if i % 10 == 9:
+            name = f'photo_{i:07d}.jpg'
+        elif i % 2:
+            name = f'IMG-{t:%Y%m%d}-WA{i % 10000:04d}.jpg'
+            name = name if not os.path.exists(os.path.join(folder, 'wa', name)) else f'IMG-{t:%Y%m%d}-WA{i % 10000:04d} ({i}).jpg'
+        else:
+            name = f'WhatsApp Image {t:%Y-%m-%d at %H.%M.%S} ({i}).jpg'
+        _save_jpeg(os.path.join(folder, 'wa', name), rng)
+        mtime = (t - datetime.datetime(1970, 1, 1)).total_seconds()
+        os.utime(os.path.join(folder, 'wa', name), (mtime, mtime))
+    open(done_marker, 'w').close()
+
+
+def generate_embeddings(folder, n, dim, n_clusters=1000, chunk_size=65536, seed=0):
+    """Clustered random embeddings of `n` fake file paths, written as an `EmbeddingStore` in `folder/embeddings.store`."""
+    from EmbeddingStore import EmbeddingStore
+    store_path = os.path.join(folder, f'embeddings_{dim}.store')
+    if os.path.exists(os.path.join(store_path, 'meta.json')):
+        return store_path
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    matrix = np.lib.format.open_memmap(os.path.join(folder, 'raw.npy'), mode='w+', dtype=np.float32, shape=(n, dim))
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        matrix[start:stop] = centers[rng.integers(0, n_clusters, size=stop - start)] + 0.5 * rng.normal(size=(stop - start, dim))
+    EmbeddingStore.write(store_path, [f'/synthetic/IMG_{i:07d}.jpg' for i in range(n)], matrix)
+    del matrix
+    os.remove(os.path.join(folder, 'raw.npy'))
+    return store_path
+
+
+def check_mtimes(source_folder, output_folder):
+    """Raise if a mapped copy does not keep the modification time of its source (run under a non-UTC `TZ`)."""
+    for name in os.listdir(source_folder):
+        source, output = os.path.getmtime(os.path.join(source_folder, name)), os.path.getmtime(os.path.join(output_folder, name))
+        if abs(output - source) >= 1:
+            raise ValueError(f"Mapped copy of '{name}' has mtime {output}, its source has {source} (TZ={os.environ.get('TZ')}).")
+
+
+def run_stage(stage, folder, size, args):
+    """Run one stage on prepared data and return the number of items it processed."""
+    out = os.path.join(folder, f'out_{stage}')
+    os.makedirs(out, exist_ok=True)
+    gps, wa = os.path.join(folder, 'gps') + '/', os.path.join(folder, 'wa')
+    if stage == 'exif_map':
+        from utils_photo_geo_tagger import create_exif_map
+        create_exif_map(gps, 1.0, 3600, output_exif_map=os.path.join(folder, 'location_map.csv'))
+        return len(os.listdir(gps))
+    if stage == 'map_images':
+        from utils_photo_geo_tagger import map_images
+        map_images(wa, out, ['.jpg'], location_mapping_csv=os.path.join(folder, 'location_map.csv'))
+        check_mtimes(wa, out)
+        return len(os.listdir(wa))
+    if stage == 'process_images':
+        from ImageProcessor import ImageProcessor
+        summary = ImageProcessor().process_images_with_exif(wa, out, ['jpg', 'jpeg'], workers=args.workers)
+        return summary['processed'] + summary['no_datetime'] + summary['failed']
+    if stage == 'embed':
+        from ImageEmbedder import ImageEmbedder
+        paths = sorted(os.path.join(gps, f) for f in os.listdir(gps))[:args.max_embed]
+        ImageEmbedder(weights_path=args.weights_path).embed_paths(paths, num_workers=0)
+        return len(paths)
+    if stage == 'similar_images':
+        from EmbeddingRetriever import EmbeddingRetriever
+        retriever = EmbeddingRetriever.from_store(generate_embeddings(folder, size, args.dim))
+        retriever.update_similar_images(method=args.similarity_method, N=10, threshold=0.8,
+                                        output_file=os.path.join(out, 'similar_images.parquet'), include_embeddings=False)
+        return size
+    raise ValueError(f"Unknown stage '{stage}'. Use one of {STAGES}.")
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process. ru_maxrss survives exec (it would include the parent's), VmHWM does not."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def child(args):
+    """Runs a single stage in this (fresh) process and prints one JSON result line."""
+    folder = os.path.join(args.data_dir, str(args.size))
+    rss_before = peak_rss_mb()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        items = run_stage(args.stage, folder, args.size, args)
+        seconds = time.perf_counter() - start
+    print(json.dumps({'stage': args.stage, 'size': args.size, 'items': items, 'seconds': round(seconds, 4),
+                      'items_per_second': round(items / seconds, 2) if seconds > 0 else None,
+                      'rss_before_mb': round(rss_before, 1),
+                      'peak_rss_mb': round(peak_rss_mb(), 1),
+                      'status': 'ok'}))
+
+
+def stage_size(stage, size, args):
+    """Effective number of items of a stage, or None when the stage is skipped at this size."""
+    if stage in ('exif_map', 'map_images', 'process_images'):
+        return min(size, args.max_images)
+    if stage == 'embed':
+        return min(size, args.max_images, args.max_embed)
+    if stage == 'similar_images':
+        return size if args.similarity_method != 'cosine' or size <= args.max_exact_similarity else None
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous_path, results):
+    """Print the time ratio of every (stage, size) against a previous results file."""
+    with open(previous_path) as f:
+        previous = json.load(f)
+    before = {(r['stage'], r['size']): r for r in previous['results'] if r['status'] == 'ok'}
+    print(f"\nCompared with {previous_path} (commit {previous.get('commit')}):")
+    for r in results:
+        old = before.get((r['stage'], r['size']))
+        if r['status'] == 'ok' and old:
+            print(f"{r['stage']:<16}{r['size']:>10}{old['seconds']:>10.2f}s -> {r['seconds']:.2f}s  "
+                  f"(speed-up x{old['seconds'] / r['seconds']:.2f}, peak RSS {old['peak_rss_mb']:.0f} -> {r['peak_rss_mb']:.0f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput and peak memory of every pipeline stage on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help='Library sizes, e.g. 1000 10000 100000 1000000.')
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES, help='Stages to run.')
+    parser.add_argument('--data-dir', default=os.path.join(ROOT, 'data', 'bench'), help='Where synthetic data is generated (and reused).')
+    parser.add_argument('--output', default=None, help='JSON results file (default: <data-dir>/results_<commit>.json).')
+    parser.add_argument('--compare', default=None, help='Previous JSON results file to compare with.')
+    parser.add_argument('--max-images', type=int, default=100000, help='Cap on the number of synthetic JPEGs per size.')
+    parser.add_argument('--max-embed', type=int, default=256, help='Cap on the number of images embedded with ResNet-50.')
+    parser.add_argument('--dim', type=int, default=256, help='Dimension of the random embeddings (ResNet-50 is 2048).')
+    parser.add_argument('--similarity-method', default='cosine', choices=['cosine', 'quantized', 'nearest_neighbors'])
+    parser.add_argument('--max-exact-similarity', type=int, default=50000, help='Largest size for the exact all-pairs search.')
+    parser.add_argument('--workers', type=int, default=1, help='Workers of process_images.')
+    parser.add_argument('--tz', default='Asia/Kolkata',
+                        help='Time zone of the stages (not UTC, so the map_images mtime check catches a shift by the UTC offset; without DST, whose repeated hour is ambiguous).')
+    # Internal: run a single stage in a child process
+    parser.add_argument('--stage', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--weights-path', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        return child(args)
+
+    if 'embed' in args.stages:
+        # Random ResNet-50 weights: the speed does not depend on their values and nothing is downloaded
+        import torch
+        from torchvision import models
+        os.makedirs(args.data_dir, exist_ok=True)
+        args.weights_path = os.path.join(args.data_dir, 'resnet50_random.pth')
+        if not os.path.exists(args.weights_path):
+            torch.save(models.resnet50(weights=None).state_dict(), args.weights_path)
+
+    results = []
+    print(f"{'stage':<16}{'size':>10}{'items':>10}{'seconds':>10}{'items/s':>12}{'peak MB':>10}")
+    for size in args.sizes:
+        folder = os.path.join(args.data_dir, str(size))
+        if any(stage_size(s, size, args) for s in args.stages if s != 'similar_images'):
+            generate_images(folder, min(size, args.max_images))
+        for stage in args.stages:
+            if stage_size(stage, size, args) is None:
+                results.append({'stage': stage, 'size': size, 'status': 'skipped'})
+                print(f"{stage:<16}{size:>10}{'skipped':>10}")
+                continue
+            # Each stage runs in a fresh interpreter, so peak RSS is its own
+            command = [sys.executable, os.path.abspath(__file__), '--stage', stage, '--size', str(size),
+                       '--data-dir', args.data_dir, '--max-images', str(args.max_images), '--max-embed', str(args.max_embed),
+                       '--dim', str(args.dim), '--similarity-method', args.similarity_method, '--workers', str(args.workers)]
+            if args.weights_path:
+                command += ['--weights-path', args.weights_path]
+            completed = subprocess.run(command, capture_output=True, text=True, env={**os.environ, 'TZ': args.tz})
+            if completed.returncode != 0:
+                results.append({'stage': stage, 'size': size, 'status': 'failed', 'error': completed.stderr.strip().splitlines()[-1:]})
+                print(f"{stage:<16}{size:>10}{'failed':>10}  {completed.stderr.strip().splitlines()[-1:]}")
+                continue
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{stage:<16}{size:>10}{result['items']:>10}{result['seconds']:>10.2f}{result['items_per_second']:>12.1f}{result['peak_rss_mb']:>10.0f}")
+
+    commit = git_commit()
+    report = {'commit': commit, 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+              'args': {k: v for k, v in vars(args).items() if k not in ('stage', 'size', 'weights_path')},
+              'results': results}
+    output = args.output or os.path.join(args.data_dir, f'results_{commit or "unknown"}.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved results to {output}")
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
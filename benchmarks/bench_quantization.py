@@ -0,0 +1,86 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# Add src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from QuantizedEmbeddings import QuantizedEmbeddings
+from utils import _l2_normalize
+
+
+def synthetic_normalized_embeddings(path, n, dim, n_clusters, chunk_size=65536, seed=0):
+    """Clustered, L2-normalized random embeddings written chunk by chunk to a memory-mapped .npy file."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n, dim))
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        block = centers[rng.integers(0, n_clusters, size=stop - start)] + rng.normal(size=(stop - start, dim)).astype(np.float32)
+        matrix[start:stop] = _l2_normalize(block)
+    matrix.flush()
+    return np.load(path, mmap_mode='r')
+
+
+def exact_top_k(matrix, queries, exclude, k, chunk_size=65536):
+    best_ids = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(matrix), chunk_size):
+        scores = queries @ np.asarray(matrix[start:start + chunk_size]).T
+        local = exclude - start
+        inside = (local >= 0) & (local < scores.shape[1])
+        scores[np.flatnonzero(inside), local[inside]] = -np.inf
+        ids = np.hstack([best_ids, np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)])
+        scores = np.hstack([best_scores, scores])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        best_ids, best_scores = np.take_along_axis(ids, top, axis=1), np.take_along_axis(scores, top, axis=1)
+    return best_ids
+
+
+def recall(found, truth):
+    return np.mean([len(np.intersect1d(f, t)) / len(t) for f, t in zip(found, truth)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory, QPS and recall@K of quantized embeddings against exact search.')
+    parser.add_argument('--n', type=int, default=1_000_000, help='Number of embeddings.')
+    parser.add_argument('--dim', type=int, default=256, help='Embedding dimension (ResNet-50 is 2048, i.e. 8 GB at 1M).')
+    parser.add_argument('--clusters', type=int, default=1000, help='Number of synthetic clusters.')
+    parser.add_argument('--queries', type=int, default=100, help='Number of queries, searched as one batch.')
+    parser.add_argument('--k', type=int, default=10, help='K for recall@K.')
+    parser.add_argument('--n-subvectors', type=int, default=32, help='Number of PQ sub-vectors.')
+    parser.add_argument('--modes', nargs='+', default=list(QuantizedEmbeddings.MODES), help='Quantization modes to benchmark.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        matrix = synthetic_normalized_embeddings(os.path.join(tmp, 'embeddings.npy'), args.n, args.dim, args.clusters)
+        query_ids = np.sort(np.random.default_rng(1).choice(args.n, size=args.queries, replace=False))
+        queries = np.asarray(matrix[query_ids])
+
+        t0 = time.perf_counter()
+        truth = exact_top_k(matrix, queries, query_ids, args.k)
+        elapsed = time.perf_counter() - t0
+        print(f"{'mode':<18}{'memory MB':>12}{'QPS':>10}{'recall@' + str(args.k):>12}")
+        print(f"{'float32 (exact)':<18}{matrix.nbytes / 2**20:>12.1f}{args.queries / elapsed:>10.1f}{1.0:>12.3f}")
+
+        for mode in args.modes:
+            t0 = time.perf_counter()
+            quantized = QuantizedEmbeddings.build(matrix, mode=mode, n_subvectors=args.n_subvectors)
+            build_time = time.perf_counter() - t0
+            for rescore in (False, True):
+                t0 = time.perf_counter()
+                found, _ = quantized.search(queries, N=args.k, exclude=query_ids, exact_embeddings=matrix if rescore else None)
+                elapsed = time.perf_counter() - t0
+                label = f"{mode}{' +rescore' if rescore else ''}"
+                print(f"{label:<18}{quantized.nbytes / 2**20:>12.1f}{args.queries / elapsed:>10.1f}{recall(found, truth):>12.3f}")
+            print(f"  ({mode} build: {build_time:.1f}s)")
+            del quantized
+        del matrix
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Add src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from EmbeddingRetriever import EmbeddingRetriever
+from QueryServer import QueryServer, QueryClient
+
+
+def synthetic_embeddings(n, dim, n_clusters, seed=0):
+    """Clustered random embeddings, closer to real image embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, n_clusters, size=n)
+    return centers[labels] + 0.5 * rng.normal(size=(n, dim)).astype(np.float32)
+
+
+def start_server(retriever, max_batch, max_wait_ms, unix_socket):
+    """Run a server in a background thread with its own event loop; returns (loop, server, port)."""
+    loop = asyncio.new_event_loop()
+    server = QueryServer(retriever, max_batch=max_batch, max_wait_ms=max_wait_ms)
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start(port=0, unix_socket=unix_socket))
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    port = None if unix_socket else server.server.sockets[0].getsockname()[1]
+    return loop, server, port
+
+
+def run_clients(port, unix_socket, n_clients, n_requests, n_rows, N):
+    """`n_clients` concurrent clients sending `n_requests` single-image queries each; returns (seconds, latencies)."""
+    def client(seed):
+        rng = np.random.default_rng(seed)
+        connection = QueryClient(port=port, unix_socket=unix_socket)
+        latencies = []
+        for row in rng.integers(0, n_rows, size=n_requests):
+            t0 = time.perf_counter()
+            connection.similar([int(row)], N=N, threshold=-1.0)
+            latencies.append(time.perf_counter() - t0)
+        connection.close()
+        return latencies
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_clients) as pool:
+        latencies = [l for ls in pool.map(client, range(n_clients)) for l in ls]
+    return time.perf_counter() - t0, np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput and latency of the query server on localhost, with and without batching.')
+    parser.add_argument('--n', type=int, default=50000, help='Number of embeddings.')
+    parser.add_argument('--dim', type=int, default=2048, help='Embedding dimension.')
+    parser.add_argument('--clusters', type=int, default=500, help='Number of synthetic clusters.')
+    parser.add_argument('--clients', type=int, default=32, help='Concurrent clients.')
+    parser.add_argument('--requests', type=int, default=20, help='Requests per client.')
+    parser.add_argument('--k', type=int, default=10, help='Neighbours per query.')
+    parser.add_argument('--max-wait-ms', type=float, default=2.0, help='Batching window of the server.')
+    parser.add_argument('--unix-socket', action='store_true', help='Connect through a Unix socket instead of TCP.')
+    args = parser.parse_args()
+
+    embeddings = synthetic_embeddings(args.n, args.dim, args.clusters)
+    retriever = EmbeddingRetriever(pd.DataFrame({'filepath': [f'/pics/{i}.jpg' for i in range(args.n)],
+                                                 'embedding': list(embeddings)}))
+
+    print(f"{'max_batch':>10}{'QPS':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'mean batch':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for max_batch in (1, 256):
+            unix_socket = os.path.join(tmp, f'server{max_batch}.sock') if args.unix_socket else None
+            loop, server, port = start_server(retriever, max_batch, args.max_wait_ms, unix_socket)
+            seconds, latencies = run_clients(port, unix_socket, args.clients, args.requests, args.n, args.k)
+            counters = server.metrics.snapshot()['counters']
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+            print(f"{max_batch:>10}{len(latencies) / seconds:>10.1f}{p50:>10.1f}{p90:>10.1f}{p99:>10.1f}"
+                  f"{counters['queries'] / counters['batches']:>12.1f}")
+            asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+# Add src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from EmbeddingRetriever import EmbeddingRetriever
+from ShardedEmbeddingStore import ShardedEmbeddingStore
+
+
+def synthetic_embeddings(n, dim, n_clusters, seed=0):
+    """Clustered random embeddings, closer to real image embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, n_clusters, size=n)
+    return centers[labels] + 0.5 * rng.normal(size=(n, dim)).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scatter-gather search over a sharded store against one in-memory retriever.')
+    parser.add_argument('--n', type=int, default=200000, help='Number of embeddings.')
+    parser.add_argument('--dim', type=int, default=2048, help='Embedding dimension.')
+    parser.add_argument('--clusters', type=int, default=500, help='Number of synthetic clusters.')
+    parser.add_argument('--shards', type=int, default=8, help='Number of shards.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4], help='Worker process counts to compare (0: in-process).')
+    parser.add_argument('--queries', type=int, default=256, help='Number of queries per search.')
+    parser.add_argument('--k', type=int, default=10, help='Neighbours per query.')
+    args = parser.parse_args()
+
+    embeddings = synthetic_embeddings(args.n, args.dim, args.clusters)
+    filepaths = [f'/pics/{2000 + i % 20}/{i}.jpg' for i in range(args.n)]
+    queries = [filepaths[i] for i in np.random.default_rng(1).choice(args.n, size=args.queries, replace=False)]
+
+    retriever = EmbeddingRetriever(pd.DataFrame({'filepath': filepaths, 'embedding': list(embeddings)}))
+    t0 = time.perf_counter()
+    _, _, exact = retriever.find_similar_embeddings_many(queries, N=args.k, threshold=-1.0)
+    print(f"single retriever: {args.queries / (time.perf_counter() - t0):.1f} QPS")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ShardedEmbeddingStore.write(tmp, filepaths, embeddings, n_shards=args.shards).close()
+        for n_workers in args.workers:
+            with ShardedEmbeddingStore.open(tmp, n_workers=n_workers) as store:
+                store.search(queries[:1], N=args.k, threshold=-1.0)  # start the workers and map the shards
+                t0 = time.perf_counter()
+                results = store.search(queries, N=args.k, threshold=-1.0)
+                seconds = time.perf_counter() - t0
+            same = np.mean([[p for p, _ in r] == list(e[:len(r)]) for r, e in zip(results, exact)])
+            print(f"{args.shards} shards, {n_workers} workers: {args.queries / seconds:.1f} QPS, same results as exact search: {same:.0%}")
+
+        # Only the shards receiving new photos are appended to
+        t0 = time.perf_counter()
+        ShardedEmbeddingStore.open(tmp).add([f'/pics/new/{i}.jpg' for i in range(1000)], synthetic_embeddings(1000, args.dim, args.clusters, seed=2))
+        print(f"add 1000 photos: {time.perf_counter() - t0:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
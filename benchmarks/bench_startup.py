@@ -0,0 +1,65 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC = os.path.join(ROOT, 'src')
+
+# Each snippet prints its own elapsed time, measured from interpreter start-up
+PRELUDE = f"import sys, time; t0 = time.perf_counter(); sys.path.insert(0, {SRC!r})\n"
+REPORT = "\nprint(f'{time.perf_counter() - t0:.3f}', 'torch' in sys.modules)"
+
+
+def entry_points(weights_path, model_path, image_path):
+    return {
+        'import utils_photo_geo_tagger': "import utils_photo_geo_tagger",
+        'import ImageProcessor (date fixing)': "from ImageProcessor import ImageProcessor",
+        'import EmbeddingRetriever': "from EmbeddingRetriever import EmbeddingRetriever",
+        'import ImageEmbedder': "from ImageEmbedder import ImageEmbedder",
+        'ImageEmbedder() (model not loaded)': "from ImageEmbedder import ImageEmbedder\nImageEmbedder()",
+        'first embedding, state dict': f"from ImageEmbedder import ImageEmbedder\nImageEmbedder(weights_path={weights_path!r}).get_embedding({image_path!r})",
+        'first embedding, TorchScript': f"from ImageEmbedder import ImageEmbedder\nImageEmbedder(model_path={model_path!r}).get_embedding({image_path!r})",
+    }
+
+
+def run(snippet, repeat):
+    """Best of `repeat` cold runs, each in a fresh interpreter."""
+    results = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', PRELUDE + snippet + REPORT], capture_output=True, text=True, check=True)
+        seconds, torch_loaded = out.stdout.split()[-2:]
+        results.append((float(seconds), torch_loaded == 'True'))
+    return min(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start time of each entry point, in fresh interpreters.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per entry point (the best one is reported).')
+    args = parser.parse_args()
+
+    sys.path.insert(0, SRC)
+    import numpy as np
+    import torch
+    from PIL import Image
+    from torchvision import models
+    from ImageEmbedder import ImageEmbedder
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Random weights: load time does not depend on the values
+        weights_path = os.path.join(tmp, 'resnet50.pth')
+        torch.save(models.resnet50(weights=None).state_dict(), weights_path)
+        model_path = os.path.join(tmp, 'resnet50.pt')
+        ImageEmbedder(weights_path=weights_path).export_torchscript(model_path)
+        image_path = os.path.join(tmp, 'image.jpg')
+        Image.fromarray((np.random.rand(480, 640, 3) * 255).astype('uint8')).save(image_path)
+
+        print(f"{'entry point':<40}{'seconds':>10}{'torch imported':>16}")
+        for name, snippet in entry_points(weights_path, model_path, image_path).items():
+            seconds, torch_loaded = run(snippet, args.repeat)
+            print(f"{name:<40}{seconds:>10.3f}{str(torch_loaded):>16}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,13 @@
 import argparse
-from src.ImageProcessor import ImageProcessor
+import logging
+import os
+import sys
+
+# Add src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+from ImageProcessor import ImageProcessor
+from Metrics import Metrics, metrics
 
 def main():
     parser = argparse.ArgumentParser(description='Process images with EXIF data.')
@@ -7,11 +15,25 @@ def main():
     parser.add_argument('folder_path_exif', type=str, help='Path to the folder to save processed images.')
     parser.add_argument('filters', type=str, nargs='+', help='List of image file extensions to filter by.')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose output.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of images processed concurrently.')
+    parser.add_argument('--executor', choices=['thread', 'process'], default='thread', help='Pool used when --workers > 1.')
+    parser.add_argument('--metrics', choices=Metrics.MODES, default='off', help='Record counters and stage latencies.')
+    parser.add_argument('--metrics-output', type=str, default=None, help='File the metrics are written to (printed otherwise).')
 
     args = parser.parse_args()
 
+    if args.metrics == 'logging':
+        logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+    metrics.configure(args.metrics)
+
     processor = ImageProcessor()
-    processor.process_images_with_exif(args.folder_path, args.folder_path_exif, args.filters, verbose=args.verbose)
+    processor.process_images_with_exif(args.folder_path, args.folder_path_exif, args.filters, verbose=args.verbose,
+                                       workers=args.workers, executor=args.executor)
+
+    if metrics.enabled:
+        text = metrics.dump(args.metrics_output)
+        if args.metrics_output is None and args.metrics != 'logging':
+            print(text)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
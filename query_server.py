@@ -0,0 +1,48 @@
+import argparse
+import asyncio
+import os
+import sys
+
+import pandas as pd
+
+# Add src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+from EmbeddingRetriever import EmbeddingRetriever
+from QueryServer import QueryServer
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve similarity queries over a warm embeddings index on localhost.')
+    parser.add_argument('embeddings', type=str, help='Embeddings Parquet file, or EmbeddingStore directory.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on.')
+    parser.add_argument('--unix-socket', type=str, default=None, help='Listen on this Unix socket instead of TCP.')
+    parser.add_argument('--ann-index', action='store_true', help='Load the IVF index saved next to the embeddings file.')
+    parser.add_argument('--embedder', action='store_true', help='Keep an ImageEmbedder loaded for /similar_image queries.')
+    parser.add_argument('--weights-path', type=str, default=None, help='Local ResNet-50 state dict for the embedder.')
+    parser.add_argument('--model-path', type=str, default=None, help='Exported TorchScript or ONNX model for the embedder.')
+    parser.add_argument('--max-batch', type=int, default=256, help='Maximum number of queries searched together.')
+    parser.add_argument('--max-wait-ms', type=float, default=2.0, help='Longest time a query waits for a batch.')
+
+    args = parser.parse_args()
+
+    if os.path.isdir(args.embeddings):
+        retriever = EmbeddingRetriever.from_store(args.embeddings)
+    else:
+        retriever = EmbeddingRetriever(pd.read_parquet(args.embeddings))
+        if args.ann_index:
+            retriever.load_ann_index(args.embeddings)
+
+    embedder = None
+    if args.embedder or args.weights_path or args.model_path:
+        from ImageEmbedder import ImageEmbedder
+        embedder = ImageEmbedder(weights_path=args.weights_path, model_path=args.model_path)
+
+    server = QueryServer(retriever, embedder=embedder, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms)
+    try:
+        asyncio.run(server.serve_forever(host=args.host, port=args.port, unix_socket=args.unix_socket))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import argparse
+import logging
+import os
+import sys
+
+# Add src directory to the Python path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+from Metrics import Metrics, metrics
+from PipelineRunner import PipelineRunner
+
+def main():
+    parser = argparse.ArgumentParser(description='Run (or resume) the whole pipeline: fix dates, location map, mapping, embeddings and similar images.')
+    parser.add_argument('whatsapp_folder', type=str, help='Path to the folder containing the WhatsApp images.')
+    parser.add_argument('camera_folder', type=str, help='Path to the folder containing the camera images with gps data.')
+    parser.add_argument('work_dir', type=str, help='Folder where the outputs and the ledger are saved.')
+    parser.add_argument('--filters', type=str, nargs='+', default=['jpg', 'jpeg'], help='List of image file extensions to filter by.')
+    parser.add_argument('--max-km', type=float, default=1.0, help='Maximum distance in km of pictures taken at the same place.')
+    parser.add_argument('--max-seconds', type=float, default=3600, help='Maximum time in seconds between pictures taken at the same place.')
+    parser.add_argument('--N', type=int, default=10, help='Maximum number of similar images per picture.')
+    parser.add_argument('--threshold', type=float, default=0.95, help='Minimum cosine similarity of similar images.')
+    parser.add_argument('--batch-size', type=int, default=32, help='Number of images embedded at a time.')
+    parser.add_argument('--queue-size', type=int, default=64, help='Maximum number of files waiting between two stages.')
+    parser.add_argument('--recursive', action='store_true', help='Also process the images in subfolders.')
+    parser.add_argument('--weights-path', type=str, default=None, help='Local ResNet-50 state dict for the embedder.')
+    parser.add_argument('--model-path', type=str, default=None, help='Exported TorchScript or ONNX model for the embedder.')
+    parser.add_argument('--metrics', choices=Metrics.MODES, default='off', help='Record counters and stage latencies.')
+    parser.add_argument('--metrics-output', type=str, default=None, help='File the metrics are written to (printed otherwise).')
+
+    args = parser.parse_args()
+
+    if args.metrics == 'logging':
+        logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+    metrics.configure(args.metrics)
+
+    runner = PipelineRunner(args.whatsapp_folder, args.camera_folder, args.work_dir, filters=args.filters,
+                            min_gps_threshold_similar=args.max_km, min_seconds_threshold_similar=args.max_seconds,
+                            N=args.N, threshold=args.threshold, batch_size=args.batch_size, queue_size=args.queue_size,
+                            recursive=args.recursive, weights_path=args.weights_path, model_path=args.model_path)
+    runner.run()
+
+    if metrics.enabled:
+        text = metrics.dump(args.metrics_output)
+        if args.metrics_output is None and args.metrics != 'logging':
+            print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Persistent on-disk store of image embeddings, backed by a single SQLite file.
+
+    Entries are keyed by (filepath, model_key), where `model_key` identifies the model and the preprocessing
+    configuration, so embeddings from a different model never get mixed in. Each entry also stores the file's
+    fingerprint (size + mtime, or a content hash) and is only returned while the file still matches it.
+    File paths are stored as absolute paths, so a file given by a relative path shares its entry.
+    """
+
+    # Number of file paths looked up per query in `lookup_many`
+    lookup_chunk_size = 500
+
+    def __init__(self, cache_path: str, model_key: str, use_content_hash: bool = False):
+        """
+        Args:
+            cache_path (str): Path of the SQLite cache file (created if missing).
+            model_key (str): Identifier of the model + preprocessing configuration.
+            use_content_hash (bool): Fingerprint files by a hash of their content instead of size + mtime.
+                Slower (every file is read), but survives copies that reset mtimes.
+        """
+        self.cache_path = cache_path
+        self.model_key = model_key
+        self.use_content_hash = use_content_hash
+        self.connection = sqlite3.connect(cache_path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            ' filepath TEXT NOT NULL,'
+            ' model_key TEXT NOT NULL,'
+            ' fingerprint TEXT NOT NULL,'
+            ' embedding BLOB NOT NULL,'
+            ' PRIMARY KEY (filepath, model_key))'
+        )
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM embeddings WHERE model_key = ?', (self.model_key,)).fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def content_hash(filepath: str, chunk_size: int = 1 << 20) -> str:
+        """BLAKE2b hash of a file's content, read in chunks."""
+        h = hashlib.blake2b(digest_size=16)
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def fingerprint(self, filepath: str, stat_result: os.stat_result = None) -> str:
+        """
+        Fingerprint of a file's current version.
+
+        Args:
+            filepath (str): The file.
+            stat_result (os.stat_result): Optional already-known `os.stat` result, to save a syscall.
+        """
+        if self.use_content_hash:
+            return self.content_hash(filepath)
+        if stat_result is None:
+            stat_result = os.stat(filepath)
+        return f'{stat_result.st_size}:{stat_result.st_mtime_ns}'
+
+    def get(self, filepath: str):
+        """Cached embedding for `filepath`, or None if missing or if the file changed since it was cached."""
+        row = self.connection.execute(
+            'SELECT fingerprint, embedding FROM embeddings WHERE filepath = ? AND model_key = ?',
+            (os.path.abspath(filepath), self.model_key),
+        ).fetchone()
+        if row is None or not os.path.exists(filepath) or row[0] != self.fingerprint(filepath):
+            return None
+        return np.frombuffer(row[1], dtype=np.float32)
+
+    def lookup_many(self, filepaths: list, stat_results: dict = None):
+        """
+        Split `filepaths` into cache hits and files that need to be (re-)embedded.
+
+        Args:
+            filepaths (list): The files.
+            stat_results (dict): Optional filepath -> already-known `os.stat` result, to save a syscall per file.
+
+        Returns:
+            tuple: (hits, misses, fingerprints) where `hits` maps filepath -> embedding, `misses` lists the
+            new or changed files, and `fingerprints` maps every existing filepath to its current fingerprint
+            (pass it back to `put_many` to avoid fingerprinting twice).
+        """
+        # Only the requested entries are read, in chunks that stay below SQLite's limit on query parameters
+        cached = {}
+        filepaths = list(filepaths)
+        keys = [os.path.abspath(filepath) for filepath in filepaths]
+        for start in range(0, len(keys), self.lookup_chunk_size):
+            chunk = keys[start:start + self.lookup_chunk_size]
+            for filepath, fingerprint, embedding in self.connection.execute(
+                    'SELECT filepath, fingerprint, embedding FROM embeddings'
+                    f' WHERE model_key = ? AND filepath IN ({", ".join("?" * len(chunk))})', (self.model_key, *chunk)):
+                cached[filepath] = (fingerprint, embedding)
+
+        stat_results = stat_results or {}
+        hits, misses, fingerprints = {}, [], {}
+        for filepath, key in zip(filepaths, keys):
+            try:
+                fingerprint = self.fingerprint(filepath, stat_results.get(filepath))
+            except OSError:
+                misses.append(filepath)
+                continue
+            fingerprints[filepath] = fingerprint
+            entry = cached.get(key)
+            if entry is not None and entry[0] == fingerprint:
+                hits[filepath] = np.frombuffer(entry[1], dtype=np.float32)
+            else:
+                misses.append(filepath)
+        return hits, misses, fingerprints
+
+    def put_many(self, filepaths: list, embeddings: np.ndarray, fingerprints: dict = None) -> None:
+        """Store (or replace) the embeddings of `filepaths`, in a single transaction."""
+        fingerprints = fingerprints or {}
+        rows = []
+        for filepath, embedding in zip(filepaths, embeddings):
+            fingerprint = fingerprints.get(filepath) or self.fingerprint(filepath)
+            rows.append((os.path.abspath(filepath), self.model_key, fingerprint, np.asarray(embedding, dtype=np.float32).tobytes()))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)', rows)
+
+    def evict_missing(self, existing_filepaths: list = None, folder_path: str = None, recursive: bool = True,
+                      extensions: list = None) -> int:
+        """
+        Remove entries whose file no longer exists.
+
+        Args:
+            existing_filepaths (list): Files known to exist (e.g. the result of a directory scan). Entries under
+                `folder_path` that are not in this list are evicted without touching the filesystem.
+                If None, every cached file is checked with `os.path.exists`.
+            folder_path (str): Only consider entries under this folder.
+            recursive (bool): Also consider entries in subfolders of `folder_path`.
+            extensions (list): Only consider entries whose name ends with one of these extensions (any case),
+                e.g. the extensions `existing_filepaths` was scanned with.
+
+        Returns:
+            int: Number of evicted entries.
+        """
+        cached = [row[0] for row in self.connection.execute('SELECT filepath FROM embeddings WHERE model_key = ?', (self.model_key,))]
+        if folder_path is not None:
+            folder_path = os.path.abspath(folder_path)
+            if recursive:
+                prefix = os.path.join(folder_path, '')
+                cached = [f for f in cached if f.startswith(prefix)]
+            else:
+                cached = [f for f in cached if os.path.dirname(f) == folder_path]
+        if extensions is not None:
+            extensions = tuple(ext.lower() for ext in extensions)
+            cached = [f for f in cached if f.lower().endswith(extensions)]
+        if existing_filepaths is not None:
+            existing = {os.path.abspath(f) for f in existing_filepaths}
+            stale = [f for f in cached if f not in existing]
+        else:
+            stale = [f for f in cached if not os.path.exists(f)]
+        with self.connection:
+            self.connection.executemany('DELETE FROM embeddings WHERE filepath = ? AND model_key = ?',
+                                        [(f, self.model_key) for f in stale])
+        if stale:
+            print(f"Evicted {len(stale)} stale embeddings from {self.cache_path}.")
+        return len(stale)
@@ -1,7 +1,14 @@
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+import pandas as pd
 import os
 
+from IVFIndex import IVFIndex
+from EmbeddingStore import EmbeddingStore
+from QuantizedEmbeddings import QuantizedEmbeddings
+from Metrics import metrics
+from StreamWriter import ParquetStreamWriter
+from utils import _l2_normalize
+
 class EmbeddingRetriever:
     def __init__(self, embeddings_df):
         """Initialize with a DataFrame containing image file paths and embeddings."""
@@ -9,56 +16,286 @@ class EmbeddingRetriever:
         self.embeddings_df = embeddings_df.copy()
         self.embeddings_df['filepath'] = self.embeddings_df['filepath'].apply(self.standardize_path)
         self.embeddings = np.vstack(self.embeddings_df['embedding'].values)
+        # L2-normalize once so that cosine similarity is a plain dot product
+        self.normalized_embeddings = _l2_normalize(self.embeddings)
+        self.ann_index = None
+        self.quantized = None
+        self._build_path_index()
+
+    @classmethod
+    def from_store(cls, store_path, mmap=True):
+        """
+        Open a retriever over an `EmbeddingStore` directory without copying the embedding matrix.
+
+        The matrix is memory-mapped, so start-up time does not depend on the library size. Stores written
+        with normalized float32 rows are used as is; other stores are normalized (and copied) once.
+
+        Two differences with a retriever built from a DataFrame:
+            - `embeddings` are the stored rows, so with a normalized store (the default of
+              `EmbeddingStore.write` and `save_store`) `find_similar_embeddings` returns normalized vectors
+              instead of the raw model outputs.
+            - `embeddings_df` only has a `filepath` column, so `update_similar_images` cannot save the
+              embeddings (`include_embeddings` has no effect).
+
+        Args:
+            store_path (str): The store directory (see `EmbeddingStore`).
+            mmap (bool): Memory-map the matrix instead of reading it into RAM.
+        """
+        store = EmbeddingStore.open(store_path, mmap=mmap)
+        retriever = cls.__new__(cls)
+        # Paths were standardized when the store was written
+        retriever.embeddings_df = pd.DataFrame({'filepath': store.filepaths})
+        retriever.embeddings = store.embeddings
+        if store.normalized and store.embeddings.dtype == np.float32:
+            retriever.normalized_embeddings = store.embeddings
+        else:
+            retriever.normalized_embeddings = _l2_normalize(store.embeddings)
+        retriever.ann_index = None
+        retriever.quantized = None
+        retriever._build_path_index()
+        return retriever
+
+    def _build_path_index(self):
+        """Prebuild the filepath -> row lookup, so that resolving a path is a dict lookup."""
+        self.filepaths = self.embeddings_df['filepath'].to_numpy(dtype=object)
+        self.row_by_path = {filepath: row for row, filepath in enumerate(self.filepaths)}
+
+    def save_store(self, store_path, dtype='float32'):
+        """Write the embeddings as an `EmbeddingStore` directory, to be reopened with `from_store`."""
+        return EmbeddingStore.write(store_path, self.embeddings_df['filepath'].values, self.normalized_embeddings, dtype=dtype)
+
+    def _to_triplets(self, indices, similarities):
+        """Build (image_path, similarity, embedding) triplets from result arrays."""
+        return [(self.filepaths[idx], float(similarity), self.embeddings[idx]) for idx, similarity in zip(indices, similarities)]
+
+    def _top_k_for_rows(self, rows, N, threshold):
+        """
+        Top-N most similar embeddings above `threshold` for the given rows, with one matrix product.
+
+        Returns:
+            tuple: (indices, scores) arrays of shape (len(rows), k), sorted by decreasing similarity and
+            padded with -1 / NaN where fewer than k neighbours pass the threshold.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        # An embedding is never its own neighbour
+        return self._top_k_for_vectors(self.normalized_embeddings[rows], N, threshold, exclude=rows)
+
+    def _top_k_for_vectors(self, queries, N, threshold, exclude=None):
+        """Same as `_top_k_for_rows` for L2-normalized query vectors, skipping row `exclude[i]` for query i if given."""
+        k = min(N, len(self.normalized_embeddings) - (1 if exclude is not None else 0))
+        if k <= 0:
+            return np.full((len(queries), 0), -1, dtype=np.int64), np.full((len(queries), 0), np.nan, dtype=np.float32)
+
+        similarities = queries @ self.normalized_embeddings.T
+        if exclude is not None:
+            similarities[np.arange(len(queries)), exclude] = -np.inf
+
+        # Unordered top-k per row, then sort only those k candidates
+        candidates = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        candidate_scores = np.take_along_axis(similarities, candidates, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind='stable')
+        indices = np.take_along_axis(candidates, order, axis=1).astype(np.int64)
+        scores = np.take_along_axis(candidate_scores, order, axis=1)
+
+        below = scores < threshold
+        indices[below] = -1
+        scores[below] = np.nan
+        return indices, scores
+
+    def _ann_top_k(self, index, N, threshold, n_probe=None):
+        """Approximate top-N most similar embeddings above `threshold` for one row, as (indices, scores) arrays."""
+        # Build the index once, on first use, if none was loaded
+        if self.ann_index is None:
+            self.build_ann_index()
+        indices, similarities = self.ann_index.search(self.embeddings[index], N=N, n_probe=n_probe, exclude=index)
+        keep = similarities >= threshold
+        return indices[keep], similarities[keep]
 
     def cosine_similarity(self, index, threshold=0.7, N=5):
         """Calculate cosine similarity and retrieve similar embeddings."""
-        # Calculate cosine similarity matrix
-        similarity_matrix = cosine_similarity(self.embeddings)
-        
-        # Get similarities for the current embedding
-        similarities = similarity_matrix[index]
-        
-        # Get indices of the most similar embeddings, sorted by similarity
-        similar_indices = np.argsort(similarities)[::-1][1:]  # Skip the first one as it's the embedding itself
-
-        # Filter by threshold
-        filtered_indices = [i for i in similar_indices if similarities[i] >= threshold]
-
-        # Get the top N similar embeddings above the threshold
-        top_n_similar_indices = filtered_indices[:N]
-
-        # Create a list of (image_path, similarity, embedding) triplets
-        similar_images = []
-        for idx in top_n_similar_indices:
-            similar_images.append((
-                self.embeddings_df.iloc[idx]['filepath'],
-                float(similarities[idx]),
-                self.embeddings_df.iloc[idx]['embedding']
-            ))
-
-        return similar_images
-
-    def approximate_nearest_neighbors(self, index, N=10, threshold=0.95):
-        """Retrieve similar embeddings using approximate nearest neighbors."""
-        # Use NearestNeighbors from sklearn
-        nbrs = NearestNeighbors(n_neighbors=N, algorithm='auto').fit(self.embeddings)
-        distances, indices = nbrs.kneighbors(self.embeddings[index].reshape(1, -1))
-
-        # Filter based on threshold
-        filtered_triplets = []
-        for i in range(len(indices[0])):
-            dist = distances[0][i]
-            if 1 - dist >= threshold:  # For cosine similarity interpretation
-                filtered_triplets.append((
-                    self.embeddings_df.iloc[indices[0][i]]['filepath'],
-                    float(1 - dist),  # Convert distance to similarity
-                    self.embeddings_df.iloc[indices[0][i]]['embedding']
-                ))
-
-        # Limit to N results
-        filtered_triplets = filtered_triplets[:N]
-
-        return filtered_triplets
+        indices, similarities = self._top_k_for_rows([index], N, threshold)
+        keep = indices[0] >= 0
+        return self._to_triplets(indices[0][keep], similarities[0][keep])
+
+    def approximate_nearest_neighbors(self, index, N=10, threshold=0.95, n_probe=None):
+        """Retrieve similar embeddings using the approximate (IVF) nearest neighbours index."""
+        return self._to_triplets(*self._ann_top_k(index, N, threshold, n_probe=n_probe))
+
+    def quantize(self, mode='int8', **kwargs):
+        """
+        Build a compressed copy of the embeddings for the 'quantized' search method (see `QuantizedEmbeddings`).
+
+        Args:
+            mode (str): 'float16', 'int8' or 'pq'.
+            **kwargs: Passed to `QuantizedEmbeddings.build` (e.g. `n_subvectors` for 'pq').
+        """
+        self.quantized = QuantizedEmbeddings.build(self.normalized_embeddings, mode=mode, **kwargs)
+        print(f"Quantized {len(self.quantized)} embeddings to {mode}: {self.quantized.nbytes / 2**20:.1f} MB "
+              f"instead of {self.normalized_embeddings.nbytes / 2**20:.1f} MB.")
+        return self.quantized
+
+    def _quantized_top_k_for_rows(self, rows, N, threshold, rescore=True):
+        """
+        Same as `_top_k_for_rows`, but scored on the quantized codes. With `rescore`, a shortlist is rescored
+        against the full-precision (possibly memory-mapped) embeddings, which restores exact scores.
+        """
+        if self.quantized is None:
+            self.quantize()
+        rows = np.asarray(rows, dtype=np.int64)
+        k = min(N, len(self.normalized_embeddings) - 1)
+        if k <= 0:
+            return np.full((len(rows), 0), -1, dtype=np.int64), np.full((len(rows), 0), np.nan, dtype=np.float32)
+        queries = np.asarray(self.normalized_embeddings[rows], dtype=np.float32)
+        indices, scores = self.quantized.search(queries, N=k, exclude=rows,
+                                                exact_embeddings=self.normalized_embeddings if rescore else None)
+        below = scores < threshold
+        indices[below] = -1
+        scores = scores.astype(np.float32)
+        scores[below] = np.nan
+        return indices, scores
+
+    def _top_k(self, rows, method, N, threshold):
+        """Dispatch to the search method; returns padded (indices, scores) arrays of shape (len(rows), k)."""
+        metrics.count('similarity_queries', len(rows))
+        with metrics.timer(f'similarity_search_{method}'):
+            return self._top_k_dispatch(rows, method, N, threshold)
+
+    def _top_k_dispatch(self, rows, method, N, threshold):
+        if method == 'cosine':
+            return self._top_k_for_rows(rows, N, threshold)
+        elif method == 'quantized':
+            return self._quantized_top_k_for_rows(rows, N, threshold)
+        elif method == 'nearest_neighbors':
+            k = max(0, min(N, len(self.filepaths) - 1))
+            indices = np.full((len(rows), k), -1, dtype=np.int64)
+            scores = np.full((len(rows), k), np.nan, dtype=np.float32)
+            for i, row in enumerate(rows):
+                row_indices, row_scores = self._ann_top_k(row, k, threshold)
+                indices[i, :len(row_indices)] = row_indices
+                scores[i, :len(row_scores)] = row_scores
+            return indices, scores
+        raise ValueError("Invalid method specified. Use 'cosine', 'quantized' or 'nearest_neighbors'.")
+
+    def build_ann_index(self, n_lists=None, n_iter=20, n_probe=8, seed=0):
+        """Build the approximate nearest neighbours index over all embeddings (see `IVFIndex.build`)."""
+        self.ann_index = IVFIndex.build(self.embeddings, n_lists=n_lists, n_iter=n_iter, n_probe=n_probe, seed=seed)
+        return self.ann_index
+
+    @staticmethod
+    def ann_index_path(embeddings_path):
+        """Location of the ANN index stored next to an embeddings file, e.g. `embeddings.parquet.ivf`."""
+        return f"{embeddings_path}.ivf"
+
+    def save_ann_index(self, embeddings_path):
+        """Save the ANN index next to the embeddings file it was built from."""
+        if self.ann_index is None:
+            self.build_ann_index()
+        self.ann_index.save(self.ann_index_path(embeddings_path))
+
+    def load_ann_index(self, embeddings_path, mmap=True):
+        """Load (memory-mapped by default) the ANN index stored next to an embeddings file."""
+        self.ann_index = IVFIndex.load(self.ann_index_path(embeddings_path), mmap=mmap)
+        if len(self.ann_index) != len(self.embeddings):
+            raise ValueError(f"ANN index has {len(self.ann_index)} vectors but there are {len(self.embeddings)} embeddings; rebuild it.")
+        return self.ann_index
+
+    def iter_top_k_blocks(self, N=10, threshold=0.95, block_size=256, method='cosine'):
+        """
+        Compute the top-N most similar embeddings for every row, one block of query rows at a time.
+
+        Each block costs a single (block_size x n) matrix product, so peak memory is capped at
+        block_size * n similarities instead of the full n x n matrix.
+
+        Args:
+            N (int): Maximum number of neighbours per row.
+            threshold (float): Minimum cosine similarity for a neighbour to be kept.
+            block_size (int): Number of query rows processed per matrix product.
+            method (str): 'cosine', 'quantized' or 'nearest_neighbors' (see `find_similar`).
+
+        Yields:
+            tuple: (start, indices, scores) where `indices` and `scores` have shape (rows_in_block, k),
+            sorted by decreasing similarity. Neighbours below `threshold` are padded with -1 / NaN.
+        """
+        n = len(self.normalized_embeddings)
+        for start in range(0, n, block_size):
+            indices, scores = self._top_k(np.arange(start, min(start + block_size, n)), method, N, threshold)
+            yield start, indices, scores
+
+    def all_pairs_top_k(self, N=10, threshold=0.95, block_size=256, method='cosine'):
+        """
+        Compute the top-N most similar embeddings above `threshold` for every row.
+
+        Returns:
+            tuple: (indices, scores) arrays of shape (n, k), padded with -1 / NaN (see `iter_top_k_blocks`).
+        """
+        blocks = list(self.iter_top_k_blocks(N=N, threshold=threshold, block_size=block_size, method=method))
+        k = blocks[0][1].shape[1] if blocks else 0
+        indices = np.vstack([b[1] for b in blocks]) if blocks else np.empty((0, k), dtype=np.int64)
+        scores = np.vstack([b[2] for b in blocks]) if blocks else np.empty((0, k), dtype=np.float32)
+        return indices, scores
+
+    def infer_locations(self, lat, long, N=5, threshold=0.8, block_size=1024, scale_km=25.0):
+        """
+        Estimate a location for every embedding without one, from its top-N visual neighbours that have one.
+
+        Untagged rows are scored against the tagged rows only (sliced once), one block at a time, with one
+        matrix product per block. The location is the similarity-weighted mean of the
+        neighbours' positions on the unit sphere, which also works across the antimeridian.
+
+        Args:
+            lat, long: Signed decimal coordinates of every row, NaN where unknown.
+            N (int): Maximum number of tagged neighbours used per row.
+            threshold (float): Minimum cosine similarity of a neighbour.
+            block_size (int): Number of untagged rows per matrix product.
+            scale_km (float): Neighbour spread at which the confidence drops to 1/e of the mean similarity.
+
+        Returns:
+            pd.DataFrame: One row per untagged embedding: `filepath`, `lat`, `long`, `confidence`,
+            `n_neighbors` and `spread_km`. `confidence` is the mean neighbour similarity times
+            `exp(-spread_km / scale_km)` (1 when they all coincide), and is 0 when no neighbour passed
+            the threshold (`lat` / `long` are then NaN). `spread_km` is the weighted mean distance from
+            the estimate to the neighbours.
+        """
+        lat = np.asarray(lat, dtype=float)
+        long = np.asarray(long, dtype=float)
+        tagged = ~np.isnan(lat) & ~np.isnan(long)
+        tagged_rows = np.flatnonzero(tagged)
+        untagged_rows = np.flatnonzero(~tagged)
+        k = min(N, len(tagged_rows))
+        tagged_matrix = np.asarray(self.normalized_embeddings[tagged_rows], dtype=np.float32)
+
+        lat_rad, long_rad = np.radians(lat), np.radians(long)
+        points = np.stack([np.cos(lat_rad) * np.cos(long_rad), np.cos(lat_rad) * np.sin(long_rad), np.sin(lat_rad)], axis=1)
+
+        estimates = np.full((len(untagged_rows), 2), np.nan)
+        confidence = np.zeros(len(untagged_rows))
+        n_neighbors = np.zeros(len(untagged_rows), dtype=np.int64)
+        spread_km = np.full(len(untagged_rows), np.nan)
+        for start in range(0, len(untagged_rows) if k > 0 else 0, block_size):
+            rows = untagged_rows[start:start + block_size]
+            similarities = np.asarray(self.normalized_embeddings[rows], dtype=np.float32) @ tagged_matrix.T
+            top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+            weights = np.take_along_axis(similarities, top, axis=1).astype(float)
+            neighbors = tagged_rows[top]
+            weights[weights < threshold] = 0.0
+
+            total = weights.sum(axis=1)
+            found = total > 0
+            resultant = np.einsum('bk,bkc->bc', weights, points[neighbors])
+            length = np.linalg.norm(resultant, axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                center = resultant / length[:, None]
+                block = slice(start, start + len(rows))
+                estimates[block, 0] = np.where(found, np.degrees(np.arcsin(np.clip(center[:, 2], -1, 1))), np.nan)
+                estimates[block, 1] = np.where(found, np.degrees(np.arctan2(center[:, 1], center[:, 0])), np.nan)
+                angles = np.arccos(np.clip(np.einsum('bc,bkc->bk', center, points[neighbors]), -1, 1))
+                spread_km[block] = np.where(found, (weights * angles).sum(axis=1) / total * 6371.0088, np.nan)
+                confidence[block] = np.where(found, (total / np.maximum((weights > 0).sum(axis=1), 1))
+                                             * np.exp(-spread_km[block] / scale_km), 0.0)
+            n_neighbors[block] = (weights > 0).sum(axis=1)
+
+        return pd.DataFrame({'filepath': self.filepaths[untagged_rows], 'lat': estimates[:, 0], 'long': estimates[:, 1],
+                             'confidence': confidence, 'n_neighbors': n_neighbors, 'spread_km': spread_km})
 
     def standardize_path(self, filepath: str) -> str:
         """
@@ -81,47 +318,126 @@ class EmbeddingRetriever:
         
         return filepath
 
-    def find_similar_embeddings(self, input_value, method='cosine', N=10, threshold=0.95):
-        """Retrieve similar embeddings based on the specified method."""
-        
-        # Standardize the path if the input is a string (i.e., filepath)
-        if isinstance(input_value, str):
-            input_value = self.standardize_path(input_value)
-        
-        # Determine index from input value
-        if isinstance(input_value, int):
-            index = input_value  # If input is an index
+    def _resolve_index(self, input_value):
+        """Row index of an input that is either a row index (int) or a file path (str)."""
+        if isinstance(input_value, (int, np.integer)):
+            if not 0 <= input_value < len(self.filepaths):
+                raise ValueError(f"Index {input_value} is out of range for {len(self.filepaths)} embeddings.")
+            return int(input_value)
         elif isinstance(input_value, str):
-            # If input is a filepath, locate the corresponding index
-            try:
-                index = self.embeddings_df[self.embeddings_df['filepath'] == input_value].index[0]
-            except IndexError:
+            # Standardize the path and look it up in the prebuilt path -> row index
+            index = self.row_by_path.get(self.standardize_path(input_value))
+            if index is None:
                 raise ValueError(f"Image path '{input_value}' not found in the DataFrame.")
-        else:
-            raise ValueError("Input must be an index (int) or a file path (str).")
+            return index
+        raise ValueError("Input must be an index (int) or a file path (str).")
 
-        # Call the appropriate similarity method
-        if method == 'cosine':
-            return self.cosine_similarity(index, threshold, N)
-        elif method == 'nearest_neighbors':
-            return self.approximate_nearest_neighbors(index, N, threshold)
+    def find_similar(self, input_value, method='cosine', N=10, threshold=0.95):
+        """
+        Retrieve similar embeddings based on the specified method, as arrays.
+
+        Args:
+            input_value (int or str): Row index or file path of the query image.
+            method (str): 'cosine' (exact), 'quantized' (compressed codes, exact rescoring) or
+                'nearest_neighbors' (approximate IVF index).
+            N (int): Maximum number of similar images.
+            threshold (float): Minimum cosine similarity.
+
+        Returns:
+            tuple: (indices, scores, paths) arrays, sorted by decreasing similarity.
+        """
+        index = self._resolve_index(input_value)
+        if method == 'nearest_neighbors':
+            indices, scores = self._ann_top_k(index, N, threshold)
         else:
-            raise ValueError("Invalid method specified. Use 'cosine' or 'nearest_neighbors'.")
-   
-    def update_similar_images(self, method='cosine', N=10, threshold=0.95, output_file='data/similar_images.parquet'):
-        """Iterate over all images and update the DataFrame with similar images."""
+            indices, scores = self._top_k([index], method, N, threshold)
+            keep = indices[0] >= 0
+            indices, scores = indices[0][keep], scores[0][keep]
+        return indices, scores, self.filepaths[indices]
+
+    def search_embeddings(self, embeddings, N=10, threshold=0.95):
+        """
+        Exact search for embeddings that are not in the retriever (e.g. of new images), with one matrix product.
+
+        Args:
+            embeddings (np.ndarray): (n, d) or (d,) query embeddings, normalized here.
+            N (int): Maximum number of similar images per query.
+            threshold (float): Minimum cosine similarity.
+
+        Returns:
+            tuple: (indices, scores, paths) arrays of shape (n, k), padded like `find_similar_embeddings_many`.
+        """
+        queries = _l2_normalize(np.atleast_2d(embeddings))
+        metrics.count('similarity_queries', len(queries))
+        with metrics.timer('similarity_search_vectors'):
+            indices, scores = self._top_k_for_vectors(queries, N, threshold)
+        paths = np.full(indices.shape, None, dtype=object)
+        found = indices >= 0
+        paths[found] = self.filepaths[indices[found]]
+        return indices, scores, paths
+
+    def find_similar_embeddings(self, input_value, method='cosine', N=10, threshold=0.95):
+        """Retrieve similar embeddings based on the specified method, as (image_path, similarity, embedding) triplets."""
+        indices, scores, _ = self.find_similar(input_value, method=method, N=N, threshold=threshold)
+        return self._to_triplets(indices, scores)
+
+    def find_similar_embeddings_many(self, inputs, method='cosine', N=10, threshold=0.95, block_size=256):
+        """
+        Retrieve similar embeddings for many queries at once.
+
+        'cosine' and 'quantized' queries are answered with one matrix product per block of `block_size` queries.
+
+        Args:
+            inputs (list): Row indices and/or file paths of the query images.
+            method (str): 'cosine', 'quantized' or 'nearest_neighbors' (see `find_similar`).
+            N (int): Maximum number of similar images per query.
+            threshold (float): Minimum cosine similarity.
+            block_size (int): Number of exact queries per matrix product.
+
+        Returns:
+            tuple: (indices, scores, paths) arrays of shape (len(inputs), k), sorted by decreasing similarity
+            and padded with -1 / NaN / None where fewer than k neighbours pass the threshold.
+        """
+        rows = np.array([self._resolve_index(v) for v in inputs], dtype=np.int64)
+        k = max(0, min(N, len(self.filepaths) - 1))
+        blocks = [self._top_k(rows[start:start + block_size], method, N, threshold) for start in range(0, len(rows), block_size)]
+        indices = np.vstack([b[0] for b in blocks]) if blocks else np.empty((0, k), dtype=np.int64)
+        scores = np.vstack([b[1] for b in blocks]) if blocks else np.empty((0, k), dtype=np.float32)
+
+        paths = np.full(indices.shape, None, dtype=object)
+        found = indices >= 0
+        paths[found] = self.filepaths[indices[found]]
+        return indices, scores, paths
+
+    def update_similar_images(self, method='cosine', N=10, threshold=0.95, output_file='data/similar_images.parquet', block_size=256, include_embeddings=True,
+                              keep_in_memory=True, row_group_size=8192):
+        """
+        Iterate over all images and update the DataFrame with similar images.
+
+        Results are streamed to the Parquet file as they are computed, one row group per `row_group_size`
+        images, so the output table is never built whole. With `include_embeddings=False` the (large)
+        embedding column is left out of the saved Parquet file. With `keep_in_memory=False` the similar images
+        are only written to the file, not added to `embeddings_df`, so memory stays flat.
+        """
+        output_columns = [c for c in self.embeddings_df.columns if include_embeddings or c != 'embedding']
+        if include_embeddings and 'embedding' not in output_columns:
+            print("Embeddings are not saved with the similar images: this retriever was opened from a store (see `from_store`).")
         similar_images_list = []
-        for i in range(len(self.embeddings_df)):
-            similar_images = self.find_similar_embeddings(i, method=method, N=N, threshold=threshold)
-            # Collect similar images for this index
-            similar_images_list.append( similar_images )
-
-        # Update DataFrame with similar images
-        self.embeddings_df['similar_images'] = similar_images_list
-        self.embeddings_df['similar_images'] = self.embeddings_df['similar_images'].apply(lambda x: [k[0] for k in x])
-        self.embeddings_df['threshold'] = threshold
-        # Save the updated DataFrame to a Parquet file
-        self.embeddings_df.to_parquet(output_file, index=False)
+        # All-pairs in blocks: normalized once, one matrix product per block of rows
+        with ParquetStreamWriter(output_file, batch_size=row_group_size) as writer:
+            for start, indices, _ in self.iter_top_k_blocks(N=N, threshold=threshold, block_size=block_size, method=method):
+                similar_images = [list(self.filepaths[row[row >= 0]]) for row in indices]
+                block = self.embeddings_df.iloc[start:start + len(indices)][output_columns].copy()
+                block['similar_images'] = similar_images
+                block['threshold'] = threshold
+                writer.write(block)
+                if keep_in_memory:
+                    similar_images_list += similar_images
+
+        if keep_in_memory:
+            # Update DataFrame with similar images
+            self.embeddings_df['similar_images'] = similar_images_list
+            self.embeddings_df['threshold'] = threshold
         print(f"Saved similar images in Parquet format to {output_file}.")
         return self.embeddings_df
 
@@ -0,0 +1,196 @@
+import json
+import os
+
+import numpy as np
+
+from utils import _l2_normalize
+
+
+class EmbeddingStore:
+    """
+    Columnar on-disk layout for an embedding table, that can be opened without copying.
+
+    A store is a directory with:
+        - `embeddings.npy`: one contiguous (n, d) float32 or float16 matrix, memory-mappable with `np.load`.
+        - `filepaths.txt`: the n image paths, one per line, in matrix row order.
+        - `meta.json`: count, dimension, dtype and whether rows are L2-normalized.
+    """
+
+    MATRIX_FILE = 'embeddings.npy'
+    PATHS_FILE = 'filepaths.txt'
+    META_FILE = 'meta.json'
+
+    def __init__(self, filepaths, embeddings, meta):
+        self.filepaths = filepaths
+        self.embeddings = embeddings
+        self.meta = meta
+
+    def __len__(self):
+        return len(self.filepaths)
+
+    @property
+    def normalized(self):
+        return self.meta.get('normalized', False)
+
+    @classmethod
+    def write(cls, path, filepaths, embeddings, dtype='float32', normalize=True, chunk_size=4096):
+        """
+        Write an embedding table as a store directory.
+
+        Args:
+            path (str): The store directory (created if missing).
+            filepaths (list): Image path of every row.
+            embeddings (np.ndarray or list): (n, d) embeddings, or a sequence of n (d,) arrays.
+            dtype (str): 'float32' or 'float16' (halves the file size).
+            normalize (bool): Store L2-normalized rows, so that cosine retrieval can use the file as is.
+            chunk_size (int): Number of rows converted and written at a time.
+
+        Returns:
+            EmbeddingStore: The written store, memory-mapped.
+        """
+        if dtype not in ('float32', 'float16'):
+            raise ValueError("dtype must be 'float32' or 'float16'.")
+        filepaths = [str(f) for f in filepaths]
+        if any('\n' in f for f in filepaths):
+            raise ValueError("File paths containing newlines are not supported.")
+
+        n = len(filepaths)
+        first = np.asarray(embeddings[0]) if n else np.empty(0)
+        os.makedirs(path, exist_ok=True)
+        # Write chunk by chunk into a preallocated memmap, so a list of arrays is never stacked whole in RAM
+        matrix = np.lib.format.open_memmap(os.path.join(path, cls.MATRIX_FILE), mode='w+', dtype=dtype, shape=(n, first.size))
+        for start in range(0, n, chunk_size):
+            block = np.vstack(embeddings[start:start + chunk_size]).astype(np.float32, copy=False)
+            if normalize:
+                block = _l2_normalize(block)
+            matrix[start:start + len(block)] = block
+        matrix.flush()
+        del matrix
+
+        with open(os.path.join(path, cls.PATHS_FILE), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(filepaths))
+        meta = {'n': n, 'dim': int(first.size), 'dtype': dtype, 'normalized': normalize}
+        with open(os.path.join(path, cls.META_FILE), 'w') as f:
+            json.dump(meta, f)
+        print(f"Saved {n} embeddings ({dtype}) to {path}.")
+        return cls.open(path)
+
+    @classmethod
+    def append(cls, path, filepaths, embeddings, chunk_size=4096):
+        """
+        Add rows at the end of an existing store directory, with the dtype and normalization it was written with.
+
+        The rows are written after the existing ones and the `.npy` header is updated in place (it is padded,
+        so the new shape usually fits), so existing rows are not rewritten. Otherwise the store is rewritten.
+
+        Args:
+            path (str): The store directory.
+            filepaths (list): Image path of every new row.
+            embeddings (np.ndarray or list): (n, d) embeddings, or a sequence of n (d,) arrays.
+            chunk_size (int): Number of rows converted and written at a time.
+
+        Returns:
+            EmbeddingStore: The updated store, memory-mapped.
+        """
+        filepaths = [str(f) for f in filepaths]
+        if any('\n' in f for f in filepaths):
+            raise ValueError("File paths containing newlines are not supported.")
+        with open(os.path.join(path, cls.META_FILE)) as f:
+            meta = json.load(f)
+        n_new = len(filepaths)
+        if meta['n'] == 0 or n_new == 0:
+            if n_new == 0:
+                return cls.open(path)
+            return cls.write(path, filepaths, embeddings, dtype=meta['dtype'], normalize=meta['normalized'], chunk_size=chunk_size)
+        if np.asarray(embeddings[0]).size != meta['dim']:
+            raise ValueError(f"Cannot append {np.asarray(embeddings[0]).size}-dimensional embeddings to a {meta['dim']}-dimensional store.")
+
+        matrix_path = os.path.join(path, cls.MATRIX_FILE)
+        with open(matrix_path, 'r+b') as f:
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            data_start = f.tell()
+            header_start = 8 + (2 if version == (1, 0) else 4)
+            header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order,
+                           'shape': (shape[0] + n_new, shape[1])})
+            if len(header) + 1 > data_start - header_start:
+                header = None
+            else:
+                f.seek(data_start + shape[0] * shape[1] * dtype.itemsize)
+                for start in range(0, n_new, chunk_size):
+                    block = np.vstack(embeddings[start:start + chunk_size]).astype(np.float32, copy=False)
+                    if meta['normalized']:
+                        block = _l2_normalize(block)
+                    f.write(np.ascontiguousarray(block, dtype=dtype).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        if header is None:
+            # No room left in the header: rewrite this store (rows are already normalized)
+            existing = cls.open(path, mmap=False)
+            return cls.write(path, list(existing.filepaths) + filepaths,
+                             np.vstack([existing.embeddings.astype(np.float32), np.vstack(embeddings).astype(np.float32)]),
+                             dtype=meta['dtype'], normalize=meta['normalized'], chunk_size=chunk_size)
+
+        # The rows and their paths are written before the header, which sets the row count: an interrupted
+        # append leaves the previous rows readable, and the extra paths it may leave are dropped
+        paths_path = os.path.join(path, cls.PATHS_FILE)
+        cls._truncate_paths(paths_path, shape[0])
+        with open(paths_path, 'a', encoding='utf-8') as f:
+            f.write('\n' + '\n'.join(filepaths))
+            f.flush()
+            os.fsync(f.fileno())
+        with open(matrix_path, 'r+b') as f:
+            f.seek(header_start)
+            f.write((header.ljust(data_start - header_start - 1) + '\n').encode('latin-1'))
+            f.flush()
+            os.fsync(f.fileno())
+        meta['n'] = shape[0] + n_new
+        with open(os.path.join(path, cls.META_FILE), 'w') as f:
+            json.dump(meta, f)
+        print(f"Appended {n_new} embeddings to {path}.")
+        return cls.open(path)
+
+    @staticmethod
+    def _truncate_paths(paths_path, n, chunk_size=1 << 20):
+        """Drop the lines of a paths file after its first `n` ones (left by an interrupted append), reading it in chunks."""
+        newlines = 0
+        with open(paths_path, 'r+b') as f:
+            while chunk := f.read(chunk_size):
+                count = chunk.count(b'\n')
+                if newlines + count >= n:
+                    # Position of the n-th newline, which ends the n-th line
+                    position = -1
+                    for _ in range(n - newlines):
+                        position = chunk.index(b'\n', position + 1)
+                    f.truncate(f.tell() - len(chunk) + position)
+                    return
+                newlines += count
+
+    @classmethod
+    def count(cls, path):
+        """Number of rows of a store directory, from its metadata only."""
+        with open(os.path.join(path, cls.META_FILE)) as f:
+            return json.load(f)['n']
+
+    @classmethod
+    def open(cls, path, mmap=True):
+        """
+        Open a store directory.
+
+        Args:
+            path (str): The store directory.
+            mmap (bool): Memory-map the matrix (zero-copy, pages are read on demand) instead of reading it.
+
+        Returns:
+            EmbeddingStore: The opened store.
+        """
+        with open(os.path.join(path, cls.META_FILE)) as f:
+            meta = json.load(f)
+        embeddings = np.load(os.path.join(path, cls.MATRIX_FILE), mmap_mode='r' if mmap else None)
+        with open(os.path.join(path, cls.PATHS_FILE), encoding='utf-8') as f:
+            # Paths after the row count of the matrix header were left by an interrupted append
+            filepaths = np.array(f.read().split('\n')[:len(embeddings)], dtype=object)
+        if len(filepaths) != len(embeddings):
+            raise ValueError(f"Store at {path} is inconsistent: {len(filepaths)} paths for {len(embeddings)} embeddings.")
+        return cls(filepaths, embeddings, meta)
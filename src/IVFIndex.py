@@ -0,0 +1,164 @@
+import json
+import os
+
+import numpy as np
+
+from utils import _l2_normalize
+
+
+class IVFIndex:
+    """
+    Inverted-file (IVF) index for approximate cosine-similarity search, in pure NumPy.
+
+    Vectors are L2-normalized and assigned to the closest of `n_lists` centroids found with spherical
+    k-means (coarse quantization). A query only scores the vectors stored in its `n_probe` closest lists.
+    The vectors are stored grouped by list, so each probed list is a contiguous slice that can be read
+    straight from a memory-mapped file.
+    """
+
+    FILES = ('centroids.npy', 'list_offsets.npy', 'ids.npy', 'vectors.npy')
+
+    def __init__(self, centroids, list_offsets, ids, vectors, n_probe=8):
+        """
+        Args:
+            centroids (np.ndarray): (n_lists, d) unit-length coarse centroids.
+            list_offsets (np.ndarray): (n_lists + 1,) start offset of each list in `ids`/`vectors`.
+            ids (np.ndarray): (n,) original row index of every stored vector, grouped by list.
+            vectors (np.ndarray): (n, d) unit-length vectors, grouped by list.
+            n_probe (int): Default number of lists scanned per query.
+        """
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.n_probe = n_probe
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def _assign(vectors, centroids, block_size=4096):
+        """Index of the most similar centroid for every vector, computed block by block."""
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_size):
+            assignments[start:start + block_size] = np.argmax(vectors[start:start + block_size] @ centroids.T, axis=1)
+        return assignments
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, n_iter=20, n_probe=8, max_training_points=None, seed=0):
+        """
+        Build an index from an (n, d) embedding matrix.
+
+        Args:
+            embeddings (np.ndarray): The embedding matrix, one row per image.
+            n_lists (int): Number of coarse clusters. Defaults to ~sqrt(n).
+            n_iter (int): Number of k-means iterations.
+            n_probe (int): Default number of lists scanned per query.
+            max_training_points (int): Sample size used to train the centroids. Defaults to 256 * n_lists.
+            seed (int): Random seed, so that builds are reproducible.
+
+        Returns:
+            IVFIndex: The built index.
+        """
+        vectors = _l2_normalize(embeddings)
+        n = len(vectors)
+        if n == 0:
+            raise ValueError("Cannot build an index from an empty embedding matrix.")
+        if n_lists is None:
+            n_lists = int(np.sqrt(n))
+        n_lists = max(1, min(n_lists, n))
+        if max_training_points is None:
+            max_training_points = 256 * n_lists
+
+        rng = np.random.default_rng(seed)
+        training = vectors if n <= max_training_points else vectors[rng.choice(n, max_training_points, replace=False)]
+
+        # Spherical k-means: assign by dot product, re-estimate and re-normalize the centroids
+        centroids = training[rng.choice(len(training), n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignments = cls._assign(training, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, training)
+            counts = np.bincount(assignments, minlength=n_lists)
+            empty = counts == 0
+            # Re-seed empty clusters with random training points
+            sums[empty] = training[rng.choice(len(training), int(empty.sum()))]
+            centroids = _l2_normalize(sums)
+
+        # Group all vectors by their list so that every list is a contiguous slice
+        assignments = cls._assign(vectors, centroids)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=n_lists)
+        list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(centroids, list_offsets, order.astype(np.int64), vectors[order], n_probe=n_probe)
+
+    def search(self, query, N=10, n_probe=None, exclude=None):
+        """
+        Find the approximate top-N most similar stored vectors for a single query.
+
+        Args:
+            query (np.ndarray): (d,) query embedding (it does not need to be normalized).
+            N (int): Number of neighbours to return.
+            n_probe (int): Number of lists to scan. Defaults to the index's `n_probe`.
+            exclude (int): Optional row index to leave out of the results (e.g. the query itself).
+
+        Returns:
+            tuple: (indices, scores) arrays sorted by decreasing cosine similarity.
+        """
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        query = _l2_normalize(np.asarray(query).reshape(1, -1))[0]
+
+        centroid_scores = self.centroids @ query
+        probed = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+
+        candidate_ids = []
+        candidate_scores = []
+        for list_id in probed:
+            start, stop = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+            if start == stop:
+                continue
+            candidate_ids.append(self.ids[start:stop])
+            candidate_scores.append(self.vectors[start:stop] @ query)
+        if not candidate_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        candidate_ids = np.concatenate(candidate_ids)
+        candidate_scores = np.concatenate(candidate_scores)
+
+        if exclude is not None:
+            keep = candidate_ids != exclude
+            candidate_ids, candidate_scores = candidate_ids[keep], candidate_scores[keep]
+
+        k = min(N, len(candidate_ids))
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        top = np.argpartition(-candidate_scores, k - 1)[:k]
+        top = top[np.argsort(-candidate_scores[top], kind='stable')]
+        return candidate_ids[top], candidate_scores[top]
+
+    def save(self, path):
+        """Save the index as a directory of `.npy` files (plus a small `meta.json`)."""
+        os.makedirs(path, exist_ok=True)
+        for filename, array in zip(self.FILES, (self.centroids, self.list_offsets, self.ids, self.vectors)):
+            np.save(os.path.join(path, filename), np.ascontiguousarray(array))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'type': 'ivf', 'n_probe': self.n_probe, 'n': len(self.ids),
+                       'dim': int(self.vectors.shape[1]), 'n_lists': len(self.centroids)}, f)
+        print(f"Saved IVF index with {len(self.centroids)} lists and {len(self.ids)} vectors to {path}.")
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load an index saved with `save`.
+
+        Args:
+            path (str): The index directory.
+            mmap (bool): Memory-map the arrays instead of reading them into RAM.
+
+        Returns:
+            IVFIndex: The loaded index.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(path, filename), mmap_mode=mmap_mode) for filename in cls.FILES]
+        return cls(*arrays, n_probe=meta.get('n_probe', 8))
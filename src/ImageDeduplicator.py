@@ -0,0 +1,170 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageOps
+
+from EmbeddingCache import EmbeddingCache
+from Metrics import metrics
+from MultiIndexHash import MultiIndexHash
+from utils import _scan_images, _connected_components
+
+
+class ImageDeduplicator:
+    """
+    Cheap duplicate detection, to run before the embedding path.
+
+    Files go through increasingly expensive stages, and each stage only sees what the previous one left:
+        1. an exact content hash (BLAKE2b), which catches byte-identical re-shares without decoding;
+        2. a 64-bit perceptual hash ('dhash' or 'phash') of one file per content hash, from a downscaled
+           decode (JPEG draft mode decodes at 1/2 to 1/8 scale directly);
+        3. a `MultiIndexHash` self-join that links hashes within `max_distance` bits, so recompressed or
+           resized copies are found without comparing every pair.
+    Duplicate groups are the connected components of these links. The representative of a group is its
+    largest file (the least recompressed copy), and only representatives need an embedding.
+    """
+
+    METHODS = ('dhash', 'phash')
+
+    def __init__(self, method: str = 'dhash', max_distance: int = 4, n_workers: int = 8):
+        """
+        Args:
+            method (str): 'dhash' (gradient hash, fastest) or 'phash' (DCT hash, more robust to recompression).
+            max_distance (int): Largest Hamming distance between the hashes of two duplicates.
+            n_workers (int): Files hashed concurrently.
+        """
+        if method not in self.METHODS:
+            raise ValueError(f"Invalid method '{method}'. Use one of {self.METHODS}.")
+        self.method = method
+        self.max_distance = max_distance
+        self.n_workers = n_workers
+
+    @staticmethod
+    def _to_uint64(bits):
+        """Pack 64 booleans (most significant first) into an unsigned 64-bit integer."""
+        return np.packbits(np.asarray(bits, dtype=bool).ravel()).view('>u8')[0].astype(np.uint64)
+
+    @staticmethod
+    def _load_gray(image_path: str, size: tuple):
+        """Grayscale pixels of an image resized to `size` (width, height), decoded at the smallest usable scale."""
+        with Image.open(image_path) as image:
+            image.draft('L', (size[0] * 4, size[1] * 4))
+            image = ImageOps.exif_transpose(image).convert('L').resize(size, Image.Resampling.BOX)
+            return np.asarray(image, dtype=np.float32)
+
+    @classmethod
+    def dhash(cls, image_path: str):
+        """Difference hash: whether each pixel of a 9x8 thumbnail is brighter than its left neighbour."""
+        pixels = cls._load_gray(image_path, (9, 8))
+        return cls._to_uint64(pixels[:, 1:] > pixels[:, :-1])
+
+    # Orthonormal DCT-II basis of size 32, so that a 2D DCT is two matrix products
+    _DCT = np.sqrt(2 / 32) * np.cos(np.pi * np.outer(np.arange(32), 2 * np.arange(32) + 1) / 64)
+    _DCT[0] /= np.sqrt(2)
+
+    @classmethod
+    def phash(cls, image_path: str):
+        """Perceptual hash: whether each of the 8x8 lowest frequencies of a 32x32 thumbnail's DCT is above their median."""
+        pixels = cls._load_gray(image_path, (32, 32))
+        low = (cls._DCT @ pixels @ cls._DCT.T)[:8, :8]
+        # The DC term only carries the mean brightness
+        return cls._to_uint64(low > np.median(low.ravel()[1:]))
+
+    def _map(self, function, filepaths):
+        """`function` over `filepaths` in a thread pool; failed files give None."""
+        def safe(filepath):
+            try:
+                return function(filepath)
+            except Exception as e:
+                metrics.log("Could not hash %s: %s", filepath, e)
+                return None
+        with ThreadPoolExecutor(max_workers=max(1, self.n_workers)) as pool:
+            return list(pool.map(safe, filepaths))
+
+    def find_duplicates(self, filepaths: list) -> pd.DataFrame:
+        """
+        Group identical and near-identical images.
+
+        Args:
+            filepaths (list): Paths of the images.
+
+        Returns:
+            pd.DataFrame: One row per file, in input order, with `filepath`, `content_hash`, `hash` (the
+            perceptual hash as uint64, 0 if the file could not be decoded), `group`, `representative`,
+            `match` ('original' for representatives, 'exact' or 'perceptual' otherwise) and `distance`
+            (Hamming distance to the representative's hash).
+        """
+        filepaths = list(filepaths)
+        n = len(filepaths)
+
+        # Stage 1: exact content hash
+        with metrics.timer('content_hash'):
+            content_hashes = self._map(EmbeddingCache.content_hash, filepaths)
+        sizes = np.array([os.path.getsize(p) if h is not None else -1 for p, h in zip(filepaths, content_hashes)], dtype=np.int64)
+        first_by_hash = {}
+        exact_of = np.arange(n)
+        for i, content_hash in enumerate(content_hashes):
+            if content_hash is not None:
+                exact_of[i] = first_by_hash.setdefault(content_hash, i)
+        uniques = np.flatnonzero(exact_of == np.arange(n))
+
+        # Stage 2: perceptual hash of one file per content
+        hash_function = self.dhash if self.method == 'dhash' else self.phash
+        with metrics.timer('perceptual_hash'):
+            unique_hashes = self._map(hash_function, [filepaths[i] for i in uniques])
+        hashed = np.array([h is not None for h in unique_hashes], dtype=bool)
+        codes = np.zeros(n, dtype=np.uint64)
+        codes[uniques[hashed]] = [h for h in unique_hashes if h is not None]
+        codes = codes[exact_of]
+
+        # Stage 3: Hamming-radius self-join of the decodable unique files
+        candidates = uniques[hashed]
+        a, b, _ = MultiIndexHash(codes[candidates], max_distance=self.max_distance).pairs()
+        sources = np.concatenate([np.arange(n), candidates[a]])
+        targets = np.concatenate([exact_of, candidates[b]])
+        labels = _connected_components(n, sources, targets)
+
+        # Representative: the largest file of each group, the first one on ties
+        order = np.lexsort((np.arange(n), -sizes, labels))
+        firsts = order[np.r_[True, labels[order][1:] != labels[order][:-1]]]
+        representative_of_label = np.empty(n, dtype=np.int64)
+        representative_of_label[labels[firsts]] = firsts
+        representative = representative_of_label[labels]
+        _, groups = np.unique(labels, return_inverse=True)
+
+        match = np.where(representative == np.arange(n), 'original',
+                         np.where(exact_of == exact_of[representative], 'exact', 'perceptual'))
+        result = pd.DataFrame({
+            'filepath': filepaths,
+            'content_hash': content_hashes,
+            'hash': codes,
+            'group': groups,
+            'representative': [filepaths[i] for i in representative],
+            'match': match,
+            'distance': MultiIndexHash.hamming(codes, codes[representative]),
+        })
+        n_exact, n_perceptual = int((match == 'exact').sum()), int((match == 'perceptual').sum())
+        print(f"Found {n_exact} exact and {n_perceptual} near duplicates among {n} images; "
+              f"{n - n_exact - n_perceptual} images left to embed.")
+        return result
+
+    def deduplicate_folder(self, folder_path: str, filter_extensions: list = None, recursive: bool = False,
+                           output_file: str = None) -> pd.DataFrame:
+        """
+        `find_duplicates` over the images of a folder, optionally saved to a CSV file.
+
+        Args:
+            folder_path (str): The folder containing the images.
+            filter_extensions (list): Image file extensions to consider (default: ['.jpg', '.jpeg', '.png']).
+            recursive (bool): Also include the images in subfolders.
+            output_file (str): Optional CSV file the result is written to.
+        """
+        if filter_extensions is None:
+            filter_extensions = ['.jpg', '.jpeg', '.png']
+        filepaths = [entry.path for entry in _scan_images(os.path.abspath(folder_path), filter_extensions, recursive=recursive)]
+        result = self.find_duplicates(filepaths)
+        if output_file is not None:
+            result.to_csv(output_file, index=False)
+            print(f"Saved duplicates to {output_file}.")
+        return result
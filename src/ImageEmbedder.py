@@ -1,53 +1,365 @@
-from torchvision import models, transforms
 from PIL import Image
-import torch
+import numpy as np
 import pandas as pd
+import contextlib
+import hashlib
+import json
+import os
+
+from EmbeddingCache import EmbeddingCache
+from EmbeddingStore import EmbeddingStore
+from utils import _scan_images
+from Metrics import metrics
+from StreamWriter import ParquetStreamWriter
+
+
+# torch and torchvision take seconds to import, so they are only imported when a model is actually used
+
+class ImagePathDataset:
+    """Decodes and preprocesses images from a list of paths, so that a DataLoader can do it in worker processes."""
+    def __init__(self, image_paths, preprocess, image_size=(224, 224)):
+        self.image_paths = image_paths
+        self.preprocess = preprocess
+        # (height, width) of the preprocessed images, for the placeholder of images that cannot be loaded
+        self.image_size = image_size
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index):
+        try:
+            with metrics.timer('decode'):
+                image = self.preprocess(Image.open(self.image_paths[index]).convert('RGB'))
+            return image, index, True
+        except Exception as e:
+            print(f"Could not load {self.image_paths[index]}: {e}")
+            # Placeholder with the right shape, dropped after inference
+            import torch
+            return torch.zeros(3, *self.image_size), index, False
+
+
+class _OnnxFeatureExtractor:
+    """Runs an ONNX-exported feature extractor with onnxruntime, with the same call interface as the torch model."""
+    def __init__(self, model_path):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("Loading an ONNX model requires onnxruntime (pip install onnxruntime).") from e
+        self.session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def __call__(self, images):
+        import torch
+        return torch.from_numpy(self.session.run(None, {self.input_name: images.numpy()})[0])
+
 
 class ImageEmbedder():
-    def __init__(self):
-        # Load pre-trained ResNet-50 model
-        self.model = models.resnet50(pretrained=True)
-        
-        # Remove the final classification layer (fully connected layer)
-        self.model = torch.nn.Sequential(*list(self.model.children())[:-1])  # Remove the last layer
-        
-        self.model.eval()  # Set model to evaluation mode
-
-        # Define image transformations (resize, normalize to match model expectations)
-        self.preprocess = transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ])
+    def __init__(self, cache_path=None, use_content_hash=False, weights_path=None, model_path=None, model_id=None):
+        """
+        The model is loaded on first use, so creating an embedder (e.g. to read cached embeddings) is fast.
+
+        Args:
+            cache_path (str): Optional path of a persistent embedding cache (SQLite file, see `EmbeddingCache`).
+                Only new or changed images are embedded when a cache is used.
+            use_content_hash (bool): Key cache entries by file content hash instead of size + mtime.
+            weights_path (str): Optional local ResNet-50 state dict (e.g. a copy of the torchvision weights file),
+                so no download is needed. Defaults to the torchvision IMAGENET1K_V1 weights (downloaded once
+                into the torch hub cache).
+            model_path (str): Optional feature extractor exported with `export_torchscript` (.pt) or
+                `export_onnx` (.onnx), which loads faster than building the model in Python.
+            model_id (str): Optional name of the weights for the embedding cache key. By default it is derived
+                from the weights / model file name and size.
+        """
+        self.weights_path = weights_path
+        self.model_path = model_path
+        # Identifies the weights, so that cached embeddings from another model are never reused
+        self.model_id = model_id or self._default_model_id()
+        self._model = None
+        self._preprocess = None
+
+        # Image transformations (resize, normalize to match model expectations)
+        self.preprocess_config = {'resize': 256, 'center_crop': 224,
+                                  'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225]}
+
+        # Size of the pooled ResNet-50 features
+        self.embedding_dim = 2048
 
         # Initialize an empty DataFrame to keep track of file paths and embeddings
         self.embeddings_df = pd.DataFrame(columns=['filepath', 'embedding'])
+        # filepath -> embedding, for O(1) lookups of already known embeddings
+        self.embeddings_by_path = {}
+
+        self.cache = EmbeddingCache(cache_path, self.cache_key(), use_content_hash=use_content_hash) if cache_path else None
+
+    def _default_model_id(self):
+        if self.model_path is not None:
+            kind = 'onnx' if self.model_path.endswith('.onnx') else 'torchscript'
+            return f'{kind}/{os.path.basename(self.model_path)}/{os.path.getsize(self.model_path)}'
+        if self.weights_path is not None:
+            return f'resnet50/{os.path.basename(self.weights_path)}/{os.path.getsize(self.weights_path)}'
+        return 'torchvision/resnet50/IMAGENET1K_V1'
+
+    @property
+    def model(self):
+        """The feature extractor (ResNet-50 without its classification layer), loaded on first use."""
+        if self._model is None:
+            self._model = self._load_model()
+        return self._model
+
+    def _load_model(self):
+        import torch
+        if self.model_path is not None:
+            if self.model_path.endswith('.onnx'):
+                return _OnnxFeatureExtractor(self.model_path)
+            return torch.jit.load(self.model_path, map_location='cpu').eval()
+
+        from torchvision import models
+        if self.weights_path is not None:
+            model = models.resnet50(weights=None)
+            model.load_state_dict(torch.load(self.weights_path, map_location='cpu', weights_only=True))
+        else:
+            # Pre-trained ResNet-50, from the torch hub cache after the first download
+            model = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1)
+        # Remove the final classification layer (fully connected layer)
+        model = torch.nn.Sequential(*list(model.children())[:-1])
+        return model.eval()  # Set model to evaluation mode
+
+    @property
+    def preprocess(self):
+        """Image transformations matching `preprocess_config`, built on first use."""
+        if self._preprocess is None:
+            from torchvision import transforms
+            self._preprocess = transforms.Compose([
+                transforms.Resize(self.preprocess_config['resize']),
+                transforms.CenterCrop(self.preprocess_config['center_crop']),
+                transforms.ToTensor(),
+                transforms.Normalize(mean=self.preprocess_config['mean'], std=self.preprocess_config['std']),
+            ])
+        return self._preprocess
+
+    @property
+    def image_size(self):
+        """(height, width) of the preprocessed images, from `preprocess_config['center_crop']` (an int or a pair)."""
+        crop = self.preprocess_config['center_crop']
+        return (crop, crop) if isinstance(crop, int) else tuple(crop)
+
+    def export_torchscript(self, save_path):
+        """Save the feature extractor as a TorchScript file, to be loaded with `ImageEmbedder(model_path=save_path)`."""
+        import torch
+        with torch.no_grad():
+            traced = torch.jit.trace(self.model, torch.zeros(1, 3, *self.image_size))
+        traced.save(save_path)
+        print(f"Saved TorchScript model to {save_path}.")
+
+    def export_onnx(self, save_path):
+        """Save the feature extractor as an ONNX file (dynamic batch size), to be run with onnxruntime."""
+        import torch
+        torch.onnx.export(self.model, torch.zeros(1, 3, *self.image_size), save_path, input_names=['images'], output_names=['features'],
+                          dynamic_axes={'images': {0: 'batch'}, 'features': {0: 'batch'}})
+        print(f"Saved ONNX model to {save_path}.")
+
+    def cache_key(self):
+        """Short hash identifying the model and the preprocessing configuration."""
+        config = json.dumps({'model_id': self.model_id, 'preprocess': self.preprocess_config}, sort_keys=True)
+        return hashlib.sha1(config.encode()).hexdigest()[:16]
+
+    def _append_embeddings(self, image_paths, embeddings):
+        """Add new (filepath, embedding) rows to `embeddings_df` with a single concat."""
+        image_paths = [p for p in image_paths if p not in self.embeddings_by_path]
+        embeddings = [self.embeddings_by_path.setdefault(p, e) for p, e in zip(image_paths, embeddings)]
+        if image_paths:
+            new_embedding_df = pd.DataFrame({'filepath': image_paths, 'embedding': embeddings})
+            self.embeddings_df = pd.concat([self.embeddings_df, new_embedding_df], ignore_index=True)
 
     # Function to calculate embedding for a single image
     def get_embedding(self, image_path, save_embedding=True):
         # Check if embedding already exists for this image
-        if image_path in self.embeddings_df['filepath'].values:
-            print(f"Embedding already exists for {image_path}.")
-            return self.embeddings_df.loc[self.embeddings_df['filepath'] == image_path, 'embedding'].values[0]
+        if image_path in self.embeddings_by_path:
+            metrics.log("Embedding already exists for %s.", image_path)
+            return self.embeddings_by_path[image_path]
 
-        # Load and preprocess the image
-        image = Image.open(image_path).convert('RGB')
-        image = self.preprocess(image).unsqueeze(0)  # Add batch dimension
+        embedding = self.cache.get(image_path) if self.cache is not None else None
+        if embedding is None:
+            # Load and preprocess the image
+            with metrics.timer('decode'):
+                image = Image.open(image_path).convert('RGB')
+                image = self.preprocess(image).unsqueeze(0)  # Add batch dimension
+
+            import torch
+            with torch.no_grad(), metrics.timer('inference'):
+                embedding = self.model(image).squeeze().numpy()  # Remove unnecessary dimensions and convert to NumPy array
+            metrics.count('images_embedded')
+
+            if self.cache is not None:
+                self.cache.put_many([image_path], [embedding])
 
-        with torch.no_grad():
-            embedding = self.model(image).squeeze().numpy()  # Remove unnecessary dimensions and convert to NumPy array
-        
-        # Use pd.concat to add the new DataFrame to the existing one
         if(save_embedding):
-            new_embedding_df = pd.DataFrame({'filepath': [image_path], 'embedding': [embedding]})
-            self.embeddings_df = pd.concat([self.embeddings_df, new_embedding_df], ignore_index=True)
-        
+            self._append_embeddings([image_path], [embedding])
+
         return embedding
 
-    def save_embeddings(self, save_path):
-        # Save the embeddings DataFrame to a Parquet file
-        self.embeddings_df.to_parquet(save_path, index=False)
+    def embed_paths(self, image_paths, batch_size=32, num_workers=None, save_embedding=True, stat_results=None, writer=None):
+        """
+        Calculate embeddings for many images at once.
+
+        JPEG decoding and preprocessing run in `num_workers` DataLoader worker processes while the model
+        runs on batches of `batch_size` images. Results are written into a preallocated float32 array.
+        When a cache is configured, only images that are new or changed since they were cached are decoded.
+
+        Args:
+            image_paths (list): Paths of the images to embed.
+            batch_size (int): Number of images per forward pass.
+            num_workers (int): Number of decoding worker processes. Defaults to one less than the CPU count.
+            save_embedding (bool): Append the new embeddings to `embeddings_df` (in a single concat).
+            stat_results (dict): Optional path -> `os.stat` result already known from a folder scan, used to
+                fingerprint files for the cache without another syscall.
+            writer (ParquetStreamWriter): Optional writer the (filepath, embedding) rows are streamed to, batch
+                by batch as they are computed.
+
+        Returns:
+            tuple: (embeddings, valid) where `embeddings` is a (len(image_paths), embedding_dim) float32 array
+            and `valid` is a boolean mask of the images that could be loaded (invalid rows are zeros).
+        """
+        image_paths = list(image_paths)
+        if num_workers is None:
+            num_workers = max(0, (os.cpu_count() or 1) - 1)
+
+        embeddings = np.zeros((len(image_paths), self.embedding_dim), dtype=np.float32)
+        valid = np.zeros(len(image_paths), dtype=bool)
+        if not image_paths:
+            return embeddings, valid
+
+        # Fill in cache hits, only run the model on the rest
+        to_embed = np.arange(len(image_paths))
+        fingerprints = {}
+        if self.cache is not None:
+            hits, misses, fingerprints = self.cache.lookup_many(image_paths, stat_results=stat_results)
+            for i, path in enumerate(image_paths):
+                if path in hits:
+                    embeddings[i] = hits[path]
+                    valid[i] = True
+            to_embed = np.flatnonzero(~valid)
+            print(f"Found {len(hits)} cached embeddings, {len(misses)} images to embed.")
+            if writer is not None:
+                self._write_rows(writer, image_paths, np.flatnonzero(valid), embeddings)
+
+        if len(to_embed):
+            self._embed_rows(image_paths, to_embed, embeddings, valid, batch_size, num_workers, writer=writer)
+        embeddings[~valid] = 0
+
+        newly_embedded = to_embed[valid[to_embed]]
+        if self.cache is not None and len(newly_embedded):
+            self.cache.put_many([image_paths[i] for i in newly_embedded], embeddings[newly_embedded], fingerprints)
+
+        if save_embedding:
+            self._append_embeddings([p for p, ok in zip(image_paths, valid) if ok], list(embeddings[valid]))
+
+        print(f"Calculated {len(newly_embedded)} embeddings ({len(image_paths) - int(valid.sum())} images could not be loaded).")
+        return embeddings, valid
+
+    @staticmethod
+    def _write_rows(writer, image_paths, rows, embeddings):
+        """Stream the (filepath, embedding) rows `rows` to `writer`."""
+        if len(rows):
+            writer.write(pd.DataFrame({'filepath': [image_paths[i] for i in rows], 'embedding': list(embeddings[rows])}))
+
+    def _embed_rows(self, image_paths, rows, embeddings, valid, batch_size, num_workers, writer=None):
+        """Run the model on `image_paths[rows]`, writing into the `embeddings` / `valid` arrays in place."""
+        import torch
+        from torch.utils.data import DataLoader
+        loader = DataLoader(
+            ImagePathDataset([image_paths[i] for i in rows], self.preprocess, self.image_size),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            shuffle=False,
+        )
+        model = self.model
+        with torch.inference_mode():
+            for images, indices, ok in loader:
+                with metrics.timer('inference'):
+                    batch_embeddings = model(images).flatten(1).numpy()
+                metrics.count('images_embedded', int(ok.sum()))
+                indices = rows[indices.numpy()]
+                embeddings[indices] = batch_embeddings
+                valid[indices] = ok.numpy()
+                if writer is not None:
+                    self._write_rows(writer, image_paths, indices[ok.numpy()], embeddings)
+
+    def embed_folder(self, folder_path, filter_extensions=None, batch_size=32, num_workers=None, save_embedding=True, recursive=False,
+                     deduplicator=None, output_file=None, row_group_size=8192):
+        """
+        Calculate embeddings for every image in a folder whose embedding is not already known.
+        With a cache, entries of files that disappeared from the folder are evicted.
+
+        Args:
+            folder_path (str): The folder containing the images.
+            filter_extensions (list): Image file extensions to consider (default: ['.jpg', '.jpeg', '.png']).
+            recursive (bool): Also embed the images in subfolders.
+            deduplicator (ImageDeduplicator): Optional duplicate detection run first. Only one image per
+                duplicate group goes through the model, the other ones get its embedding.
+            output_file (str): Optional Parquet file the new (filepath, embedding) rows are streamed to as they
+                are computed, in row groups of `row_group_size` rows. Use `save_embedding=False` with it to
+                keep memory flat.
+
+        Returns:
+            tuple: (image_paths, embeddings, valid), see `embed_paths`.
+        """
+        if filter_extensions is None:
+            filter_extensions = ['.jpg', '.jpeg', '.png']
+
+        # The scan's stat results are reused to fingerprint the files for the cache
+        stat_results = {entry.path: entry.stat() for entry in _scan_images(os.path.abspath(folder_path), filter_extensions, recursive=recursive)}
+        image_paths = list(stat_results)
+        if self.cache is not None:
+            self.cache.evict_missing(existing_filepaths=image_paths, folder_path=folder_path, recursive=recursive,
+                                     extensions=filter_extensions)
+        image_paths = [p for p in image_paths if p not in self.embeddings_by_path]
+
+        with (ParquetStreamWriter(output_file, batch_size=row_group_size) if output_file is not None else contextlib.nullcontext()) as writer:
+            if deduplicator is None:
+                embeddings, valid = self.embed_paths(image_paths, batch_size=batch_size, num_workers=num_workers,
+                                                     save_embedding=save_embedding, stat_results=stat_results, writer=writer)
+                return image_paths, embeddings, valid
+
+            duplicates = deduplicator.find_duplicates(image_paths)
+            originals = duplicates['match'].to_numpy() == 'original'
+            representative_paths = duplicates['filepath'].to_numpy(dtype=object)[originals]
+            row_of_representative = {p: row for row, p in enumerate(representative_paths)}
+            rows = np.array([row_of_representative[p] for p in duplicates['representative']], dtype=np.int64)
+
+            representative_embeddings, representative_valid = self.embed_paths(
+                representative_paths, batch_size=batch_size, num_workers=num_workers,
+                save_embedding=save_embedding, stat_results=stat_results, writer=writer)
+            embeddings, valid = representative_embeddings[rows], representative_valid[rows]
+            copied = ~originals & valid
+            if save_embedding:
+                self._append_embeddings([p for p, ok in zip(image_paths, copied) if ok], list(embeddings[copied]))
+            if writer is not None:
+                self._write_rows(writer, image_paths, np.flatnonzero(copied), embeddings)
+            return image_paths, embeddings, valid
+
+    def save_embeddings(self, save_path, row_group_size=8192):
+        # Save the embeddings DataFrame to a Parquet file, one row group at a time so that it is never
+        # converted to Arrow whole
+        with ParquetStreamWriter(save_path, batch_size=row_group_size) as writer:
+            for start in range(0, len(self.embeddings_df), row_group_size):
+                writer.write(self.embeddings_df.iloc[start:start + row_group_size])
         print(f"Saved {len(self.embeddings_df)} embeddings in Parquet format to {save_path}.")
 
 
+
+    def save_embedding_store(self, save_path, dtype='float32'):
+        """
+        Save the embeddings as an `EmbeddingStore` directory: one memory-mappable (n, d) matrix of L2-normalized
+        rows plus a sidecar with the file paths. Open it with `EmbeddingRetriever.from_store`.
+
+        Args:
+            save_path (str): The store directory.
+            dtype (str): 'float32' or 'float16'.
+        """
+        # Same path standardization as EmbeddingRetriever
+        filepaths = [os.path.normpath(os.path.abspath(os.path.expanduser(p))) for p in self.embeddings_df['filepath'].values]
+        return EmbeddingStore.write(save_path, filepaths, self.embeddings_df['embedding'].values, dtype=dtype)
@@ -1,7 +1,13 @@
-from exif import Image as ExifImage
 import os
 import re
+import sys
+import time
 import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from utils import _write_with_exif, _scan_images
+from Metrics import metrics
 
 class ImageProcessor:
     def get_filename_from_path(self, file_path: str) -> str:
@@ -16,25 +22,36 @@ class ImageProcessor:
         """
         return os.path.basename(file_path)
 
-    def list_pic_files_in_folder(self, folder_path: str, filters: list = ['jpg', 'jpeg']) -> list:
+    def iter_pic_files_in_folder(self, folder_path: str, filters: list = ['jpg', 'jpeg'], recursive: bool = False):
+        """
+        Lazily yields the picture files with specified file extensions in a folder (see `utils._scan_images`).
+
+        Args:
+            folder_path (str): The path to the folder.
+            filters (list): A list of file extensions to filter.
+            recursive (bool): Also look in subfolders.
+
+        Yields:
+            os.DirEntry: The entry of each picture file, with its path and cached stat result.
+        """
+        if not os.path.isdir(folder_path):
+            print(f"Folder '{folder_path}' does not exist or is not a directory.")
+            return
+        yield from _scan_images(folder_path, filters, recursive=recursive)
+
+    def list_pic_files_in_folder(self, folder_path: str, filters: list = ['jpg', 'jpeg'], recursive: bool = False) -> list:
         """
         Lists picture files with specified file extensions in a folder.
 
         Args:
             folder_path (str): The path to the folder.
             filters (list): A list of file extensions to filter.
+            recursive (bool): Also look in subfolders.
 
         Returns:
             list: A list of picture files in the folder.
         """
-        jpg_and_jpeg_files = []
-        if os.path.exists(folder_path) and os.path.isdir(folder_path):
-            for filename in os.listdir(folder_path):
-                if filename.lower().endswith(tuple(filters)):
-                    jpg_and_jpeg_files.append(os.path.join(folder_path, filename))
-        else:
-            print(f"Folder '{folder_path}' does not exist or is not a directory.")
-        return jpg_and_jpeg_files
+        return [entry.path for entry in self.iter_pic_files_in_folder(folder_path, filters=filters, recursive=recursive)]
 
     def extract_datetime_from_title(self, filename: str, filter_extensions: list = None) -> datetime.datetime:
         """
@@ -91,21 +108,42 @@ class ImageProcessor:
             output_filename (str): The path to save the cloned image with modified EXIF data.
             datetime_obj (datetime.datetime): The new datetime object for EXIF data.
         """
-        with open(original_filename, 'rb') as img_file:
-            img = ExifImage(img_file)
         # Append exif data
         datetime_str = datetime_obj.strftime('%Y:%m:%d %H:%M:%S')
-        img.datetime = datetime_str
-        img.datetime_original = datetime_str
-        img.datetime_digitized = datetime_str
-        # Save image with modified EXIF metadata
-        with open(output_filename, 'wb') as new_image_file:
-            new_image_file.write(img.get_file())
+        exif_updates = {'datetime': datetime_str, 'datetime_original': datetime_str, 'datetime_digitized': datetime_str}
+        # Save image with modified EXIF metadata, only the exif segment is rewritten
+        _write_with_exif(original_filename, output_filename, exif_updates)
         new_access_time_seconds = datetime_obj.timestamp()
         new_modified_time_seconds = datetime_obj.timestamp()
         os.utime(output_filename, times=(new_access_time_seconds, new_modified_time_seconds))
 
-    def process_images_with_exif(self, folder_path: str, folder_path_exif: str, filters: list, verbose:bool=False) -> None:
+    def process_image_with_exif(self, im_path: str, folder_path_exif: str, filters: list, size: int = None) -> tuple:
+        """
+        Processes a single image: extracts the datetime from its filename and saves a copy with updated EXIF data.
+
+        Args:
+            im_path (str): The path to the image.
+            folder_path_exif (str): The path to the folder where the modified image will be saved (created if missing).
+            filters (list): A list of file extensions to filter.
+            size (int): The size of the image in bytes, if already known from the folder scan.
+
+        Returns:
+            tuple: (status, filename, datetime, bytes) where status is 'processed', 'no_datetime' or 'failed'.
+        """
+        filename = self.get_filename_from_path(im_path)
+        dt_obj = self.extract_datetime_from_title(filename, filter_extensions=filters)
+        if not dt_obj:
+            return ('no_datetime', filename, None, 0)
+        try:
+            os.makedirs(folder_path_exif, exist_ok=True)
+            self.clone_and_save_with_exif(im_path, os.path.join(folder_path_exif, filename), dt_obj)
+        except Exception as e:
+            return ('failed', filename, e, 0)
+        return ('processed', filename, dt_obj, size if size is not None else os.path.getsize(im_path))
+
+    def process_images_with_exif(self, folder_path: str, folder_path_exif: str, filters: list, verbose:bool=False,
+                                 workers: int = 1, executor: str = 'thread', progress_interval: float = 2.0,
+                                 recursive: bool = False) -> dict:
         """
         Processes images in a folder, updates their EXIF data, and saves them in another folder.
 
@@ -113,21 +151,68 @@ class ImageProcessor:
             folder_path (str): The path to the folder containing images.
             folder_path_exif (str): The path to the folder where modified images with EXIF data will be saved.
             filters (list): A list of file extensions to filter.
-        """
-        image_files_path = self.list_pic_files_in_folder(folder_path, filters=filters)
-        print(image_files_path)
-        print([self.get_filename_from_path(f) for f in image_files_path])
-
-        for im_path in image_files_path:
-            filename = self.get_filename_from_path(im_path)
-            out_path = os.path.join(folder_path_exif, filename)
-            dt_obj = self.extract_datetime_from_title(filename, filter_extensions=filters)
-            
-            if dt_obj:
-                self.clone_and_save_with_exif(im_path, out_path, dt_obj)
-                if(verbose):
-                    print(f"Processing {filename}, as date {dt_obj}...")
-            else:
-                print(f"No datetime found in '{filename}'")
-
+            verbose (bool): Print a line per file.
+            workers (int): Number of files processed concurrently.
+            executor (str): 'thread' or 'process' pool, used when workers > 1.
+            progress_interval (float): Seconds between progress lines (files/s, MB/s).
+            recursive (bool): Also process the images in subfolders, whose tree is recreated in `folder_path_exif`.
 
+        Returns:
+            dict: Summary with the number of processed, skipped (no datetime) and failed files, bytes and seconds.
+        """
+        # Files are streamed from the folder scan and processed as they are found
+        image_entries = self.iter_pic_files_in_folder(folder_path, filters=filters, recursive=recursive)
+
+        def output_dir(entry):
+            # The folder tree is kept, so pictures with the same name in subfolders do not collide
+            return os.path.normpath(os.path.join(folder_path_exif, os.path.relpath(os.path.dirname(entry.path), folder_path)))
+
+        summary = {'processed': 0, 'no_datetime': 0, 'failed': 0, 'bytes': 0, 'seconds': 0.0}
+        start = last_report = time.perf_counter()
+
+        def record(result):
+            nonlocal last_report
+            status, filename, value, n_bytes = result
+            summary[status] += 1
+            metrics.count(f'images_{status}')
+            summary['bytes'] += n_bytes
+            if status == 'failed':
+                print(f"Failed to process '{filename}': {value}")
+            elif verbose:
+                if status == 'processed':
+                    print(f"Processing {filename}, as date {value}...")
+                else:
+                    print(f"No datetime found in '{filename}'")
+            now = time.perf_counter()
+            if not verbose and now - last_report >= progress_interval:
+                last_report = now
+                done = summary['processed'] + summary['no_datetime'] + summary['failed']
+                elapsed = now - start
+                sys.stdout.write(f"\r{done} files ({done / elapsed:.1f} files/s, "
+                                 f"{summary['bytes'] / 2**20 / elapsed:.1f} MB/s)")
+                sys.stdout.flush()
+
+        if workers <= 1:
+            for entry in image_entries:
+                record(self.process_image_with_exif(entry.path, output_dir(entry), filters, entry.stat().st_size))
+        else:
+            pool_class = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+            with pool_class(max_workers=workers) as pool:
+                # Bounded number of files in flight, results are recorded as they complete in order
+                in_flight = deque()
+                for entry in image_entries:
+                    in_flight.append(pool.submit(self.process_image_with_exif, entry.path, output_dir(entry), filters, entry.stat().st_size))
+                    if len(in_flight) >= 4 * workers:
+                        record(in_flight.popleft().result())
+                while in_flight:
+                    record(in_flight.popleft().result())
+
+        summary['seconds'] = time.perf_counter() - start
+        total = summary['processed'] + summary['no_datetime'] + summary['failed']
+        elapsed = max(summary['seconds'], 1e-9)
+        if not verbose and last_report != start:
+            sys.stdout.write('\n')
+        print(f"Processed {summary['processed']} of {total} images in {summary['seconds']:.1f}s "
+              f"({total / elapsed:.1f} files/s, {summary['bytes'] / 2**20 / elapsed:.1f} MB/s); "
+              f"{summary['no_datetime']} without a datetime in the filename, {summary['failed']} failed.")
+        return summary
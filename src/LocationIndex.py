@@ -0,0 +1,122 @@
+import ast
+import heapq
+
+import numpy as np
+import pandas as pd
+
+
+class LocationIndex:
+    """
+    Sorted interval index over the (`start`, `end`) time windows of a location mapping.
+
+    Finds the location mapping row whose window contains a datetime with a binary search, instead of
+    masking the whole DataFrame per image. When windows overlap, the first matching row (in DataFrame
+    order) wins, exactly like the boolean-mask lookup it replaces. To get this, the time axis is cut at
+    every window boundary. For each boundary point and each gap between two boundaries, the answer is
+    precomputed with a sweep line, in O(n log n).
+    """
+
+    def __init__(self, df_location_mapping: pd.DataFrame):
+        """
+        Args:
+            df_location_mapping (pd.DataFrame): Location mapping with datetime `start` and `end` columns,
+                and `lat`, `long`, `lat_dms`, `long_dms` columns (as written by `create_exif_map`).
+        """
+        self.df = df_location_mapping.reset_index(drop=True)
+        self.lat = self.df['lat'].values
+        self.long = self.df['long'].values
+        self.lat_dms_str = self.df['lat_dms'].values
+        self.long_dms_str = self.df['long_dms'].values
+        # DMS tuples, parsed once per row on first use
+        self._dms_cache = {}
+
+        starts = self.df['start'].values.astype('datetime64[s]')
+        ends = self.df['end'].values.astype('datetime64[s]')
+        self.points, self.row_at_point, self.row_after_point = self._sweep(starts, ends)
+
+    @staticmethod
+    def _sweep(starts, ends):
+        """Precompute the first matching row at every boundary point and in the gap right after it."""
+        points = np.unique(np.concatenate([starts, ends]))
+        row_at_point = np.full(len(points), -1, dtype=np.int64)
+        row_after_point = np.full(len(points), -1, dtype=np.int64)
+        start_positions = np.searchsorted(points, starts)
+        opening = [[] for _ in range(len(points))]
+        for row, position in enumerate(start_positions):
+            opening[position].append(row)
+
+        # Active windows, as a min-heap of row numbers; windows that ended are removed lazily
+        active = []
+        for i, point in enumerate(points):
+            for row in opening[i]:
+                heapq.heappush(active, row)
+            # windows containing the point itself: start <= point <= end
+            while active and ends[active[0]] < point:
+                heapq.heappop(active)
+            row_at_point[i] = active[0] if active else -1
+            # windows containing the open gap after the point: start <= point < end
+            while active and ends[active[0]] <= point:
+                heapq.heappop(active)
+            row_after_point[i] = active[0] if active else -1
+        return points, row_at_point, row_after_point
+
+    @classmethod
+    def from_csv(cls, location_mapping_csv: str):
+        """Build the index from a location mapping CSV written by `create_exif_map`."""
+        df = pd.read_csv(filepath_or_buffer=location_mapping_csv, header=0)
+        df['start'] = pd.to_datetime(df['start'], format='%Y:%m:%d %H:%M:%S')
+        df['end'] = pd.to_datetime(df['end'], format='%Y:%m:%d %H:%M:%S')
+        return cls(df)
+
+    def __len__(self):
+        return len(self.df)
+
+    def lookup_rows(self, datetimes) -> np.ndarray:
+        """
+        Row of the location mapping whose window contains each datetime, in one vectorized pass.
+
+        Args:
+            datetimes: Sequence of datetimes (or a datetime64 array).
+
+        Returns:
+            np.ndarray: Row index per datetime, -1 when no window contains it.
+        """
+        times = np.asarray(datetimes, dtype='datetime64[s]')
+        if len(self.points) == 0:
+            return np.full(len(times), -1, dtype=np.int64)
+        position = np.searchsorted(self.points, times, side='left')
+        clipped = np.minimum(position, len(self.points) - 1)
+        on_point = (position < len(self.points)) & (self.points[clipped] == times)
+        rows = np.where(position > 0, self.row_after_point[np.maximum(position - 1, 0)], -1)
+        return np.where(on_point, self.row_at_point[clipped], rows)
+
+    def _dms(self, row: int) -> tuple:
+        if row not in self._dms_cache:
+            self._dms_cache[row] = (ast.literal_eval(self.lat_dms_str[row]), ast.literal_eval(self.long_dms_str[row]))
+        return self._dms_cache[row]
+
+    def map_locations(self, datetime_strs: list) -> list:
+        """
+        Location data for many '%Y:%m:%d %H:%M:%S' (or '%Y-%m-%d %H:%M:%S') datetime strings at once.
+
+        Returns:
+            list: One dict per datetime, with the same keys as `utils._map_location_mapping`. `date` is a naive
+            `datetime.datetime` (not a `pd.Timestamp`, whose `timestamp()` would read it as UTC instead of local time).
+        """
+        datetime_strs = [s.replace('-', ':') for s in datetime_strs]
+        datetimes = pd.to_datetime(pd.Series(datetime_strs, dtype=object), format='%Y:%m:%d %H:%M:%S')
+        rows = self.lookup_rows(datetimes.values)
+        mapped = []
+        for datetime_str, my_datetime, row in zip(datetime_strs, datetimes, rows):
+            my_datetime = my_datetime.to_pydatetime()
+            if row < 0:
+                mapped.append({'date_str': datetime_str, 'date': my_datetime, 'lat': None, 'long': None, 'lat_dec': None, 'long_dec': None})
+            else:
+                lat_dms, long_dms = self._dms(row)
+                mapped.append({'date_str': datetime_str, 'date': my_datetime, 'lat': lat_dms, 'long': long_dms,
+                               'lat_dec': self.lat[row], 'long_dec': self.long[row]})
+        return mapped
+
+    def map_location(self, datetime_str: str) -> dict:
+        """Location data for a single datetime string (see `map_locations`)."""
+        return self.map_locations([datetime_str])[0]
@@ -0,0 +1,167 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('photo_geo_tagging')
+
+
+class _NullTimer:
+    """Timer used when metrics are off: entering and leaving it does nothing."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    """
+    Counters and latency histograms for the pipeline stages (file read, exif parse, exif write, decode,
+    inference, similarity search...), plus the per-file progress messages.
+
+    Modes:
+        - 'off' (default): nothing is recorded and per-file messages are dropped. `timer` returns a shared
+          no-op context manager, so instrumented code only pays an attribute check.
+        - 'logging': metrics are recorded and per-file messages go to the 'photo_geo_tagging' logger (DEBUG).
+        - 'json' / 'prometheus': metrics are recorded silently, `dump` renders them in that format.
+
+    The mode can also be set with the PHOTO_GEO_TAGGING_METRICS environment variable. Metrics recorded in
+    worker processes (e.g. `executor='process'`) stay in those processes.
+    """
+
+    MODES = ('off', 'logging', 'json', 'prometheus')
+    # Histogram bucket upper bounds in seconds, 10us to 100s on a log scale (1-2.5-5 steps)
+    BUCKETS = tuple(m * 10.0**e for e in range(-5, 2) for m in (1, 2.5, 5)) + (100.0,)
+
+    def __init__(self, mode: str = 'off'):
+        self.lock = threading.Lock()
+        self.configure(mode)
+
+    def configure(self, mode: str = 'off') -> None:
+        """Switch mode ('off', 'logging', 'json' or 'prometheus') and clear the recorded metrics."""
+        if mode not in self.MODES:
+            raise ValueError(f"Invalid metrics mode '{mode}'. Use one of {self.MODES}.")
+        self.mode = mode
+        self.enabled = mode != 'off'
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters = {}
+            # name -> [bucket counts (+ one overflow bucket), sum, count]
+            self.histograms = {}
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Add `n` to the counter `name`."""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Record one latency of `seconds` in the histogram `name`."""
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def timer(self, name: str):
+        """Context manager recording the duration of its block in the histogram `name`."""
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def log(self, message: str, *args) -> None:
+        """
+        Per-file progress message, only emitted (at DEBUG level) in 'logging' mode. Like `logging`, `message`
+        is %-formatted with `args` only when it is emitted.
+        """
+        if self.mode == 'logging':
+            logger.debug(message, *args)
+
+    def _quantile(self, buckets, count, q):
+        """Upper bound of the bucket holding the q-quantile."""
+        rank = q * count
+        seen = 0
+        for bound, n in zip(self.BUCKETS + (float('inf'),), buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self) -> dict:
+        """Counters, and count / total / mean / approximate p50, p90, p99 (bucket upper bounds) of every histogram."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: (list(h[0]), h[1], h[2]) for name, h in self.histograms.items()}
+        return {
+            'counters': counters,
+            'latencies': {name: {'count': count, 'total_seconds': total, 'mean_seconds': total / count,
+                                 'p50_seconds': self._quantile(buckets, count, 0.5),
+                                 'p90_seconds': self._quantile(buckets, count, 0.9),
+                                 'p99_seconds': self._quantile(buckets, count, 0.99)}
+                          for name, (buckets, total, count) in histograms.items() if count},
+        }
+
+    def to_prometheus(self, prefix: str = 'photo_geo_tagging') -> str:
+        """Metrics in the Prometheus text exposition format."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: (list(h[0]), h[1], h[2]) for name, h in self.histograms.items()}
+        lines = []
+        for name, value in sorted(counters.items()):
+            lines += [f'# TYPE {prefix}_{name}_total counter', f'{prefix}_{name}_total {value}']
+        for name, (buckets, total, count) in sorted(histograms.items()):
+            metric = f'{prefix}_{name}_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            cumulative = 0
+            for bound, n in zip(self.BUCKETS, buckets):
+                cumulative += n
+                lines.append(f'{metric}_bucket{{le="{bound:g}"}} {cumulative}')
+            lines += [f'{metric}_bucket{{le="+Inf"}} {count}', f'{metric}_sum {total}', f'{metric}_count {count}']
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str = None) -> str:
+        """
+        Render the metrics: Prometheus text in 'prometheus' mode, JSON otherwise (in 'logging' mode a summary is
+        also logged at INFO level). The text is written to `path` if given.
+        """
+        if self.mode == 'prometheus':
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=2)
+            if self.mode == 'logging':
+                logger.info(f"Metrics: {text}")
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+
+# Shared instance used by all the modules
+metrics = Metrics(os.environ.get('PHOTO_GEO_TAGGING_METRICS', 'off'))
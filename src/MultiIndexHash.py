@@ -0,0 +1,103 @@
+import numpy as np
+
+
+class MultiIndexHash:
+    """
+    Hamming-radius search over 64-bit hashes (e.g. perceptual image hashes).
+
+    The 64 bits are split into `max_distance + 1` disjoint substrings. Two hashes within `max_distance`
+    bits of each other agree exactly on at least one substring (pigeonhole), so each substring gets a
+    sorted table and only hashes sharing a substring with the query are compared bit by bit. Lookups are
+    `np.searchsorted` ranges, and the all-pairs self-join compares neighbours within equal-key runs.
+    """
+
+    def __init__(self, codes, max_distance: int = 6):
+        """
+        Args:
+            codes: The hashes, as an array of unsigned 64-bit integers.
+            max_distance (int): Largest Hamming distance that can be searched (at most 63).
+        """
+        if not 0 <= max_distance < 64:
+            raise ValueError("max_distance must be between 0 and 63.")
+        self.codes = np.ascontiguousarray(codes, dtype=np.uint64)
+        self.max_distance = max_distance
+        # Substring bit ranges, as even as possible
+        bounds = np.linspace(0, 64, max_distance + 2).astype(int)
+        self.substrings = list(zip(bounds[:-1], bounds[1:]))
+        self.tables = []
+        for start, stop in self.substrings:
+            keys = self._keys(self.codes, start, stop)
+            order = np.argsort(keys, kind='stable')
+            self.tables.append((keys[order], order))
+
+    def __len__(self):
+        return len(self.codes)
+
+    @staticmethod
+    def _keys(codes, start, stop):
+        mask = np.uint64((1 << (stop - start)) - 1)
+        return (codes >> np.uint64(start)) & mask
+
+    @staticmethod
+    def hamming(a, b):
+        """Bitwise Hamming distance between (arrays of) 64-bit hashes."""
+        return np.bitwise_count(np.bitwise_xor(np.asarray(a, dtype=np.uint64), np.asarray(b, dtype=np.uint64))).astype(np.int64)
+
+    def query(self, code, max_distance: int = None):
+        """
+        Hashes within `max_distance` bits of `code`.
+
+        Returns:
+            tuple: (rows, distances) sorted by distance, then row.
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        if max_distance > self.max_distance:
+            raise ValueError(f"The index was built for distances up to {self.max_distance}.")
+        code = np.array([code], dtype=np.uint64)
+        candidates = []
+        for (start, stop), (keys, order) in zip(self.substrings, self.tables):
+            key = self._keys(code, start, stop)
+            lo, hi = np.searchsorted(keys, key, side='left')[0], np.searchsorted(keys, key, side='right')[0]
+            candidates.append(order[lo:hi])
+        rows = np.unique(np.concatenate(candidates))
+        distances = self.hamming(self.codes[rows], code[0])
+        keep = distances <= max_distance
+        rows, distances = rows[keep], distances[keep]
+        order = np.lexsort((rows, distances))
+        return rows[order], distances[order]
+
+    def pairs(self, max_distance: int = None):
+        """
+        All pairs of indexed hashes within `max_distance` bits of each other.
+
+        Returns:
+            tuple: (a, b, distances) arrays with a < b, each pair once, sorted by (a, b).
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        if max_distance > self.max_distance:
+            raise ValueError(f"The index was built for distances up to {self.max_distance}.")
+        n = len(self.codes)
+        found = []
+        for keys, order in self.tables:
+            # Rows sharing a key are contiguous: pair each position with the one `offset` further in its
+            # run, only keeping the positions whose run is still long enough
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            run_end = np.repeat(np.r_[starts[1:], len(keys)], np.diff(np.r_[starts, len(keys)]))
+            positions = np.arange(len(keys))
+            offset = 1
+            while True:
+                positions = positions[run_end[positions] - positions > offset]
+                if not len(positions):
+                    break
+                a, b = order[positions], order[positions + offset]
+                # Verify right away, so memory grows with the matches rather than the candidates
+                close = self.hamming(self.codes[a], self.codes[b]) <= max_distance
+                a, b = a[close], b[close]
+                found.append(np.minimum(a, b) * n + np.maximum(a, b))
+                offset += 1
+        # A pair sharing several substrings is found once per substring
+        pair_ids = np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+        a, b = pair_ids // n, pair_ids % n
+        return a, b, self.hamming(self.codes[a], self.codes[b])
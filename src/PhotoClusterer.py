@@ -0,0 +1,177 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils import _haversine_km, _get_signed_lat_long_decimal, _connected_components
+
+
+class PhotoClusterer:
+    """
+    Cluster a whole photo library into events, combining time gaps, gps distance and visual similarity.
+
+    Photos are sorted by time once and only compared with the next `window` photos, so the work is
+    linear in the number of photos:
+        - two photos are linked when they are less than `max_gap_sec` apart and, if both have gps data,
+          closer than `max_km`;
+        - two photos less than `visual_max_gap_sec` apart are also linked when their embeddings are more
+          similar than `visual_threshold` (same place rule);
+        - photos without a date are linked to their top-`n_neighbors` visual neighbours, found with the
+          `EmbeddingRetriever` search method `neighbor_method`.
+    Clusters are the connected components of these links. Cluster ids are given in order of the first
+    photo of each cluster, so the output is deterministic for a given input.
+    """
+
+    def __init__(self,
+                 max_gap_sec: float = 3600,
+                 max_km: float = 1.0,
+                 visual_threshold: float = 0.9,
+                 visual_max_gap_sec: float = 86400,
+                 window: int = 16,
+                 n_neighbors: int = 10,
+                 neighbor_method: str = 'nearest_neighbors',
+                 chunk_size: int = 4096):
+        """
+        Args:
+            max_gap_sec (float): Maximum time gap between two linked photos.
+            max_km (float): Maximum distance between two linked photos that both have gps data.
+            visual_threshold (float): Minimum cosine similarity of a visual link.
+            visual_max_gap_sec (float): Maximum time gap of a visual link between dated photos.
+            window (int): Number of following photos (in time order) each photo is compared with.
+            n_neighbors (int): Visual neighbours searched for each photo without a date.
+            neighbor_method (str): 'cosine', 'quantized' or 'nearest_neighbors' (see `EmbeddingRetriever.find_similar`).
+            chunk_size (int): Photo pairs whose similarity is computed at a time.
+        """
+        self.max_gap_sec = max_gap_sec
+        self.max_km = max_km
+        self.visual_threshold = visual_threshold
+        self.visual_max_gap_sec = visual_max_gap_sec
+        self.window = window
+        self.n_neighbors = n_neighbors
+        self.neighbor_method = neighbor_method
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def photos_from_exifs(exifs) -> pd.DataFrame:
+        """
+        Photo table (`filepath`, `datetime`, `lat`, `long`) from `_get_exifs` / `_iter_exifs` results.
+        Missing dates and coordinates are NaT / NaN.
+        """
+        rows = []
+        for exif_data in exifs:
+            lat_long = _get_signed_lat_long_decimal(exif_data) or (np.nan, np.nan)
+            rows.append({'filepath': os.path.join(exif_data['filepath'], exif_data['filename']),
+                         'datetime': exif_data.get('datetime_original', exif_data.get('datetime')),
+                         'lat': lat_long[0], 'long': lat_long[1]})
+        photos = pd.DataFrame(rows, columns=['filepath', 'datetime', 'lat', 'long'])
+        photos['datetime'] = pd.to_datetime(photos['datetime'], format='%Y:%m:%d %H:%M:%S', errors='coerce')
+        return photos
+
+    def _geo_ok(self, lat, long, a, b, max_km):
+        """Pairs whose distance is below `max_km`, or where one of the photos has no gps data."""
+        missing = np.isnan(lat[a]) | np.isnan(lat[b])
+        distance = _haversine_km(lat[a], long[a], lat[b], long[b])
+        return missing | (distance <= max_km)
+
+    def _similarities(self, embeddings, a, b):
+        """Cosine similarities of the pairs (a, b) of rows of the normalized embedding matrix, in chunks."""
+        similarities = np.empty(len(a), dtype=np.float32)
+        for start in range(0, len(a), self.chunk_size):
+            stop = start + self.chunk_size
+            similarities[start:stop] = np.einsum('ij,ij->i', np.asarray(embeddings[a[start:stop]], dtype=np.float32),
+                                                 np.asarray(embeddings[b[start:stop]], dtype=np.float32))
+        return similarities
+
+    def _window_links(self, seconds, lat, long, embedding_rows, embeddings):
+        """Links between each dated photo and the next `window` ones, in time order."""
+        sources, targets = [], []
+        n = len(seconds)
+        for offset in range(1, min(self.window, n - 1) + 1):
+            a = np.arange(n - offset)
+            b = a + offset
+            gap = seconds[b] - seconds[a]
+            geo_ok = self._geo_ok(lat, long, a, b, self.max_km)
+            linked = (gap <= self.max_gap_sec) & geo_ok
+            if embeddings is not None:
+                # Visual links, for the pairs not already linked by time
+                candidates = np.flatnonzero(~linked & geo_ok & (gap <= self.visual_max_gap_sec)
+                                            & (embedding_rows[a] >= 0) & (embedding_rows[b] >= 0))
+                similar = self._similarities(embeddings, embedding_rows[a[candidates]], embedding_rows[b[candidates]]) >= self.visual_threshold
+                linked[candidates[similar]] = True
+            sources.append(a[linked])
+            targets.append(b[linked])
+            # Gaps only grow with the offset
+            if not (gap <= max(self.max_gap_sec, self.visual_max_gap_sec if embeddings is not None else 0)).any():
+                break
+        return sources, targets
+
+    def _neighbor_links(self, rows, lat, long, embedding_rows, retriever):
+        """Links between the given photos and their visual neighbours, found with the retriever."""
+        path_rows = np.full(len(retriever.filepaths), -1, dtype=np.int64)
+        with_embedding = np.flatnonzero(embedding_rows >= 0)
+        path_rows[embedding_rows[with_embedding]] = with_embedding
+
+        rows = rows[embedding_rows[rows] >= 0]
+        indices, _, _ = retriever.find_similar_embeddings_many(embedding_rows[rows], method=self.neighbor_method,
+                                                               N=self.n_neighbors, threshold=self.visual_threshold)
+        a = np.repeat(rows, indices.shape[1])
+        b = np.where(indices >= 0, path_rows[np.maximum(indices, 0)], -1).ravel()
+        keep = b >= 0
+        a, b = a[keep], b[keep]
+        keep = self._geo_ok(lat, long, a, b, self.max_km)
+        return [a[keep]], [b[keep]]
+
+    def cluster(self, photos: pd.DataFrame, retriever=None) -> pd.DataFrame:
+        """
+        Assign every photo to an event.
+
+        Args:
+            photos (pd.DataFrame): `filepath`, `datetime`, `lat` and `long` columns (see `photos_from_exifs`).
+            retriever (EmbeddingRetriever): Optional embeddings of the photos, matched by file path. Without
+                it only time and gps data are used.
+
+        Returns:
+            pd.DataFrame: The photos sorted by (`datetime`, `filepath`), undated ones last, with a `cluster` column.
+        """
+        photos = photos.sort_values(['datetime', 'filepath'], kind='stable', na_position='last').reset_index(drop=True)
+        n = len(photos)
+        dated = photos['datetime'].notna().to_numpy()
+        seconds = ((photos['datetime'] - pd.Timestamp(1970, 1, 1)) / pd.Timedelta(seconds=1)).to_numpy(dtype=float)
+        lat = photos['lat'].to_numpy(dtype=float)
+        long = photos['long'].to_numpy(dtype=float)
+
+        embeddings = None
+        embedding_rows = np.full(n, -1, dtype=np.int64)
+        if retriever is not None:
+            embeddings = retriever.normalized_embeddings
+            embedding_rows = np.array([retriever.row_by_path.get(retriever.standardize_path(p), -1) for p in photos['filepath']], dtype=np.int64)
+
+        # Dated photos come first, so the time windows are over rows [0, n_dated)
+        n_dated = int(dated.sum())
+        sources, targets = self._window_links(seconds[:n_dated], lat, long, embedding_rows, embeddings)
+        if retriever is not None and n_dated < n:
+            more_sources, more_targets = self._neighbor_links(np.arange(n_dated, n), lat, long, embedding_rows, retriever)
+            sources += more_sources
+            targets += more_targets
+
+        labels = _connected_components(n, np.concatenate(sources or [np.empty(0, dtype=np.int64)]).astype(np.int64),
+                                       np.concatenate(targets or [np.empty(0, dtype=np.int64)]).astype(np.int64))
+        # Number clusters by their first photo: labels are the smallest row of each component
+        _, photos['cluster'] = np.unique(labels, return_inverse=True)
+        print(f"Clustered {n} photos into {photos['cluster'].nunique()} events.")
+        return photos
+
+    @staticmethod
+    def summarize(clustered: pd.DataFrame) -> pd.DataFrame:
+        """One row per cluster: `start`, `end`, mean `lat` / `long` (of the photos with gps data) and `n_pics`."""
+        return clustered.groupby('cluster', sort=True).agg(start=('datetime', 'min'), end=('datetime', 'max'),
+                                                           lat=('lat', 'mean'), long=('long', 'mean'),
+                                                           n_pics=('filepath', 'size')).reset_index()
+
+    def cluster_to_parquet(self, photos: pd.DataFrame, retriever=None, output_file: str = 'data/clusters.parquet') -> pd.DataFrame:
+        """Cluster the photos (see `cluster`) and save the assignments to a Parquet file, ordered by cluster."""
+        clustered = self.cluster(photos, retriever=retriever)
+        clustered = clustered.sort_values('cluster', kind='stable').reset_index(drop=True)
+        clustered.to_parquet(output_file, index=False)
+        print(f"Saved clusters in Parquet format to {output_file}.")
+        return clustered
@@ -0,0 +1,135 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class PipelineLedger:
+    """
+    Persistent record of the pipeline's progress, backed by a single SQLite file.
+
+    The `files` table has one row per (stage, file) with the fingerprint of the file (size + mtime) and the
+    parameters it was processed with, so a re-run only redoes the files that changed, whose stage parameters
+    changed, or that failed. The `checkpoints` table does the same for the stages that run on a whole folder
+    at once (e.g. the location map). Rows are committed as soon as a file is done, so an interrupted run
+    resumes where it stopped.
+
+    The connection is shared by the stage threads of a `PipelineRunner`, behind a lock.
+    """
+
+    DONE_STATUSES = ('done', 'skipped')
+
+    def __init__(self, ledger_path: str):
+        """
+        Args:
+            ledger_path (str): Path of the SQLite ledger file (created if missing).
+        """
+        self.ledger_path = ledger_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(ledger_path, check_same_thread=False)
+        # WAL: readers (e.g. a progress query from another process) do not block the stage threads
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' stage TEXT NOT NULL,'
+            ' filepath TEXT NOT NULL,'
+            ' fingerprint TEXT NOT NULL,'
+            ' params TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' output TEXT,'
+            ' error TEXT,'
+            ' updated REAL NOT NULL,'
+            ' PRIMARY KEY (stage, filepath))'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS checkpoints ('
+            ' stage TEXT PRIMARY KEY,'
+            ' fingerprint TEXT NOT NULL,'
+            ' params TEXT NOT NULL,'
+            ' output TEXT,'
+            ' updated REAL NOT NULL)'
+        )
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def fingerprint(filepath: str, stat_result: os.stat_result = None) -> str:
+        """Fingerprint of a file's current version (size + mtime), from an already-known `os.stat` result if given."""
+        if stat_result is None:
+            stat_result = os.stat(filepath)
+        return f'{stat_result.st_size}:{stat_result.st_mtime_ns}'
+
+    @staticmethod
+    def params_key(params: dict) -> str:
+        """Canonical string of a stage's parameters."""
+        return json.dumps(params, sort_keys=True, default=str)
+
+    def lookup(self, stage: str, filepath: str, fingerprint: str, params: dict):
+        """
+        Record of `filepath` in `stage`, if it is up to date.
+
+        Returns:
+            tuple: (status, output) if the file was done (or skipped) with this fingerprint and these
+            parameters, and its output still exists. None if it has to be (re)processed.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT status, output FROM files WHERE stage = ? AND filepath = ? AND fingerprint = ? AND params = ?',
+                (stage, filepath, fingerprint, self.params_key(params)),
+            ).fetchone()
+        if row is None or row[0] not in self.DONE_STATUSES or (row[1] is not None and not os.path.exists(row[1])):
+            return None
+        return row
+
+    def mark(self, stage: str, filepath: str, fingerprint: str, params: dict, status: str,
+             output: str = None, error: str = None) -> None:
+        """Record the outcome ('done', 'skipped' or 'failed') of `filepath` in `stage`, committed immediately."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (stage, filepath, fingerprint, self.params_key(params), status, output, error, time.time()),
+            )
+
+    def checkpoint(self, stage: str, fingerprint: str, params: dict):
+        """Output of a whole-folder stage if it was completed with this fingerprint and these parameters (and still exists), else None."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT output FROM checkpoints WHERE stage = ? AND fingerprint = ? AND params = ?',
+                (stage, fingerprint, self.params_key(params)),
+            ).fetchone()
+        if row is None or (row[0] is not None and not os.path.exists(row[0])):
+            return None
+        return row[0]
+
+    def save_checkpoint(self, stage: str, fingerprint: str, params: dict, output: str = None) -> None:
+        """Record that a whole-folder stage completed, committed immediately."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)',
+                (stage, fingerprint, self.params_key(params), output, time.time()),
+            )
+
+    def failures(self, stage: str = None) -> list:
+        """(stage, filepath, error) of the files whose last attempt failed."""
+        query = "SELECT stage, filepath, error FROM files WHERE status = 'failed'"
+        with self.lock:
+            if stage is None:
+                return self.connection.execute(query + ' ORDER BY stage, filepath').fetchall()
+            return self.connection.execute(query + ' AND stage = ? ORDER BY filepath', (stage,)).fetchall()
+
+    def summary(self) -> dict:
+        """stage -> {status: number of files}, over the whole ledger."""
+        summary = {}
+        with self.lock:
+            for stage, status, n in self.connection.execute('SELECT stage, status, COUNT(*) FROM files GROUP BY stage, status'):
+                summary.setdefault(stage, {})[status] = n
+        return summary
@@ -0,0 +1,405 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+
+import pandas as pd
+
+from EmbeddingCache import EmbeddingCache
+from EmbeddingRetriever import EmbeddingRetriever
+from ImageEmbedder import ImageEmbedder
+from ImageProcessor import ImageProcessor
+from LocationIndex import LocationIndex
+from Metrics import metrics
+from PipelineLedger import PipelineLedger
+from StreamWriter import ParquetStreamWriter
+from utils import _scan_images, _get_image_modified_data
+from utils_photo_geo_tagger import create_exif_map, _write_mapped_image
+
+# Put on a queue by a stage when it has no more files to pass on
+_END = object()
+
+
+class PipelineRunner:
+    """
+    Runs the whole workflow, from the WhatsApp and camera folders to the similar images, in one resumable call.
+
+    Stages:
+        - fix_dates: WhatsApp pictures get the date in their filename as exif date (`work_dir/dated`, with the
+          folder tree of the WhatsApp folder).
+        - exif_map: the location map of the camera pictures (`work_dir/location_map.csv`, see `create_exif_map`).
+        - map: the dated pictures get the location of the camera pictures taken at the same time (`work_dir/mapped`).
+          If there is no location map, the dated pictures are skipped (embedded unmapped) until a run has one.
+        - embed: the mapped and camera pictures are embedded into `work_dir/embeddings.sqlite` (an `EmbeddingCache`).
+        - export: all the embeddings are written to `work_dir/embeddings.parquet`.
+        - similar: the similar images of every picture are written to `work_dir/similar_images.parquet`.
+
+    Every stage is recorded in a `PipelineLedger` (`work_dir/ledger.sqlite`), per file or, for the stages that
+    work on a whole folder or table, as a checkpoint. A re-run skips the work that is up to date, redoes the
+    files that changed or failed, and what depends on them; an interrupted run resumes where it stopped.
+
+    The per-file stages run in their own threads, connected by queues of at most `queue_size` files, so
+    dates are fixed while the location map is computed, and pictures are embedded as soon as they are mapped.
+    Export and similar run once the embeddings are all known.
+    """
+
+    STAGES = ('fix_dates', 'exif_map', 'map', 'embed', 'export', 'similar')
+
+    def __init__(self,
+                 whatsapp_folder: str,
+                 camera_folder: str,
+                 work_dir: str,
+                 filters: list = ['jpg', 'jpeg'],
+                 min_gps_threshold_similar: float = 1.0,
+                 min_seconds_threshold_similar: float = 3600,
+                 N: int = 10,
+                 threshold: float = 0.95,
+                 batch_size: int = 32,
+                 queue_size: int = 64,
+                 recursive: bool = False,
+                 weights_path: str = None,
+                 model_path: str = None,
+                 model_id: str = None):
+        """
+        Args:
+            whatsapp_folder (str): Folder of the WhatsApp pictures, whose date is in their filename.
+            camera_folder (str): Folder of the camera pictures, with gps exif data.
+            work_dir (str): Folder where all the outputs and the ledger are saved (created if missing).
+            filters (list): Picture file extensions to consider.
+            min_gps_threshold_similar (float): Maximum distance in kilometers of pictures taken at the same place.
+            min_seconds_threshold_similar (float): Maximum time in seconds between pictures taken at the same place.
+            N (int): Maximum number of similar images per picture.
+            threshold (float): Minimum cosine similarity of similar images.
+            batch_size (int): Number of pictures embedded at a time.
+            queue_size (int): Maximum number of files waiting between two stages.
+            recursive (bool): Also process the pictures in subfolders.
+            weights_path (str): Optional local ResNet-50 weights, see `ImageEmbedder`.
+            model_path (str): Optional exported feature extractor, see `ImageEmbedder`.
+            model_id (str): Optional name of the weights, see `ImageEmbedder`.
+        """
+        self.whatsapp_folder = os.path.abspath(whatsapp_folder)
+        self.camera_folder = os.path.abspath(camera_folder)
+        self.work_dir = work_dir
+        self.filters = filters
+        self.min_gps_threshold_similar = min_gps_threshold_similar
+        self.min_seconds_threshold_similar = min_seconds_threshold_similar
+        self.N = N
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.recursive = recursive
+
+        self.dated_dir = os.path.join(work_dir, 'dated')
+        self.mapped_dir = os.path.join(work_dir, 'mapped')
+        self.location_map_csv = os.path.join(work_dir, 'location_map.csv')
+        self.cache_path = os.path.join(work_dir, 'embeddings.sqlite')
+        self.embeddings_file = os.path.join(work_dir, 'embeddings.parquet')
+        self.similar_file = os.path.join(work_dir, 'similar_images.parquet')
+        self.ledger_path = os.path.join(work_dir, 'ledger.sqlite')
+
+        self.processor = ImageProcessor()
+        # No cache here: the embed stage opens its own connection, the model is only loaded if something is embedded
+        self.embedder = ImageEmbedder(weights_path=weights_path, model_path=model_path, model_id=model_id)
+
+    def run(self) -> dict:
+        """
+        Run (or resume) the pipeline.
+
+        Returns:
+            dict: stage -> {outcome: number of files}, where outcome is 'processed', 'up_to_date', 'failed',
+            'no_datetime' or 'skipped'.
+        """
+        for directory in (self.work_dir, self.dated_dir, self.mapped_dir):
+            os.makedirs(directory, exist_ok=True)
+        self.stop = threading.Event()
+        self.location_map_ready = threading.Event()
+        self.location_map = None
+        self.errors = []
+        self.counts = {}
+        self.counts_lock = threading.Lock()
+        self.embedded_paths = []
+
+        start = time.perf_counter()
+        with PipelineLedger(self.ledger_path) as self.ledger:
+            dates_queue = queue.Queue(maxsize=self.queue_size)
+            map_queue = queue.Queue(maxsize=self.queue_size)
+            embed_queue = queue.Queue(maxsize=self.queue_size)
+            stages = [
+                ('scan', self._scan_stage, (self.whatsapp_folder, dates_queue)),
+                ('fix_dates', self._fix_dates_stage, (dates_queue, map_queue)),
+                ('exif_map', self._exif_map_stage, ()),
+                ('map', self._map_stage, (map_queue, embed_queue)),
+                ('scan', self._scan_stage, (self.camera_folder, embed_queue)),
+                ('embed', self._embed_stage, (embed_queue, 2)),
+            ]
+            threads = [threading.Thread(target=self._run_stage, args=stage, name=f'pipeline-{stage[0]}', daemon=True)
+                       for stage in stages]
+            for thread in threads:
+                thread.start()
+            try:
+                for thread in threads:
+                    while thread.is_alive():
+                        thread.join(timeout=0.5)
+            except KeyboardInterrupt:
+                # Files done so far are in the ledger, the next run resumes from there
+                self.stop.set()
+                for thread in threads:
+                    thread.join()
+                raise
+            if self.errors:
+                stage, error = self.errors[0]
+                raise RuntimeError(f"Pipeline stage '{stage}' failed: {error}") from error
+
+            self._export_and_similar_stages()
+
+        print(f"Pipeline finished in {time.perf_counter() - start:.1f}s, outputs in {self.work_dir}")
+        self.counts = {stage: self.counts[stage] for stage in self.STAGES if stage in self.counts}
+        for stage, counts in self.counts.items():
+            print(f"  {stage}: " + ', '.join(f'{n} {outcome}' for outcome, n in sorted(counts.items())))
+        return self.counts
+
+    def _run_stage(self, name, stage, args):
+        """Thread body: an unexpected error stops all the stages (errors on single files are recorded in the ledger)."""
+        try:
+            stage(*args)
+        except Exception as e:
+            self.errors.append((name, e))
+            self.stop.set()
+
+    def _put(self, q, item) -> bool:
+        """Put `item` on a bounded queue, waiting for room. False if the pipeline was stopped meanwhile."""
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        """Next item of a queue, or `_END` if the pipeline was stopped."""
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _record(self, stage: str, outcome: str, n: int = 1) -> None:
+        with self.counts_lock:
+            counts = self.counts.setdefault(stage, {})
+            counts[outcome] = counts.get(outcome, 0) + n
+        metrics.count(f'pipeline_{stage}_{outcome}', n)
+
+    def _scan_stage(self, folder, q_out):
+        """Pass on (path, stat result, changed) of every picture of a folder."""
+        for entry in self.processor.iter_pic_files_in_folder(folder, filters=self.filters, recursive=self.recursive):
+            if not self._put(q_out, (entry.path, entry.stat(), False)):
+                return
+        self._put(q_out, _END)
+
+    def _fix_dates_stage(self, q_in, q_out):
+        params = {'filters': self.filters}
+        while (item := self._get(q_in)) is not _END:
+            path, stat_result, _ = item
+            fingerprint = self.ledger.fingerprint(path, stat_result)
+            record = self.ledger.lookup('fix_dates', path, fingerprint, params)
+            if record is not None:
+                self._record('fix_dates', 'up_to_date')
+                if record[0] == 'done' and not self._put(q_out, (record[1], None, False)):
+                    return
+                continue
+
+            # The folder tree of the WhatsApp folder is kept, so pictures with the same name in subfolders do not collide
+            output_dir = os.path.normpath(os.path.join(self.dated_dir, os.path.relpath(os.path.dirname(path), self.whatsapp_folder)))
+            os.makedirs(output_dir, exist_ok=True)
+            status, filename, value, _ = self.processor.process_image_with_exif(path, output_dir, self.filters, stat_result.st_size)
+            if status == 'processed':
+                output = os.path.join(output_dir, filename)
+                self.ledger.mark('fix_dates', path, fingerprint, params, 'done', output=output)
+                self._record('fix_dates', 'processed')
+                if not self._put(q_out, (output, None, True)):
+                    return
+            elif status == 'no_datetime':
+                self.ledger.mark('fix_dates', path, fingerprint, params, 'skipped')
+                self._record('fix_dates', 'no_datetime')
+            else:
+                print(f"Failed to process '{filename}': {value}")
+                self.ledger.mark('fix_dates', path, fingerprint, params, 'failed', error=str(value))
+                self._record('fix_dates', 'failed')
+        self._put(q_out, _END)
+
+    def _exif_map_stage(self):
+        """Location map of the camera folder, recomputed only when a camera picture or a threshold changed."""
+        try:
+            params = {'min_gps_threshold_similar': self.min_gps_threshold_similar,
+                      'min_seconds_threshold_similar': self.min_seconds_threshold_similar,
+                      'filters': self.filters, 'recursive': self.recursive}
+            folder_hash = hashlib.blake2b(digest_size=16)
+            for entry in _scan_images(self.camera_folder, self.filters, recursive=self.recursive):
+                folder_hash.update(f'{entry.path}\0{self.ledger.fingerprint(entry.path, entry.stat())}\n'.encode('utf-8'))
+            fingerprint = folder_hash.hexdigest()
+
+            self.location_map = self.ledger.checkpoint('exif_map', fingerprint, params)
+            if self.location_map is not None:
+                self._record('exif_map', 'up_to_date')
+                return
+            try:
+                # create_exif_map joins the folder and the file names as strings
+                result = create_exif_map(os.path.join(self.camera_folder, ''), self.min_gps_threshold_similar,
+                                         self.min_seconds_threshold_similar, output_exif_map=self.location_map_csv,
+                                         name_filters_l=self.filters, recursive=self.recursive,
+                                         keep_in_memory=False)
+            except Exception as e:
+                print(f"Failed to create the location map of '{self.camera_folder}': {e}")
+                result = None
+            if result is None:
+                self._record('exif_map', 'failed')
+                return
+            self.ledger.save_checkpoint('exif_map', fingerprint, params, output=self.location_map_csv)
+            self.location_map = self.location_map_csv
+            self._record('exif_map', 'processed')
+        finally:
+            self.location_map_ready.set()
+
+    def _map_stage(self, q_in, q_out):
+        while not self.location_map_ready.wait(timeout=0.1):
+            if self.stop.is_set():
+                return
+        location_index = None
+        params = {'location_map': None}
+        if self.location_map is not None:
+            location_index = LocationIndex.from_csv(self.location_map)
+            # A new location map remaps every picture
+            params['location_map'] = EmbeddingCache.content_hash(self.location_map)
+
+        while (item := self._get(q_in)) is not _END:
+            path, _, changed = item
+            output = os.path.join(self.mapped_dir, os.path.relpath(path, self.dated_dir))
+            try:
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+                stat_result = os.stat(path)
+                fingerprint = self.ledger.fingerprint(path, stat_result)
+            except OSError as e:
+                print(f"Failed to map '{path}': {e}")
+                self._record('map', 'failed')
+                continue
+            # Dated copies keep the same mtime when they are rewritten, so their changes are passed on explicitly
+            record = None if changed else self.ledger.lookup('map', path, fingerprint, params)
+            if record is not None:
+                self._record('map', 'up_to_date')
+                if not self._put(q_out, (record[1], None, False)):
+                    return
+                continue
+
+            if location_index is None:
+                # Without a location map the dated picture is embedded as it is, and mapped by a run that has one
+                self.ledger.mark('map', path, fingerprint, params, 'skipped', output=path)
+                self._record('map', 'skipped')
+                if not self._put(q_out, (path, None, changed)):
+                    return
+                continue
+
+            try:
+                modified = _get_image_modified_data(path, stat_result)
+                with metrics.timer('location_lookup'):
+                    exif_data = location_index.map_locations([modified])[0]
+                _write_mapped_image(path, output, exif_data)
+                # The copy keeps the (local) modification time of its source
+                if _get_image_modified_data(output) != modified:
+                    raise ValueError(f"modification time {_get_image_modified_data(output)} of the copy is not {modified}")
+            except Exception as e:
+                print(f"Failed to map '{path}': {e}")
+                self.ledger.mark('map', path, fingerprint, params, 'failed', error=str(e))
+                self._record('map', 'failed')
+                continue
+            self.ledger.mark('map', path, fingerprint, params, 'done', output=output)
+            self._record('map', 'processed')
+            if not self._put(q_out, (output, None, True)):
+                return
+        self._put(q_out, _END)
+
+    def _embed_stage(self, q_in, n_inputs):
+        """Embed the pictures of `n_inputs` upstream stages, in batches of `batch_size` new or changed pictures."""
+        params = {'model': self.embedder.cache_key()}
+        pending = []
+        with EmbeddingCache(self.cache_path, self.embedder.cache_key()) as cache:
+            while n_inputs:
+                item = self._get(q_in)
+                if item is _END:
+                    if self.stop.is_set():
+                        return
+                    n_inputs -= 1
+                    continue
+                path, stat_result, changed = item
+                try:
+                    fingerprint = self.ledger.fingerprint(path, stat_result)
+                except OSError as e:
+                    print(f"Failed to embed '{path}': {e}")
+                    self._record('embed', 'failed')
+                    continue
+                self.embedded_paths.append(path)
+                if not changed and self.ledger.lookup('embed', path, fingerprint, params) is not None:
+                    self._record('embed', 'up_to_date')
+                    continue
+                pending.append((path, fingerprint))
+                if len(pending) >= self.batch_size:
+                    self._embed_batch(cache, pending, params)
+                    pending = []
+            self._embed_batch(cache, pending, params)
+
+    def _embed_batch(self, cache, pending, params):
+        if not pending:
+            return
+        paths = [path for path, _ in pending]
+        # Decoded in this thread: DataLoader worker processes are not started from a pipeline thread
+        embeddings, valid = self.embedder.embed_paths(paths, batch_size=self.batch_size, num_workers=0, save_embedding=False)
+        # Replaces the entries of rewritten copies, whose size and mtime may not have changed
+        cache.put_many([path for path, ok in zip(paths, valid) if ok], embeddings[valid], dict(pending))
+        for (path, fingerprint), ok in zip(pending, valid):
+            if ok:
+                self.ledger.mark('embed', path, fingerprint, params, 'done', output=self.cache_path)
+            else:
+                self.ledger.mark('embed', path, fingerprint, params, 'failed', error='could not load image')
+            self._record('embed', 'processed' if ok else 'failed')
+
+    def _export_and_similar_stages(self):
+        """Write the embedding table and its similar images, unless the embeddings are the same as last time."""
+        filepaths = sorted(set(self.embedded_paths))
+        with EmbeddingCache(self.cache_path, self.embedder.cache_key()) as cache:
+            hits, _, _ = cache.lookup_many(filepaths)
+        filepaths = [path for path in filepaths if path in hits]
+        if not filepaths:
+            print("No embeddings to export.")
+            return
+
+        # The outputs only depend on the embedding table
+        table_hash = hashlib.blake2b(digest_size=16)
+        for path in filepaths:
+            table_hash.update(path.encode('utf-8') + b'\0')
+            table_hash.update(hits[path].tobytes())
+        fingerprint = table_hash.hexdigest()
+
+        params = {'model': self.embedder.cache_key()}
+        if self.ledger.checkpoint('export', fingerprint, params) is None:
+            with ParquetStreamWriter(self.embeddings_file) as writer:
+                for start in range(0, len(filepaths), writer.batch_size):
+                    chunk = filepaths[start:start + writer.batch_size]
+                    writer.write(pd.DataFrame({'filepath': chunk, 'embedding': [hits[path] for path in chunk]}))
+            self.ledger.save_checkpoint('export', fingerprint, params, output=self.embeddings_file)
+            print(f"Saved {len(filepaths)} embeddings to {self.embeddings_file}.")
+            self._record('export', 'processed')
+        else:
+            self._record('export', 'up_to_date')
+        del hits
+
+        params = {'model': self.embedder.cache_key(), 'N': self.N, 'threshold': self.threshold}
+        if self.ledger.checkpoint('similar', fingerprint, params) is None:
+            retriever = EmbeddingRetriever(pd.read_parquet(self.embeddings_file))
+            retriever.update_similar_images(N=self.N, threshold=self.threshold, output_file=self.similar_file,
+                                            include_embeddings=False, keep_in_memory=False)
+            self.ledger.save_checkpoint('similar', fingerprint, params, output=self.similar_file)
+            self._record('similar', 'processed')
+        else:
+            self._record('similar', 'up_to_date')
@@ -0,0 +1,197 @@
+import numpy as np
+
+
+class QuantizedEmbeddings:
+    """
+    Compressed copy of an L2-normalized embedding matrix, for memory-efficient cosine-similarity search.
+
+    Modes:
+        - 'float16': half precision, 2 bytes per dimension.
+        - 'int8': scalar quantization with one symmetric scale per dimension, 1 byte per dimension.
+        - 'pq': product quantization, the vector is split in `n_subvectors` parts and each part is replaced by
+          the id of its closest of 256 centroids, so 1 byte per sub-vector (e.g. 64 bytes instead of 8 KB).
+
+    Queries are kept in full precision (asymmetric distance): for 'pq', a (n_subvectors x 256) table of
+    query/centroid dot products is built once per query and scores are sums of table lookups.
+    """
+
+    MODES = ('float16', 'int8', 'pq')
+
+    def __init__(self, mode, codes, scale=None, codebooks=None):
+        """
+        Args:
+            mode (str): One of `MODES`.
+            codes (np.ndarray): (n, d) float16, (n, d) int8 or (n, n_subvectors) uint8 codes.
+            scale (np.ndarray): (d,) per-dimension scale for 'int8'.
+            codebooks (np.ndarray): (n_subvectors, 256, d / n_subvectors) centroids for 'pq'.
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"Invalid quantization mode '{mode}'. Use one of {self.MODES}.")
+        self.mode = mode
+        self.codes = codes
+        self.scale = scale
+        self.codebooks = codebooks
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        """Memory used by the codes and their codebooks / scales."""
+        extra = sum(a.nbytes for a in (self.scale, self.codebooks) if a is not None)
+        return self.codes.nbytes + extra
+
+    @classmethod
+    def build(cls, normalized_embeddings, mode='int8', n_subvectors=64, n_iter=15, max_training_points=16384, chunk_size=65536, seed=0):
+        """
+        Quantize an L2-normalized (n, d) embedding matrix.
+
+        Args:
+            normalized_embeddings (np.ndarray): The matrix to compress (may be memory-mapped).
+            mode (str): 'float16', 'int8' or 'pq'.
+            n_subvectors (int): Number of PQ sub-vectors; must divide d.
+            n_iter (int): k-means iterations used to train the PQ codebooks.
+            max_training_points (int): Sample size used to train the PQ codebooks.
+            chunk_size (int): Rows encoded at a time.
+            seed (int): Random seed for the PQ training sample and initialization.
+
+        Returns:
+            QuantizedEmbeddings: The compressed matrix.
+        """
+        n, d = normalized_embeddings.shape
+        if mode == 'float16':
+            codes = np.empty((n, d), dtype=np.float16)
+            for start in range(0, n, chunk_size):
+                codes[start:start + chunk_size] = normalized_embeddings[start:start + chunk_size]
+            return cls(mode, codes)
+
+        if mode == 'int8':
+            # Symmetric per-dimension scale from the largest absolute value
+            max_abs = np.zeros(d, dtype=np.float32)
+            for start in range(0, n, chunk_size):
+                np.maximum(max_abs, np.abs(normalized_embeddings[start:start + chunk_size]).max(axis=0), out=max_abs)
+            scale = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+            codes = np.empty((n, d), dtype=np.int8)
+            for start in range(0, n, chunk_size):
+                codes[start:start + chunk_size] = np.clip(np.rint(normalized_embeddings[start:start + chunk_size] / scale), -127, 127)
+            return cls(mode, codes, scale=scale)
+
+        if mode == 'pq':
+            if d % n_subvectors:
+                raise ValueError(f"n_subvectors ({n_subvectors}) must divide the embedding dimension ({d}).")
+            sub_d = d // n_subvectors
+            rng = np.random.default_rng(seed)
+            sample = np.sort(rng.choice(n, min(n, max_training_points), replace=False))
+            training = np.asarray(normalized_embeddings[sample], dtype=np.float32).reshape(len(sample), n_subvectors, sub_d)
+            n_centroids = min(256, len(sample))
+            codebooks = np.stack([
+                cls._kmeans(training[:, j], n_centroids, n_iter, rng) for j in range(n_subvectors)
+            ])
+            codes = np.empty((n, n_subvectors), dtype=np.uint8)
+            for start in range(0, n, chunk_size):
+                block = np.asarray(normalized_embeddings[start:start + chunk_size], dtype=np.float32).reshape(-1, n_subvectors, sub_d)
+                for j in range(n_subvectors):
+                    codes[start:start + len(block), j] = cls._nearest_centroid(block[:, j], codebooks[j])
+            return cls(mode, codes, codebooks=codebooks)
+
+        raise ValueError(f"Invalid quantization mode '{mode}'. Use one of {cls.MODES}.")
+
+    @staticmethod
+    def _nearest_centroid(vectors, centroids):
+        """Index of the closest (Euclidean) centroid of every vector."""
+        # argmin ||x - c||^2 == argmax (x.c - ||c||^2 / 2)
+        return np.argmax(vectors @ centroids.T - 0.5 * np.einsum('ij,ij->i', centroids, centroids), axis=1)
+
+    @classmethod
+    def _kmeans(cls, vectors, n_centroids, n_iter, rng):
+        centroids = vectors[rng.choice(len(vectors), n_centroids, replace=False)].copy()
+        for _ in range(n_iter):
+            assignments = cls._nearest_centroid(vectors, centroids)
+            counts = np.bincount(assignments, minlength=n_centroids)
+            filled = counts > 0
+            # Per-cluster sums with one sort + reduceat (much faster than np.add.at)
+            order = np.argsort(assignments, kind='stable')
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums = np.add.reduceat(vectors[order], starts[filled], axis=0)
+            centroids[filled] = sums / counts[filled, None]
+            # Re-seed empty clusters with random points
+            centroids[~filled] = vectors[rng.choice(len(vectors), int((~filled).sum()))]
+        return centroids
+
+    def scores(self, queries, start=0, stop=None):
+        """
+        Approximate cosine similarities between full-precision queries and rows [start, stop) of the codes.
+
+        Args:
+            queries (np.ndarray): (b, d) L2-normalized queries.
+
+        Returns:
+            np.ndarray: (b, stop - start) float32 similarities.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        codes = self.codes[start:stop]
+        if self.mode == 'float16':
+            return queries @ codes.astype(np.float32).T
+        if self.mode == 'int8':
+            # Fold the scale into the query instead of dequantizing the codes
+            return (queries * self.scale) @ codes.astype(np.float32).T
+        # PQ: per-query lookup tables of sub-vector / centroid dot products
+        n_subvectors, _, sub_d = self.codebooks.shape
+        # (n_subvectors, 256, b): gathering whole rows by code is much faster than per-element indexing
+        tables = np.einsum('bjs,jcs->jcb', queries.reshape(len(queries), n_subvectors, sub_d), self.codebooks)
+        scores = np.zeros((len(codes), len(queries)), dtype=np.float32)
+        for j in range(n_subvectors):
+            scores += tables[j][codes[:, j]]
+        return scores.T
+
+    def search(self, queries, N=10, shortlist=None, exact_embeddings=None, exclude=None, chunk_size=65536):
+        """
+        Top-N search over the compressed codes, optionally rescoring a shortlist with exact vectors.
+
+        Args:
+            queries (np.ndarray): (b, d) L2-normalized queries.
+            N (int): Number of neighbours per query.
+            shortlist (int): Number of approximate candidates rescored exactly (default: 10 * N).
+            exact_embeddings (np.ndarray): Full-precision normalized matrix (may be memory-mapped). If None,
+                the approximate scores are returned without rescoring.
+            exclude (np.ndarray): Optional (b,) row index to leave out of each query's results.
+            chunk_size (int): Code rows scored at a time, which bounds the temporary memory.
+
+        Returns:
+            tuple: (indices, scores) arrays of shape (b, min(N, n)) sorted by decreasing similarity.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        b, n = len(queries), len(self.codes)
+        shortlist = min(n, max(N, shortlist or 10 * N))
+        if exact_embeddings is None:
+            shortlist = min(n, N)
+
+        # Running top-`shortlist` over chunks of codes
+        best_ids = np.empty((b, 0), dtype=np.int64)
+        best_scores = np.empty((b, 0), dtype=np.float32)
+        for start in range(0, n, chunk_size):
+            scores = self.scores(queries, start, start + chunk_size)
+            if exclude is not None:
+                local = np.asarray(exclude) - start
+                inside = (local >= 0) & (local < scores.shape[1])
+                scores[np.flatnonzero(inside), local[inside]] = -np.inf
+            ids = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+            all_ids = np.hstack([best_ids, ids])
+            all_scores = np.hstack([best_scores, scores])
+            k = min(shortlist, all_scores.shape[1])
+            top = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+            best_ids = np.take_along_axis(all_ids, top, axis=1)
+            best_scores = np.take_along_axis(all_scores, top, axis=1)
+
+        if exact_embeddings is not None:
+            # Exact rescoring of the shortlist only
+            unique_ids = np.unique(best_ids)
+            candidates = np.asarray(exact_embeddings[unique_ids], dtype=np.float32)
+            positions = np.searchsorted(unique_ids, best_ids)
+            best_scores = np.einsum('bkd,bd->bk', candidates[positions], queries)
+            if exclude is not None:
+                best_scores[best_ids == np.asarray(exclude)[:, None]] = -np.inf
+
+        k = min(N, best_scores.shape[1])
+        top = np.argsort(-best_scores, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(best_ids, top, axis=1), np.take_along_axis(best_scores, top, axis=1)
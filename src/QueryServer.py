@@ -0,0 +1,255 @@
+import asyncio
+import http.client
+import json
+import socket
+import time
+from urllib.parse import urlsplit, parse_qs
+
+from Metrics import Metrics
+
+
+class _Batch:
+    """Queries waiting for the same search, answered together."""
+    def __init__(self):
+        self.items = []
+        self.size = 0
+        self.created = time.perf_counter()
+        self.full = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.results = None
+        self.error = None
+
+
+class QueryServer:
+    """
+    Long-running similarity search service over a warm `EmbeddingRetriever` (and optionally a warm
+    `ImageEmbedder` for images that are not in the retriever), for localhost use.
+
+    It speaks a minimal HTTP/1.1 (keep-alive, JSON bodies) over TCP or a Unix socket:
+        - POST /similar        {"queries": [path or row, ...], "N": 10, "threshold": 0.95, "method": "cosine"}
+        - POST /similar_image  {"image_paths": [path, ...], "N": 10, "threshold": 0.95}
+        - GET  /health
+        - GET  /metrics        latency percentiles and query / batch counts as JSON (`?format=prometheus` for text)
+    Both search endpoints answer {"results": [[{"filepath": ..., "score": ...}, ...], ...]}, one list per query.
+
+    Concurrent queries are micro-batched: a query waits at most `max_wait_ms` (or until `max_batch` queries
+    with the same parameters are queued) and the whole batch is answered with one matrix product, run in a
+    worker thread while the event loop keeps accepting requests.
+    """
+
+    def __init__(self, retriever, embedder=None, max_batch: int = 256, max_wait_ms: float = 2.0):
+        """
+        Args:
+            retriever (EmbeddingRetriever): The indexed embeddings, loaded once.
+            embedder (ImageEmbedder): Optional embedder for /similar_image queries; its model is loaded on start.
+            max_batch (int): Maximum number of queries per batch.
+            max_wait_ms (float): Longest time a query waits for others to join its batch.
+        """
+        self.retriever = retriever
+        self.embedder = embedder
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        # Always on, whatever the mode of the shared pipeline metrics
+        self.metrics = Metrics('json')
+        self.pending = {}
+        self.server = None
+        self.lock = None
+
+    def _warm_up(self):
+        """Load the model and the search structures before the first request."""
+        if self.embedder is not None:
+            self.embedder.model
+        if len(self.retriever.filepaths) > 1:
+            self.retriever.find_similar_embeddings_many([0], N=1, threshold=-1.0)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8765, unix_socket: str = None):
+        """Start listening on `host`:`port`, or on `unix_socket` if given. Returns the asyncio server."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._warm_up)
+        # Searches run one at a time: numpy uses all the cores for one matrix product anyway
+        self.lock = asyncio.Lock()
+        if unix_socket is not None:
+            self.server = await asyncio.start_unix_server(self._handle_connection, path=unix_socket)
+        else:
+            self.server = await asyncio.start_server(self._handle_connection, host=host, port=port)
+        print(f"Query server listening on {unix_socket or '%s:%d' % self.server.sockets[0].getsockname()[:2]} "
+              f"({len(self.retriever.filepaths)} embeddings).")
+        return self.server
+
+    async def serve_forever(self, host: str = '127.0.0.1', port: int = 8765, unix_socket: str = None):
+        server = await self.start(host=host, port=port, unix_socket=unix_socket)
+        async with server:
+            await server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    # Batching
+
+    def _search(self, kind, inputs, method, N, threshold):
+        """Run one batch of queries (in a worker thread)."""
+        if kind == 'image':
+            embeddings, valid = self.embedder.embed_paths(inputs, num_workers=0, save_embedding=False)
+            indices, scores, paths = self.retriever.search_embeddings(embeddings, N=N, threshold=threshold)
+            indices[~valid] = -1
+        else:
+            indices, scores, paths = self.retriever.find_similar_embeddings_many(inputs, method=method, N=N, threshold=threshold)
+        return [[{'filepath': path, 'score': float(score)} for path, score, index in zip(row_paths, row_scores, row_indices) if index >= 0]
+                for row_paths, row_scores, row_indices in zip(paths, scores, indices)]
+
+    async def _run_batch(self, key, batch):
+        try:
+            await asyncio.wait_for(batch.full.wait(), self.max_wait_ms / 1000)
+        except asyncio.TimeoutError:
+            pass
+        kind, method, N, threshold = key
+        async with self.lock:
+            # The batch kept collecting queries while the previous one was searched
+            if self.pending.get(key) is batch:
+                del self.pending[key]
+            self.metrics.observe('batch_wait', time.perf_counter() - batch.created)
+            self.metrics.count('batches')
+            self.metrics.count('queries', batch.size)
+            loop = asyncio.get_running_loop()
+            try:
+                with self.metrics.timer('search'):
+                    batch.results = await loop.run_in_executor(None, self._search, kind, batch.items, method, N, threshold)
+            except Exception as e:
+                batch.error = e
+        batch.ready.set()
+
+    async def query(self, kind, inputs, method='cosine', N=10, threshold=0.95):
+        """Queue `inputs` (paths or rows, or image paths for kind 'image') and wait for their batch's results."""
+        key = (kind, method, int(N), float(threshold))
+        batch = self.pending.get(key)
+        if batch is None or batch.size + len(inputs) > self.max_batch:
+            batch = self.pending[key] = _Batch()
+            asyncio.get_running_loop().create_task(self._run_batch(key, batch))
+        offset = batch.size
+        batch.items.extend(inputs)
+        batch.size += len(inputs)
+        if batch.size >= self.max_batch:
+            batch.full.set()
+            del self.pending[key]
+        await batch.ready.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[offset:offset + len(inputs)]
+
+    # HTTP
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                start = time.perf_counter()
+                status, content_type, payload = await self._dispatch(method, target, body)
+                path = urlsplit(target).path
+                if not status.startswith('404'):
+                    self.metrics.observe(f'request{path.replace("/", "_")}', time.perf_counter() - start)
+
+                writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                             f'Content-Length: {len(payload)}\r\n\r\n'.encode('latin-1') + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, target, body):
+        """Answer one request: (status line, content type, body bytes)."""
+        url = urlsplit(target)
+        try:
+            if method == 'GET' and url.path == '/health':
+                result = {'status': 'ok', 'embeddings': len(self.retriever.filepaths), 'embedder': self.embedder is not None}
+            elif method == 'GET' and url.path == '/metrics':
+                if parse_qs(url.query).get('format') == ['prometheus']:
+                    return '200 OK', 'text/plain; version=0.0.4', self.metrics.to_prometheus('photo_geo_tagging_server').encode()
+                result = self.metrics.snapshot()
+            elif method == 'POST' and url.path in ('/similar', '/similar_image'):
+                request = json.loads(body or b'{}')
+                if url.path == '/similar_image':
+                    if self.embedder is None:
+                        return self._error('400 Bad Request', "The server was started without an embedder.")
+                    kind, inputs = 'image', request['image_paths']
+                else:
+                    kind, inputs = 'similar', request['queries']
+                    # Checked here, so that one bad query does not fail the whole batch
+                    inputs = [self.retriever._resolve_index(value) for value in inputs]
+                results = await self.query(kind, inputs, method=request.get('method', 'cosine'),
+                                           N=request.get('N', 10), threshold=request.get('threshold', 0.95))
+                result = {'results': results}
+            else:
+                return self._error('404 Not Found', f"No route for {method} {url.path}.")
+        except (KeyError, ValueError, TypeError) as e:
+            return self._error('400 Bad Request', str(e))
+        except Exception as e:
+            return self._error('500 Internal Server Error', str(e))
+        return '200 OK', 'application/json', json.dumps(result).encode()
+
+    @staticmethod
+    def _error(status, message):
+        return status, 'application/json', json.dumps({'error': message}).encode()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_socket = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+
+class QueryClient:
+    """Blocking client for a `QueryServer`, keeping its connection open between requests."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8765, unix_socket: str = None, timeout: float = 60):
+        if unix_socket is not None:
+            self.connection = _UnixHTTPConnection(unix_socket, timeout=timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def close(self):
+        self.connection.close()
+
+    def _request(self, method, path, payload=None):
+        body = None if payload is None else json.dumps(payload)
+        self.connection.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+        response = self.connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{response.status} {response.reason}: {data.decode(errors='replace')}")
+        return data if path.endswith('format=prometheus') else json.loads(data)
+
+    def similar(self, queries, N=10, threshold=0.95, method='cosine'):
+        """Similar images of indexed images (file paths or row indices), one list of {filepath, score} per query."""
+        return self._request('POST', '/similar', {'queries': list(queries), 'N': N, 'threshold': threshold, 'method': method})['results']
+
+    def similar_image(self, image_paths, N=10, threshold=0.95):
+        """Similar indexed images of new images, embedded by the server."""
+        return self._request('POST', '/similar_image', {'image_paths': list(image_paths), 'N': N, 'threshold': threshold})['results']
+
+    def health(self):
+        return self._request('GET', '/health')
+
+    def metrics(self, format: str = 'json'):
+        return self._request('GET', '/metrics?format=prometheus' if format == 'prometheus' else '/metrics')
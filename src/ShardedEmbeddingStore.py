@@ -0,0 +1,216 @@
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from EmbeddingStore import EmbeddingStore
+from utils import _l2_normalize
+
+# Shards opened by the current (worker) process, kept memory-mapped between searches
+_open_shards = {}
+
+
+def _get_shard(shard_path):
+    """
+    (store, filepath -> row dict) of a shard, opened once per process and reopened when it grew since
+    (e.g. after an `add`).
+    """
+    n = EmbeddingStore.count(shard_path)
+    shard = _open_shards.get(shard_path)
+    if shard is None or len(shard[0]) != n:
+        store = EmbeddingStore.open(shard_path, mmap=True)
+        shard = _open_shards[shard_path] = (store, {filepath: row for row, filepath in enumerate(store.filepaths)})
+    return shard
+
+
+def _search_shard(shard_path, queries, k, threshold, exclude, block_size):
+    """
+    Top-k rows of one shard for each L2-normalized query (scores above `threshold`, path `exclude[i]` skipped).
+
+    Returns:
+        list: One list of (score, filepath) per query, sorted by decreasing score.
+    """
+    store, row_by_path = _get_shard(shard_path)
+    excluded = [(i, row_by_path[path]) for i, path in enumerate(exclude) if path in row_by_path]
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    # Scan the shard by blocks of rows, keeping a running top-k per query
+    for start in range(0, len(store), block_size):
+        scores = queries @ np.asarray(store.embeddings[start:start + block_size], dtype=np.float32).T
+        for i, row in excluded:
+            if start <= row < start + scores.shape[1]:
+                scores[i, row - start] = -np.inf
+        rows = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+        best_scores = np.concatenate([best_scores, scores], axis=1)
+        best_rows = np.concatenate([best_rows, rows], axis=1)
+        if best_scores.shape[1] > k:
+            top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+            best_scores, best_rows = np.take_along_axis(best_scores, top, axis=1), np.take_along_axis(best_rows, top, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    best_scores, best_rows = np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+    return [[(float(score), store.filepaths[row]) for score, row in zip(query_scores, query_rows) if score >= threshold]
+            for query_scores, query_rows in zip(best_scores, best_rows)]
+
+
+class ShardedEmbeddingStore:
+    """
+    An embedding library split into several `EmbeddingStore` shards, for libraries that do not fit in one
+    process's RAM.
+
+    A sharded store is a directory with one `EmbeddingStore` sub-directory per shard and a `shards.json`
+    manifest. Photos are assigned to a shard by a stable hash of their path ('hash', `n_shards` shards) or by
+    the folder they are in ('folder', e.g. one shard per year folder), so new photos only touch their own
+    shard. Searches scatter the queries over the shards in a process pool, each worker keeping its shards
+    memory-mapped, and the per-shard top-k lists are merged with a heap.
+    """
+
+    MANIFEST_FILE = 'shards.json'
+
+    def __init__(self, path, manifest, n_workers=None):
+        self.path = path
+        self.manifest = manifest
+        self.n_workers = n_workers
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return sum(EmbeddingStore.count(p) for p in self.shard_paths)
+
+    def close(self):
+        """Shut down the worker processes."""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    @property
+    def shard_paths(self):
+        return [os.path.join(self.path, name) for name in self.manifest['shards']]
+
+    @staticmethod
+    def shard_name(filepath, shard_by='hash', n_shards=8):
+        """Shard of a photo: 'shard_<i>' from a hash of its path, or 'shard_<folder>' from its parent folder."""
+        if shard_by == 'hash':
+            digest = hashlib.blake2b(filepath.encode('utf-8'), digest_size=8).digest()
+            return f'shard_{int.from_bytes(digest, "little") % n_shards}'
+        elif shard_by == 'folder':
+            folder = os.path.basename(os.path.dirname(filepath)) or 'root'
+            return 'shard_' + re.sub(r'[^\w.-]', '_', folder)
+        raise ValueError("Invalid shard_by specified. Use 'hash' or 'folder'.")
+
+    def _shard_name(self, filepath):
+        return self.shard_name(filepath, self.manifest['shard_by'], self.manifest['n_shards'])
+
+    @classmethod
+    def write(cls, path, filepaths, embeddings, shard_by='hash', n_shards=8, dtype='float32', n_workers=None):
+        """
+        Split an embedding table into shards and write them.
+
+        Args:
+            path (str): The sharded store directory (created if missing).
+            filepaths (list): Image path of every row (standardized, as in `EmbeddingRetriever`).
+            embeddings (np.ndarray or list): (n, d) embeddings, or a sequence of n (d,) arrays.
+            shard_by (str): 'hash' or 'folder' (see `shard_name`).
+            n_shards (int): Number of shards with 'hash'.
+            dtype (str): 'float32' or 'float16'.
+            n_workers (int): Worker processes used by `search`.
+
+        Returns:
+            ShardedEmbeddingStore: The written store.
+        """
+        filepaths = [str(f) for f in filepaths]
+        manifest = {'shard_by': shard_by, 'n_shards': n_shards, 'dtype': dtype, 'shards': []}
+        store = cls(path, manifest, n_workers=n_workers)
+        os.makedirs(path, exist_ok=True)
+        rows_by_shard = {}
+        for row, filepath in enumerate(filepaths):
+            rows_by_shard.setdefault(store._shard_name(filepath), []).append(row)
+        for name, rows in sorted(rows_by_shard.items()):
+            EmbeddingStore.write(os.path.join(path, name), [filepaths[r] for r in rows], [embeddings[r] for r in rows], dtype=dtype)
+        manifest['shards'] = sorted(rows_by_shard)
+        store._save_manifest()
+        print(f"Saved {len(filepaths)} embeddings in {len(manifest['shards'])} shards to {path}.")
+        return store
+
+    @classmethod
+    def open(cls, path, n_workers=None):
+        """Open a sharded store directory; `n_workers` worker processes are started on the first search."""
+        with open(os.path.join(path, cls.MANIFEST_FILE)) as f:
+            return cls(path, json.load(f), n_workers=n_workers)
+
+    def _save_manifest(self):
+        with open(os.path.join(self.path, self.MANIFEST_FILE), 'w') as f:
+            json.dump(self.manifest, f)
+
+    def add(self, filepaths, embeddings):
+        """
+        Add photos to their shards. Only the shards receiving photos are touched, and their existing rows are
+        not rewritten (see `EmbeddingStore.append`). Photos that are already in their shard are skipped.
+        """
+        filepaths = [str(f) for f in filepaths]
+        rows_by_shard = {}
+        for row, filepath in enumerate(filepaths):
+            rows_by_shard.setdefault(self._shard_name(filepath), []).append(row)
+        for name, rows in sorted(rows_by_shard.items()):
+            shard_path = os.path.join(self.path, name)
+            if name in self.manifest['shards']:
+                _, existing = _get_shard(shard_path)
+                rows = [r for r in rows if filepaths[r] not in existing]
+                EmbeddingStore.append(shard_path, [filepaths[r] for r in rows], [embeddings[r] for r in rows])
+            else:
+                EmbeddingStore.write(shard_path, [filepaths[r] for r in rows], [embeddings[r] for r in rows], dtype=self.manifest['dtype'])
+                self.manifest['shards'] = sorted(self.manifest['shards'] + [name])
+        self._save_manifest()
+
+    def get_embeddings(self, filepaths):
+        """Stored (normalized, float32) embeddings of the given photos, read from their shards."""
+        embeddings = []
+        for filepath in filepaths:
+            shard_path = os.path.join(self.path, self._shard_name(filepath))
+            store, row_by_path = _get_shard(shard_path) if os.path.isdir(shard_path) else (None, {})
+            if filepath not in row_by_path:
+                raise ValueError(f"Image path '{filepath}' not found in the store.")
+            embeddings.append(np.asarray(store.embeddings[row_by_path[filepath]], dtype=np.float32))
+        return np.vstack(embeddings)
+
+    def search(self, queries, N=10, threshold=0.95, block_size=65536):
+        """
+        Top-N most similar photos across all shards.
+
+        Args:
+            queries (list or np.ndarray): File paths of stored photos (which are not returned as their own
+                neighbour), or an (n, d) array of query embeddings.
+            N (int): Maximum number of similar photos per query.
+            threshold (float): Minimum cosine similarity.
+            block_size (int): Shard rows scored at a time in a worker, which bounds its memory.
+
+        Returns:
+            list: One list of (filepath, similarity) per query, sorted by decreasing similarity.
+        """
+        if isinstance(queries, np.ndarray):
+            vectors, exclude = queries, [None] * len(queries)
+        else:
+            vectors, exclude = self.get_embeddings(queries), list(queries)
+        vectors = _l2_normalize(np.atleast_2d(np.asarray(vectors)))
+
+        # Scatter: one task per shard, in the pool (or in this process with n_workers=0)
+        arguments = [(shard_path, vectors, N, threshold, exclude, block_size) for shard_path in self.shard_paths]
+        if self.n_workers == 0:
+            per_shard = [_search_shard(*a) for a in arguments]
+        else:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.n_workers)
+            per_shard = list(self.pool.map(_search_shard, *zip(*arguments)))
+
+        # Gather: each shard's list is sorted, so a heap merge yields the global top-N without a full sort
+        return [[(filepath, score) for score, filepath in itertools.islice(heapq.merge(*lists, key=lambda x: -x[0]), N)]
+                for lists in zip(*per_shard)]
@@ -0,0 +1,226 @@
+import math
+import os
+
+import numpy as np
+
+from utils import _haversine_km, _get_signed_lat_long_decimal
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+class SpatialIndex:
+    """
+    Persistent grid index over photo gps coordinates, for "photos near a place" queries.
+
+    Points are bucketed in fixed-size latitude/longitude cells (`cell_deg` degrees) whose ids are kept
+    sorted, so all the cells of one latitude row that overlap a query are a single `np.searchsorted` range.
+    A radius query only looks at the cells overlapping the circle's bounding box (longitude wrap-around and
+    poles included) and computes exact haversine distances for the points in them. A k-nearest query grows
+    the radius until it holds k points. Inserts go to a small unsorted buffer that is merged into the sorted
+    cells once it grows, so the index can be extended incrementally as new photos are scanned.
+    """
+
+    def __init__(self, cell_deg: float = 0.05):
+        """
+        Args:
+            cell_deg (float): Cell size in degrees (0.05 degrees is about 5.5 km of latitude).
+        """
+        self.cell_deg = cell_deg
+        self.n_rows = int(math.ceil(180 / cell_deg))
+        self.n_cols = int(math.ceil(360 / cell_deg))
+        self.filepaths = []
+        self.row_by_path = {}
+        self.lat = np.empty(0)
+        self.long = np.empty(0)
+        self.size = 0
+        # Sorted cell ids of the merged points and the matching point rows
+        self.sorted_cells = np.empty(0, dtype=np.int64)
+        self.sorted_rows = np.empty(0, dtype=np.int64)
+        # Rows inserted (or moved) since the last merge, scanned linearly by queries
+        self.pending = []
+        self.stale = False
+
+    def __len__(self):
+        return self.size
+
+    def _cell(self, lat, long):
+        row = np.clip(np.floor((np.asarray(lat) + 90) / self.cell_deg), 0, self.n_rows - 1).astype(np.int64)
+        col = np.floor((np.asarray(long) + 180) / self.cell_deg).astype(np.int64) % self.n_cols
+        return row * self.n_cols + col
+
+    def _merge(self):
+        """Re-sort all points by cell id, emptying the pending buffer."""
+        cells = self._cell(self.lat[:self.size], self.long[:self.size])
+        self.sorted_rows = np.argsort(cells, kind='stable')
+        self.sorted_cells = cells[self.sorted_rows]
+        self.pending = []
+        self.stale = False
+
+    def insert_many(self, filepaths: list, lats, longs) -> None:
+        """
+        Add photos to the index. A filepath that is already indexed gets its coordinates updated.
+
+        Args:
+            filepaths (list): Paths of the photos.
+            lats, longs: Signed decimal coordinates.
+        """
+        lats = np.asarray(lats, dtype=float)
+        longs = np.asarray(longs, dtype=float)
+        needed = self.size + len(lats)
+        if needed > len(self.lat):
+            # Grow the arrays geometrically, so inserts are amortized O(1)
+            capacity = max(1024, 2 * len(self.lat), needed)
+            self.lat = np.resize(self.lat, capacity)
+            self.long = np.resize(self.long, capacity)
+        for filepath, lat, long in zip(filepaths, lats, longs):
+            row = self.row_by_path.get(filepath)
+            if row is not None:
+                # Moved photo: its sorted cell is out of date
+                self.stale = True
+            else:
+                row = self.size
+                self.filepaths.append(filepath)
+                self.row_by_path[filepath] = row
+                self.size += 1
+                self.pending.append(row)
+            self.lat[row] = lat
+            self.long[row] = long
+        if self.stale or len(self.pending) > max(1024, self.size // 16):
+            self._merge()
+
+    def insert(self, filepath: str, lat: float, long: float) -> None:
+        """Add a single photo (see `insert_many`)."""
+        self.insert_many([filepath], [lat], [long])
+
+    def insert_exifs(self, exifs: list) -> int:
+        """
+        Add the photos of `_get_exifs` / `_iter_exifs` results that have gps data.
+
+        Returns:
+            int: Number of photos added.
+        """
+        filepaths, lats, longs = [], [], []
+        for exif_data in exifs:
+            lat_long = _get_signed_lat_long_decimal(exif_data)
+            if lat_long is None:
+                continue
+            filepaths.append(os.path.join(exif_data['filepath'], exif_data['filename']))
+            lats.append(lat_long[0])
+            longs.append(lat_long[1])
+        self.insert_many(filepaths, lats, longs)
+        return len(filepaths)
+
+    @classmethod
+    def from_exifs(cls, exifs: list, cell_deg: float = 0.05):
+        """Build an index from `_get_exifs` / `_iter_exifs` results."""
+        index = cls(cell_deg=cell_deg)
+        index.insert_exifs(exifs)
+        return index
+
+    def _candidates_in_box(self, min_lat, min_long, max_lat, max_long):
+        """Rows of the points in the cells overlapping a box (`max_long` may exceed 180 to wrap around)."""
+        row_start, row_stop = (int(np.clip(math.floor((x + 90) / self.cell_deg), 0, self.n_rows - 1)) for x in (min_lat, max_lat))
+        if max_long - min_long >= 360:
+            col_ranges = [(0, self.n_cols - 1)]
+        else:
+            col_start = math.floor((min_long + 180) / self.cell_deg) % self.n_cols
+            col_stop = math.floor((max_long + 180) / self.cell_deg) % self.n_cols
+            col_ranges = [(col_start, col_stop)] if col_start <= col_stop else [(col_start, self.n_cols - 1), (0, col_stop)]
+
+        grid_rows = np.arange(row_start, row_stop + 1, dtype=np.int64) * self.n_cols
+        lows = np.concatenate([grid_rows + lo for lo, _ in col_ranges])
+        highs = np.concatenate([grid_rows + hi for _, hi in col_ranges])
+        starts = np.searchsorted(self.sorted_cells, lows, side='left')
+        stops = np.searchsorted(self.sorted_cells, highs, side='right')
+        slices = [self.sorted_rows[a:b] for a, b in zip(starts, stops) if b > a]
+        if self.pending:
+            slices.append(np.asarray(self.pending, dtype=np.int64))
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+    def _candidates_in_radius(self, lat: float, long: float, radius_km: float):
+        angular = radius_km / EARTH_RADIUS_KM
+        dlat = math.degrees(angular)
+        min_lat, max_lat = lat - dlat, lat + dlat
+        if min_lat <= -90 or max_lat >= 90 or math.sin(angular) >= math.cos(math.radians(lat)):
+            # The circle contains a pole: every longitude
+            dlong = 180.0
+        else:
+            dlong = math.degrees(math.asin(math.sin(angular) / math.cos(math.radians(lat))))
+        return self._candidates_in_box(max(min_lat, -90), long - dlong, min(max_lat, 90), long + dlong)
+
+    def query_radius(self, lat: float, long: float, radius_km: float):
+        """
+        Photos within `radius_km` of a point.
+
+        Returns:
+            tuple: (rows, distances_km, filepaths) sorted by increasing distance.
+        """
+        candidates = self._candidates_in_radius(lat, long, radius_km)
+        distances = _haversine_km(lat, long, self.lat[candidates], self.long[candidates])
+        keep = distances <= radius_km
+        candidates, distances = candidates[keep], distances[keep]
+        order = np.argsort(distances, kind='stable')
+        candidates, distances = candidates[order], distances[order]
+        return candidates, distances, [self.filepaths[r] for r in candidates]
+
+    def query_box(self, min_lat: float, min_long: float, max_lat: float, max_long: float):
+        """
+        Photos inside a latitude/longitude bounding box. If `min_long` > `max_long` the box crosses
+        the antimeridian.
+
+        Returns:
+            tuple: (rows, filepaths).
+        """
+        if min_long > max_long:
+            max_long += 360
+        candidates = self._candidates_in_box(min_lat, min_long, max_lat, max_long)
+        lat, long = self.lat[candidates], self.long[candidates]
+        long = np.where(long < min_long, long + 360, long)
+        keep = (lat >= min_lat) & (lat <= max_lat) & (long >= min_long) & (long <= max_long)
+        candidates = np.sort(candidates[keep])
+        return candidates, [self.filepaths[r] for r in candidates]
+
+    def query_knn(self, lat: float, long: float, k: int = 10):
+        """
+        The k photos closest to a point.
+
+        Returns:
+            tuple: (rows, distances_km, filepaths) sorted by increasing distance.
+        """
+        k = min(k, self.size)
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0), []
+        # Start from a radius fitted to the density of the query's own cell
+        cell_km = self.cell_deg * 111.0
+        cell = self._cell(lat, long)
+        in_cell = np.searchsorted(self.sorted_cells, cell, side='right') - np.searchsorted(self.sorted_cells, cell, side='left')
+        radius_km = cell_km * min(1.0, math.sqrt(k / in_cell)) if in_cell else cell_km
+        while True:
+            rows, distances, filepaths = self.query_radius(lat, long, radius_km)
+            # Every point outside the circle is farther than every point inside it
+            if len(rows) >= k or radius_km >= math.pi * EARTH_RADIUS_KM:
+                return rows[:k], distances[:k], filepaths[:k]
+            radius_km *= 2
+
+    def save(self, path: str) -> None:
+        """Save the index as a single `.npz` file."""
+        if self.pending or self.stale:
+            self._merge()
+        np.savez(path, lat=self.lat[:self.size], long=self.long[:self.size],
+                 filepaths=np.array(self.filepaths, dtype=str), cell_deg=self.cell_deg,
+                 sorted_cells=self.sorted_cells, sorted_rows=self.sorted_rows)
+        print(f"Saved spatial index with {self.size} photos to {path}.")
+
+    @classmethod
+    def load(cls, path: str):
+        """Load an index saved with `save`."""
+        with np.load(path) as data:
+            index = cls(cell_deg=float(data['cell_deg']))
+            index.filepaths = data['filepaths'].tolist()
+            index.row_by_path = {filepath: row for row, filepath in enumerate(index.filepaths)}
+            index.lat = data['lat'].copy()
+            index.long = data['long'].copy()
+            index.size = len(index.filepaths)
+            index.sorted_cells = data['sorted_cells']
+            index.sorted_rows = data['sorted_rows']
+        return index
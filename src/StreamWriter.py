@@ -0,0 +1,154 @@
+import abc
+import os
+
+import pandas as pd
+
+
+class StreamWriter(abc.ABC):
+    """
+    Base of the streaming output writers: rows are buffered and flushed to the file in batches of
+    `batch_size` rows as they are produced, so memory stays bounded by one batch whatever the output size.
+
+    Writers are context managers and are closed even when the block raises, so the batches flushed before
+    an error stay readable.
+    """
+
+    def __init__(self, path: str, batch_size: int = 8192):
+        """
+        Args:
+            path (str): The output file, overwritten.
+            batch_size (int): Number of rows buffered before they are written.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.buffer = []
+        self.buffered_rows = 0
+        self.rows_written = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def write(self, rows) -> None:
+        """Add rows, given as a DataFrame or as a list of dicts."""
+        if not isinstance(rows, pd.DataFrame):
+            rows = pd.DataFrame(rows)
+        if not len(rows):
+            return
+        self.buffer.append(rows)
+        self.buffered_rows += len(rows)
+        if self.buffered_rows >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered rows."""
+        if not self.buffer:
+            return
+        batch = self.buffer[0] if len(self.buffer) == 1 else pd.concat(self.buffer, ignore_index=True)
+        self.buffer = []
+        self.buffered_rows = 0
+        self._write_batch(batch)
+        self.rows_written += len(batch)
+
+    @abc.abstractmethod
+    def _write_batch(self, batch: pd.DataFrame) -> None:
+        """Write one batch of rows to the file."""
+
+    def close(self) -> None:
+        self.flush()
+
+
+class CsvStreamWriter(StreamWriter):
+    """
+    Streaming CSV writer: the header is written with the first batch and every batch is appended and
+    flushed to the OS, so partial results survive even if the process is killed.
+    """
+
+    def __init__(self, path: str, batch_size: int = 8192, columns: list = None):
+        """
+        Args:
+            path (str): The output CSV file, overwritten.
+            batch_size (int): Number of rows buffered before they are written.
+            columns (list): Column order of the file (default: the columns of the first batch).
+        """
+        super().__init__(path, batch_size=batch_size)
+        self.columns = columns
+        self.file = open(path, 'w', newline='')
+
+    def _write_batch(self, batch):
+        if self.columns is None:
+            self.columns = list(batch.columns)
+        batch.reindex(columns=self.columns).to_csv(self.file, header=self.rows_written == 0, index=False)
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        super().close()
+        if self.rows_written == 0 and self.columns is not None:
+            # No rows: still write the header, as `DataFrame.to_csv` would
+            pd.DataFrame(columns=self.columns).to_csv(self.file, index=False)
+        self.file.close()
+
+
+class ParquetStreamWriter(StreamWriter):
+    """
+    Streaming Parquet writer: every batch becomes one row group of the file (pyarrow `ParquetWriter`), so
+    the whole table is never converted to Arrow at once. The schema, pandas metadata included, comes from the
+    first batch; columns that are all null in it (e.g. empty lists) are typed as strings.
+
+    Parquet files are only readable once closed (the footer is written last), so a crash that skips the
+    `close` (e.g. the process is killed) loses the file; an exception inside a `with` block does not.
+    """
+
+    def __init__(self, path: str, batch_size: int = 8192, schema=None, compression: str = 'snappy'):
+        """
+        Args:
+            path (str): The output Parquet file, overwritten.
+            batch_size (int): Number of rows per row group.
+            schema (pyarrow.Schema): Schema of the file (default: inferred from the first batch).
+            compression (str): Parquet compression codec.
+        """
+        super().__init__(path, batch_size=batch_size)
+        self.schema = schema
+        self.compression = compression
+        self.writer = None
+        self.closed = False
+
+    @staticmethod
+    def _resolve_nulls(schema):
+        """Replace the null types that pandas infers for all-null / all-empty columns by strings."""
+        import pyarrow as pa
+        for i, field in enumerate(schema):
+            if pa.types.is_null(field.type):
+                schema = schema.set(i, field.with_type(pa.string()))
+            elif pa.types.is_list(field.type) and pa.types.is_null(field.type.value_type):
+                schema = schema.set(i, field.with_type(pa.list_(pa.string())))
+        return schema
+
+    def _write_batch(self, batch):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self.schema is None:
+            self.schema = self._resolve_nulls(pa.Schema.from_pandas(batch, preserve_index=False))
+        table = pa.Table.from_pandas(batch, schema=self.schema, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, self.schema, compression=self.compression)
+        self.writer.write_table(table, row_group_size=len(table))
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        if self.writer is None and self.schema is not None:
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(self.path, self.schema, compression=self.compression)
+        if self.writer is not None:
+            self.writer.close()
+        self.closed = True
@@ -1,32 +1,236 @@
 from exif import Image
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import os
+import shutil
 from datetime import datetime
-import geopy.distance
+import numpy as np
 from statistics import mean
 import ast
 
-def _load_images(path: str, name_filters_l : list = ['.jpg'] )->list: 
-    allf = os.listdir(path)
-    tor = []
-    for str_filter in name_filters_l:
-        allf_aux = [f for f in allf if str_filter in f]
-        tor = tor + allf_aux
-    return tor
+from Metrics import metrics
+
+def _load_images(path: str, name_filters_l : list = ['.jpg'], recursive: bool = False)->list: 
+    return [os.path.relpath(entry.path, path) for entry in _scan_images(path, name_filters_l, recursive=recursive)]
+
+def _scan_images(path: str,
+                 extensions: list = ['.jpg', '.jpeg'],
+                 recursive: bool = True,
+                 follow_symlinks: bool = False):
+    """
+    Lazily yield the `os.DirEntry` of every file under `path` whose name ends with one of `extensions` (any case).
+
+    Directories are read one at a time with `os.scandir` and walked depth first, each one sorted by name so
+    the order is deterministic. Only one directory listing is held in memory at a time. The entries carry their
+    file type and cache their `stat()` result, so later size / mtime lookups cost no extra syscall.
+
+    Args:
+        path (str): The folder to scan.
+        extensions (list): File extensions to keep, e.g. ['.jpg', '.jpeg'].
+        recursive (bool): Also scan subfolders (hidden ones, starting with '.', are skipped).
+        follow_symlinks (bool): Follow symlinks to folders.
+    """
+    extensions = tuple(ext.lower() for ext in extensions)
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError as e:
+        print(f"Could not scan folder '{path}': {e}")
+        return
+    for entry in entries:
+        try:
+            if entry.is_file(follow_symlinks=follow_symlinks):
+                if entry.name.lower().endswith(extensions):
+                    yield entry
+            elif recursive and not entry.name.startswith('.') and entry.is_dir(follow_symlinks=follow_symlinks):
+                yield from _scan_images(entry.path, extensions, recursive=recursive, follow_symlinks=follow_symlinks)
+        except OSError:
+            continue
+
+def _locate_exif_segment(f):
+    """
+    Find the EXIF (APP1) segment of an open JPEG file by walking its markers.
+
+    Returns the (start, end) byte offsets of the segment, (2, 2) if the JPEG has no EXIF segment (it would
+    go right after the SOI marker), or None if the file is not a JPEG.
+    """
+    f.seek(0)
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        position = f.tell()
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return (2, 2)
+        # Markers without a length field
+        if marker[1] in (0x01, 0xD8) or 0xD0 <= marker[1] <= 0xD7:
+            continue
+        # Start of scan / end of image: no EXIF segment before the image data
+        if marker[1] in (0xDA, 0xD9):
+            return (2, 2)
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return (2, 2)
+        length = int.from_bytes(length_bytes, 'big')
+        if marker[1] == 0xE1 and f.read(6) == b'Exif\x00\x00':
+            return (position, position + 2 + length)
+        f.seek(position + 2 + length)
+
+def _read_exif_header(path: str):
+    """
+    Read only the EXIF (APP1) segment of a JPEG instead of the whole file.
+
+    Returns a minimal JPEG (SOI + APP1 + EOI) that `exif.Image` can parse, b'' if the JPEG has no EXIF
+    segment, or None if the file is not a JPEG (the caller should then read the whole file).
+    """
+    with open(path, 'rb') as f:
+        span = _locate_exif_segment(f)
+        if span is None:
+            return None
+        start, end = span
+        if start == end:
+            return b''
+        f.seek(start)
+        return b'\xff\xd8' + f.read(end - start) + b'\xff\xd9'
+
+def _stream_copy(fin, fout, offset: int):
+    """Copy `fin` from `offset` to its end into `fout`, in kernel space with os.sendfile when possible."""
+    fout.flush()
+    try:
+        remaining = os.fstat(fin.fileno()).st_size - offset
+        while remaining > 0:
+            sent = os.sendfile(fout.fileno(), fin.fileno(), offset, remaining)
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+        fout.seek(0, os.SEEK_END)
+    except (AttributeError, OSError):
+        fin.seek(offset)
+        shutil.copyfileobj(fin, fout, 1 << 20)
+
+def _write_with_exif(original_path: str, output_path: str, exif_updates: dict) -> None:
+    """
+    Save a copy of an image with some exif tags changed, rewriting only its EXIF segment.
+
+    Only the EXIF (APP1) segment is parsed and re-serialized; everything before it is copied as is and
+    the rest of the file (the image data) is streamed without being parsed. Files that are not JPEGs
+    fall back to parsing and re-serializing the whole file.
+
+    Args:
+        original_path (str): The image to copy.
+        output_path (str): Where to write the copy.
+        exif_updates (dict): exif tag name -> new value, e.g. {'datetime': '2023:01:01 10:00:00'}.
+    """
+    with metrics.timer('exif_write'), open(original_path, 'rb') as fin:
+        span = _locate_exif_segment(fin)
+        new_segment = None
+        if span is not None:
+            start, end = span
+            fin.seek(0)
+            prefix = fin.read(start)
+            img = Image(b'\xff\xd8' + fin.read(end - start) + b'\xff\xd9')
+            for tag, value in exif_updates.items():
+                setattr(img, tag, value)
+            new_file = img.get_file()
+            if new_file[:2] == b'\xff\xd8' and new_file[-2:] == b'\xff\xd9':
+                new_segment = new_file[2:-2]
+
+        with open(output_path, 'wb') as fout:
+            if new_segment is not None:
+                fout.write(prefix)
+                fout.write(new_segment)
+                _stream_copy(fin, fout, end)
+            else:
+                fin.seek(0)
+                img = Image(fin.read())
+                for tag, value in exif_updates.items():
+                    setattr(img, tag, value)
+                fout.write(img.get_file())
+    metrics.count('exif_written')
+
+def _fast_copy(original_path: str, output_path: str, mode: str = 'reflink') -> None:
+    """
+    Copy a file whose metadata does not change, without reading it in Python.
+
+    Args:
+        mode (str): 'reflink' (copy-on-write clone on filesystems that support it, e.g. btrfs/XFS, falling
+            back to a regular kernel-space copy) or 'copy'. Either way the copy is a separate file, so editing
+            it never changes the original (hard links would share its inode).
+    """
+    if mode not in ('reflink', 'copy'):
+        raise ValueError(f"Unknown copy mode '{mode}', use 'reflink' or 'copy'.")
+    if mode == 'reflink':
+        try:
+            import fcntl
+            FICLONE = 0x40049409
+            with open(original_path, 'rb') as fin, open(output_path, 'wb') as fout:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+    shutil.copyfile(original_path, output_path)
 
 def _get_exifs(filename : str,
                filepath : str,
-               exifs_to_append: list = ['datetime','datetime_original','gps_altitude','gps_altitude_ref','gps_latitude','gps_latitude_ref','gps_longitude','gps_longitude_ref','model']
+               exifs_to_append: list = ['datetime','datetime_original','gps_altitude','gps_altitude_ref','gps_latitude','gps_latitude_ref','gps_longitude','gps_longitude_ref','model'],
+               header_only: bool = True,
                )-> dict:
 
     path = f'{filepath}{filename}'
     d = {'filename':filename, 'filepath':filepath}
-    with open(path, 'rb') as img_file:
-        img = Image(img_file)
+    # only the EXIF segment is read from JPEGs, other files are read whole
+    with metrics.timer('file_read'):
+        data = _read_exif_header(path) if header_only else None
+        if data is None:
+            with open(path, 'rb') as img_file:
+                data = img_file.read()
+    metrics.count('files_read')
+    if not data:
+        return d
+    with metrics.timer('exif_parse'):
+        img = Image(data)
+        # list the available tags once per file
+        available = set(img.list_all())
         for exif_prop in exifs_to_append:
-            if(exif_prop) in img.list_all():
+            if exif_prop in available:
                 d[exif_prop] = img.get(exif_prop)
     return d
 
+def _get_exifs_or_empty(filename: str, filepath: str, **kwargs) -> dict:
+    """`_get_exifs`, but a file that cannot be read or parsed gives an exif dict without any tag."""
+    try:
+        return _get_exifs(filename, filepath, **kwargs)
+    except Exception as e:
+        print(f"Could not read exif data of '{filepath}{filename}': {e}")
+        return {'filename': filename, 'filepath': filepath}
+
+def _iter_exifs(filenames: list,
+                filepath: str,
+                n_workers: int = 8,
+                exifs_to_append: list = None,
+                header_only: bool = True,
+                skip_errors: bool = False):
+    """
+    Read the exifs of many files concurrently with a pool of `n_workers` threads (the work is mostly I/O).
+
+    Results are yielded in the order of `filenames` as soon as they are ready, with at most
+    4 * `n_workers` reads in flight, so memory stays bounded for very large folders. With `skip_errors`,
+    files that cannot be read (e.g. deleted since) give an exif dict without any tag instead of raising.
+    """
+    kwargs = {'header_only': header_only}
+    if exifs_to_append is not None:
+        kwargs['exifs_to_append'] = exifs_to_append
+    get_exifs = _get_exifs_or_empty if skip_errors else _get_exifs
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        in_flight = deque()
+        for filename in filenames:
+            in_flight.append(pool.submit(get_exifs, filename, filepath, **kwargs))
+            if len(in_flight) >= 4 * n_workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
 def _dms2dd(degrees:float, minutes:float, seconds:float, direction='N'):
     """transform degrees, minutes, seconds coords into decimal coordinates"""
     dd = float(degrees) + float(minutes)/60 + float(seconds)/(60*60);
@@ -48,6 +252,14 @@ def _get_lat_long_decimal(lat_long:tuple):
     (lat, long) = lat_long   
     return (_dms2dd(lat[0], lat[1], lat[2]), _dms2dd(long[0], long[1], long[2]))
 
+def _get_signed_lat_long_decimal(exif_data: dict):
+    """Signed decimal (lat, long) of an exif dict, using the N/S and E/W refs; None if it has no gps data."""
+    if 'gps_latitude' not in exif_data or 'gps_longitude' not in exif_data:
+        return None
+    lat, long = exif_data['gps_latitude'], exif_data['gps_longitude']
+    return (_dms2dd(lat[0], lat[1], lat[2], direction=exif_data.get('gps_latitude_ref', 'N')),
+            _dms2dd(long[0], long[1], long[2], direction=exif_data.get('gps_longitude_ref', 'E')))
+
 def _is_closer_than_n_kms(lat_long:tuple, 
                            lat2_long2 :tuple, 
                            max_thr_kms: float = .5)-> tuple: 
@@ -56,6 +268,8 @@ def _is_closer_than_n_kms(lat_long:tuple,
     #to be trasnformed into decimal e.g. 12.13
     p1 = _get_lat_long_decimal(lat_long) 
     p2 = _get_lat_long_decimal(lat2_long2) 
+    # geopy is only imported when a geodesic distance is actually needed
+    import geopy.distance
     d = geopy.distance.geodesic(p1, p2).km
     return (d < max_thr_kms, d)
 
@@ -68,24 +282,140 @@ def _is_in_time(time_str_1:str,
     time_diff = (dt2 - dt1).seconds
     return (time_diff<=max_thr_sec, time_diff)
     
+def _haversine_km(lat1, long1, lat2, long2):
+    """Great-circle distance in km between decimal coordinates; works element-wise on numpy arrays."""
+    lat1, long1, lat2, long2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, long1, lat2, long2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2)**2
+    return 2 * 6371.0088 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def _group_exifs(all_exifs: list,
+                 max_thr_kms: float,
+                 max_thr_sec: float,
+                 exact_distance: bool = True,
+                 chunk_size: int = 256) -> list:
+    """
+    Group date-sorted exifs the same way as the pairwise `_is_in_time` / `_is_closer_than_n_kms` loop, in bulk.
+
+    Each group starts at an anchor picture. Following pictures with gps data join it while they are in time
+    or closer than `max_thr_kms` to the anchor, and the first one that is neither starts the next group.
+    Coordinates and timestamps are converted to numpy arrays once. Distances to the anchor are computed
+    with the haversine formula over growing chunks of candidates. Haversine differs from the geodesic
+    distance by less than 0.6%, so with `exact_distance` only the pairs that are not in time and whose
+    haversine distance is within 1% of the threshold are re-checked with `geopy.distance.geodesic`. The groups
+    are then identical to the pairwise loop.
+
+    Returns:
+        list: Groups as lists of indices into `all_exifs`. Pictures without gps data (other than the first
+        one) are not part of any group.
+
+    Raises:
+        KeyError: If pictures have to be compared while the first picture has no gps data, or a picture with
+            gps data has no datetime, as in the pairwise loop.
+    """
+    n = len(all_exifs)
+    if n == 0:
+        return []
+    has_gps = np.array(['gps_latitude' in e and 'gps_longitude' in e for e in all_exifs])
+    lat = np.full(n, np.nan)
+    long = np.full(n, np.nan)
+    seconds = np.full(n, np.nan)
+    for i, e in enumerate(all_exifs):
+        if has_gps[i]:
+            lat[i], long[i] = _get_lat_long_decimal((e['gps_latitude'], e['gps_longitude']))
+        if 'datetime' in e:
+            # naive difference to the epoch, like subtracting two naive datetimes
+            seconds[i] = (datetime.strptime(e['datetime'], '%Y:%m:%d %H:%M:%S') - datetime(1970, 1, 1)).total_seconds()
+
+    for i in np.flatnonzero(~has_gps[1:]) + 1:
+        metrics.log("Latitude and/or longitude not found! %s", all_exifs[i])
+    metrics.count('pictures_without_gps', int((~has_gps[1:]).sum()))
+
+    candidates = np.flatnonzero(has_gps[1:]) + 1
+    # Like the pairwise loop, comparing with an anchor without gps data, or pictures without a date, is an error
+    if len(candidates):
+        if not has_gps[0]:
+            raise KeyError(f"The first picture has no gps data: {all_exifs[0].get('filename')}")
+        compared = np.concatenate([[0], candidates])
+        missing_date = compared[np.isnan(seconds[compared])]
+        if len(missing_date):
+            raise KeyError(f"Picture without datetime: {all_exifs[missing_date[0]].get('filename')}")
+    groups = []
+    anchor = 0
+    grouped = [0]
+    position = 0
+    size = chunk_size
+    while position < len(candidates):
+        chunk = candidates[position:position + size]
+        # same as `(dt2 - dt1).seconds` in `_is_in_time`: the seconds part of the difference
+        in_time = np.mod(seconds[chunk] - seconds[anchor], 86400) <= max_thr_sec
+        distance = _haversine_km(lat[anchor], long[anchor], lat[chunk], long[chunk])
+        closer = distance < max_thr_kms
+        if exact_distance:
+            import geopy.distance
+            for j in np.flatnonzero(~in_time & (np.abs(distance - max_thr_kms) <= 0.01 * max_thr_kms)):
+                closer[j] = geopy.distance.geodesic((lat[anchor], long[anchor]), (lat[chunk[j]], long[chunk[j]])).km < max_thr_kms
+
+        breaks = ~closer & ~in_time
+        if breaks.any():
+            first_break = int(np.argmax(breaks))
+            grouped.extend(chunk[:first_break].tolist())
+            groups.append(grouped)
+            anchor = int(chunk[first_break])
+            grouped = [anchor]
+            position += first_break + 1
+            size = chunk_size
+        else:
+            grouped.extend(chunk.tolist())
+            position += len(chunk)
+            size *= 2
+    groups.append(grouped)
+    return groups
+
+def _l2_normalize(embeddings) -> np.ndarray:
+    """Return a float32 copy of `embeddings` with unit-length rows (zero rows are left as zeros)."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+def _connected_components(n: int, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """
+    Component label (its smallest row) of each of `n` rows linked by the (sources[i], targets[i]) pairs, by
+    hooking every link to the smaller label and pointer jumping until no link joins two labels; a few
+    vectorized passes in practice.
+    """
+    labels = np.arange(n)
+    while True:
+        low = np.minimum(labels[sources], labels[targets])
+        high = np.maximum(labels[sources], labels[targets])
+        joined = low != high
+        if not joined.any():
+            return labels
+        np.minimum.at(labels, high[joined], low[joined])
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
 def _save_copy_pics(path:str, 
                     grouped:list,
                     copy_grouped_pics_path:str,
-                    counter:int):
+                    counter:int,
+                    copy_mode:str = 'reflink'):
     for p in grouped:
-        original_path = path+p
-        to_save = copy_grouped_pics_path+str(counter)+'_'+p
-        #print(f"we will save file {original_path} in {to_save}")
-        #This does not work as it says it cannot create a directory
-        with open(original_path, 'rb') as a:
-            img_a = Image(a)
-        with open(to_save, 'wb') as b:
-            b.write(img_a.get_file())
+        # grouped holds the exif dicts of the pictures
+        filename = p['filename'] if isinstance(p, dict) else p
+        original_path = path+filename
+        # pictures found in subfolders are copied flat, with the subfolders in their name
+        to_save = copy_grouped_pics_path+str(counter)+'_'+filename.replace(os.sep, '_')
+        # metadata does not change, so copy the file without parsing it
+        _fast_copy(original_path, to_save, mode=copy_mode)
 
 # get date modified from image
-def _get_image_modified_data(path):
-    # get the date last modified of the file
-    date_modified = os.path.getmtime(path)
+def _get_image_modified_data(path, stat_result: os.stat_result = None):
+    # get the date last modified of the file, from the stat result when it is already known
+    date_modified = stat_result.st_mtime if stat_result is not None else os.path.getmtime(path)
     # convert the timestamp to a datetime object
     date_modified = datetime.fromtimestamp(date_modified)
     date_modified_str = date_modified.strftime('%Y-%m-%d %H:%M:%S')
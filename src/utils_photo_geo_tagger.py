@@ -1,10 +1,11 @@
 import os
-from exif import Image
-from datetime import datetime
 from statistics import mean
 import pandas as pd
 
-from utils import _load_images, _get_exifs, _is_closer_than_n_kms, _is_in_time, _save_copy_pics, _get_lat_long_decimal, _dd2dms, _get_image_modified_data, _map_location_mapping
+from utils import _scan_images, _iter_exifs, _save_copy_pics, _get_lat_long_decimal, _dd2dms, _get_image_modified_data, _write_with_exif, _group_exifs, _get_signed_lat_long_decimal
+from LocationIndex import LocationIndex
+from Metrics import metrics
+from StreamWriter import CsvStreamWriter
 
 
 def create_exif_map(path: str, 
@@ -13,6 +14,11 @@ def create_exif_map(path: str,
                     output_exif_map: str = 'location_map.csv',
                     name_filters_l : list = ['.jpg', '.jpeg'],
                     copy_grouped_pics_path : str = None, 
+                    n_workers : int = 8,
+                    exact_distance : bool = True,
+                    recursive : bool = False,
+                    batch_size : int = 1024,
+                    keep_in_memory : bool = True,
                     )->list: 
     
     """
@@ -32,83 +38,110 @@ def create_exif_map(path: str,
         List of file extensions to consider when loading image files
     copy_grouped_pics_path : str, optional (default: None)
         Path to directory where grouped images should be saved as copies. If None, no copies are made.
+        Copies are separate files (copy-on-write clones where the filesystem supports it, never hard links),
+        so editing a copy does not change the original picture.
+    n_workers : int, optional (default: 8)
+        Number of threads reading exif data concurrently. Only the exif segment of each file is read.
+    exact_distance : bool, optional (default: True)
+        Distances are computed in bulk with the haversine formula. If True, the few pairs close to
+        `min_gps_threshold_similar` are re-checked with the exact geodesic distance, so groups are
+        the same as with a geodesic-only comparison.
+    recursive : bool, optional (default: False)
+        Also look for pictures in the subfolders of `path`.
+    batch_size : int, optional (default: 1024)
+        Number of groups written to `output_exif_map` at a time, as they are computed.
+    keep_in_memory : bool, optional (default: True)
+        Also return the mapping as a DataFrame, which is built whole (memory grows with the number of groups).
+        If False, groups are only written to `output_exif_map` and `df` is None, so memory stays flat.
 
     Returns:
     --------
-    df : Dataframe
-        df with with mapping information
+    (df, output_exif_map) : tuple
+        df with with mapping information (None with `keep_in_memory=False`), and the path of the CSV file
     """
 
 
-    # Load all files
-    pic_paths = _load_images(path, name_filters_l)
-    print(f'Loaded {len(pic_paths)} pictures after applying all filters')
-
-    # pic by pic, load all exifs
-    all_exifs = []
-    for img in pic_paths:
-        all_exifs.append( _get_exifs(img, path) )
+    # Stream all files and load their exifs concurrently, collecting them as they are read
+    pic_paths = (os.path.relpath(entry.path, path) for entry in _scan_images(path, name_filters_l, recursive=recursive))
+    all_exifs = list(_iter_exifs(pic_paths, path, n_workers=n_workers))
+    print(f'Loaded {len(all_exifs)} pictures after applying all filters')
 
     #sort them by date, form older to newer
     if 'datetime_original' in all_exifs[0]:
         all_exifs.sort(key= lambda x: x['datetime_original'])
 
     # find groups of pictures taken in the same place, based on the
-    # gps position and the threshold `max_thr_kms`
-    initial = all_exifs[0]
-    all_groups = []
-    grouped = [initial]   
+    # gps position and the threshold `max_thr_kms`, all pairs computed in bulk
+    group_indices = _group_exifs(all_exifs,
+                                 max_thr_kms=min_gps_threshold_similar,
+                                 max_thr_sec=min_seconds_threshold_similar,
+                                 exact_distance=exact_distance)
+    all_groups = [[all_exifs[i] for i in group] for group in group_indices]
     counter = 0
-    for k in range(1, len(all_exifs)): 
-        actual = all_exifs[k]
-        if('gps_latitude' not in actual or 'gps_longitude' not in actual):
-            print("Latitude and/or longitude not found!")
-            print(actual)
-        else:
-            (in_time, _) = _is_in_time( initial['datetime'], 
-                                        actual['datetime'],
-                                        max_thr_sec=min_seconds_threshold_similar)
-            (closer, _) = _is_closer_than_n_kms( (initial['gps_latitude'], initial['gps_longitude']), 
-                                        (actual['gps_latitude'], actual['gps_longitude']), 
-                                        max_thr_kms= min_gps_threshold_similar) 
-            
-            if(not closer and not in_time):
-                print(f"Found new group of {len(grouped)} pictures! ")
-                #save all files in a new folder if we specify a path
-                if(copy_grouped_pics_path is not None):
-                    _save_copy_pics(path, grouped, copy_grouped_pics_path, counter)
-                    counter +=1
-                initial = actual
-                all_groups.append(grouped)
-                grouped = [initial]
-            else:
-                grouped.append( actual )
-    all_groups.append(grouped)
+    for grouped in all_groups[:-1]:
+        metrics.log("Found new group of %d pictures! ", len(grouped))
+        #save all files in a new folder if we specify a path
+        if(copy_grouped_pics_path is not None):
+            _save_copy_pics(path, grouped, copy_grouped_pics_path, counter)
+            counter +=1
     
-    # Create final grouped mapping
-    df = pd.DataFrame(columns=['start', 'end', 'lat', 'long', 'n_pics'])
-    for group in all_groups:
-        if(len(all_groups) == 1 and len(group) == 1):
-            print(f"No location file was generated, as there is no exif data in any of the images.")
-            return None
-        print(f"Exploring group of {len(group)} elements..")
-        starting_date = group[0]['datetime']
-        ending_date = group[-1]['datetime']
-        lat_avg = mean( [_get_lat_long_decimal( (k['gps_latitude'], k['gps_longitude']) )[0] for k in group] )
-        long_avg = mean( [_get_lat_long_decimal( (k['gps_latitude'], k['gps_longitude']) )[1] for k in group])
-        print(f"Group has {len(group)} elements, goes from {starting_date} to {ending_date} and averages (lat,long) ({lat_avg}, {long_avg}).")
-        df = pd.concat([df, pd.DataFrame([{'start':starting_date,'end':ending_date,'lat':lat_avg,'long':long_avg,'lat_dms': _dd2dms(lat_avg),'long_dms': _dd2dms(long_avg),'n_pics': len(group)}])], ignore_index=True)
-    df.to_csv(path_or_buf=output_exif_map, index=False)
-    print(f"File saved in {output_exif_map}")
+    if(len(all_groups) == 1 and len(all_groups[0]) == 1):
+        print(f"No location file was generated, as there is no exif data in any of the images.")
+        return None
+
+    # Create final grouped mapping, streamed to the csv file in batches of groups
+    rows = []
+    with CsvStreamWriter(output_exif_map, batch_size=batch_size,
+                         columns=['start', 'end', 'lat', 'long', 'n_pics', 'lat_dms', 'long_dms']) as writer:
+        for group in all_groups:
+            metrics.log("Exploring group of %d elements..", len(group))
+            starting_date = group[0]['datetime']
+            ending_date = group[-1]['datetime']
+            lat_avg = mean( [_get_lat_long_decimal( (k['gps_latitude'], k['gps_longitude']) )[0] for k in group] )
+            long_avg = mean( [_get_lat_long_decimal( (k['gps_latitude'], k['gps_longitude']) )[1] for k in group])
+            metrics.log("Group has %d elements, goes from %s to %s and averages (lat,long) (%s, %s).", len(group), starting_date, ending_date, lat_avg, long_avg)
+            row = {'start':starting_date,'end':ending_date,'lat':lat_avg,'long':long_avg,'lat_dms': _dd2dms(lat_avg),'long_dms': _dd2dms(long_avg),'n_pics': len(group)}
+            writer.write([row])
+            if keep_in_memory:
+                rows.append(row)
+    metrics.count('groups', len(all_groups))
+    df = pd.DataFrame(rows, columns=writer.columns) if keep_in_memory else None
+    print(f"Found {len(all_groups)} groups, file saved in {output_exif_map}")
     return (df, output_exif_map)
 
 
 
 
+def _write_mapped_image(original_image_path: str, output_image_path: str, exif_data_to_insert: dict) -> None:
+    """
+    Saves a copy of one image with the location and date found by `LocationIndex.map_locations`, and sets
+    its access and modified times to that date.
+    """
+    metrics.log("Opening image from %s", original_image_path)
+
+    # exif data to append
+    exif_updates = {}
+    if(exif_data_to_insert['lat'] is not None): exif_updates['gps_latitude'] = exif_data_to_insert['lat']
+    if(exif_data_to_insert['long'] is not None): exif_updates['gps_longitude'] = exif_data_to_insert['long']
+    if(exif_data_to_insert['date_str'] is not None): 
+        exif_updates['datetime'] = exif_data_to_insert['date_str']
+        exif_updates['datetime_original'] = exif_data_to_insert['date_str']
+        exif_updates['datetime_digitized'] = exif_data_to_insert['date_str']
+
+    # Save image with modified EXIF metadata to an image file, only the exif segment is rewritten
+    metrics.log("Saving new image in %s", output_image_path)
+    _write_with_exif(original_image_path, output_image_path, exif_updates)
+
+    new_access_time_seconds = exif_data_to_insert['date'].timestamp()
+    new_modified_time_seconds = exif_data_to_insert['date'].timestamp()
+    os.utime(output_image_path, times=(new_access_time_seconds, new_modified_time_seconds))
+
+
 def map_images(path,
             output_image_path,
             name_filters_l : list = ['.jpg', '.jpeg'],
-            location_mapping_csv = None#"location_mapping.csv",
+            location_mapping_csv = None,#"location_mapping.csv",
+            recursive : bool = False,
             ):
 
     """
@@ -120,6 +153,7 @@ def map_images(path,
     - output_image_path (str): the directory path where the mapped images will be saved
     - name_filters_l (list of str, optional): a list of filename extensions to filter by, defaults to ['.jpg', '.jpeg']
     - location_mapping_csv (str, optional): the path to a CSV file containing location mapping data, defaults to "location_mapping.csv"
+    - recursive (bool, optional): also map the images in the subfolders of `path` (the folder tree is recreated in `output_image_path`), defaults to False
 
     Returns: 
     -----------
@@ -130,48 +164,86 @@ def map_images(path,
 
     """
 
-    # load all data
-    allimg = _load_images(path, name_filters_l= name_filters_l)
-
-    # read location mapping
-    df_location_mapping = pd.read_csv(filepath_or_buffer=location_mapping_csv, header = 0)
-    def convert_date_string(date_str):
-        return datetime.strptime(date_str, '%Y:%m:%d %H:%M:%S')
-    df_location_mapping.start = df_location_mapping.start.apply(convert_date_string)
-    df_location_mapping.end = df_location_mapping.end.apply(convert_date_string)
-    print(f"Loaded location mapping from {location_mapping_csv} and has {len(df_location_mapping)} rows")
-
-    # get last date modified from file info
-    allimg = [ (i, _get_image_modified_data(f"data/pics_whatsapp/{i}")) for i in allimg]
-
-    # location mapping per file
-    for img_data in allimg:
-        #get corresponding exif data
-        exif_data_to_insert = _map_location_mapping(img_data[1], df_location_mapping)
-        print(f"Exif data found {exif_data_to_insert}")
-
-        #open original file
-        original_image_path = f"{path}/{img_data[0]}"
-        print(f"Opening image from {original_image_path}")
-        with open(original_image_path, 'rb') as img_file:
-            img = Image(img_file)
-
-        # append exif data
-        if(exif_data_to_insert['lat'] is not None): img.gps_latitude = exif_data_to_insert['lat']
-        if(exif_data_to_insert['long'] is not None): img.gps_longitude = exif_data_to_insert['long']
-        if(exif_data_to_insert['date_str'] is not None): 
-            img.datetime = exif_data_to_insert['date_str']
-            img.datetime_original = exif_data_to_insert['date_str']
-            img.datetime_digitized = exif_data_to_insert['date_str']
-        
-        # Save image with modified EXIF metadata to an image file
-        folder_path_out = f'{output_image_path}/{img_data[0]}'
-        print(f"Saving new image in {folder_path_out}")
-        with open(folder_path_out, 'wb') as new_image_file:
-                new_image_file.write(img.get_file())
-
-        new_access_time_seconds = exif_data_to_insert['date'].timestamp()
-        new_modified_time_seconds = exif_data_to_insert['date'].timestamp()
-        os.utime(folder_path_out, times=(new_access_time_seconds, new_modified_time_seconds))
-    
+    # read location mapping and index its time windows once
+    location_index = LocationIndex.from_csv(location_mapping_csv)
+    print(f"Loaded location mapping from {location_mapping_csv} and has {len(location_index)} rows")
+
+    # stream all files, getting the last date modified from the stat result the scan already has
+    allimg = [ (os.path.relpath(entry.path, path), _get_image_modified_data(entry.path, entry.stat()))
+               for entry in _scan_images(path, name_filters_l, recursive=recursive)]
+
+    # location mapping for all files in one vectorized lookup
+    with metrics.timer('location_lookup'):
+        all_exif_data = location_index.map_locations([img_data[1] for img_data in allimg])
+
+    for img_data, exif_data_to_insert in zip(allimg, all_exif_data):
+        metrics.log("Exif data found %s", exif_data_to_insert)
+        if os.sep in img_data[0]:
+            os.makedirs(os.path.dirname(f'{output_image_path}/{img_data[0]}'), exist_ok=True)
+        _write_mapped_image(f"{path}/{img_data[0]}", f'{output_image_path}/{img_data[0]}', exif_data_to_insert)
+    metrics.count('images_mapped', len(allimg))
+    print(f"Saved {len(allimg)} mapped images in {output_image_path}")
+
+
+
+def propagate_gps(retriever,
+                  output_image_path: str,
+                  N: int = 5,
+                  threshold: float = 0.8,
+                  min_confidence: float = 0.8,
+                  scale_km: float = 25.0,
+                  n_workers: int = 8,
+                  output_csv: str = None,
+                  ):
+    """
+    Geo-tags the photos without GPS data from their most similar photos that have it.
+
+    Parameters:
+    -----------
+    - retriever (EmbeddingRetriever): embeddings of the photos, both tagged and untagged
+    - output_image_path (str): the directory path where the geo-tagged copies will be saved
+    - N (int, optional): maximum number of tagged visual neighbours used per photo, defaults to 5
+    - threshold (float, optional): minimum cosine similarity of a neighbour, defaults to 0.8
+    - min_confidence (float, optional): photos whose inferred location has a lower confidence are not written, defaults to 0.8
+    - scale_km (float, optional): spread of the neighbours, in km, at which the confidence drops to 1/e of their mean similarity, defaults to 25
+    - n_workers (int, optional): number of threads reading exif data concurrently, defaults to 8
+    - output_csv (str, optional): path of a CSV file where all inferred locations are saved, defaults to None
+
+    Returns:
+    -----------
+    df : Dataframe
+        one row per untagged photo with the inferred `lat`, `long`, `confidence`, `n_neighbors`, `spread_km`
+        and whether it was `written`
+
+    The gps data of every photo is read once, then all untagged photos are located at once with
+    `EmbeddingRetriever.infer_locations` (one matrix product per block of photos). The copies are saved with
+    only their exif segment rewritten, in the folder tree of the photos below their common folder.
+    """
 
+    # gps data of every embedded photo (paths are absolute), photos that cannot be read count as untagged
+    lat_long = [_get_signed_lat_long_decimal(exif_data) or (float('nan'), float('nan'))
+                for exif_data in _iter_exifs(list(retriever.filepaths), '', n_workers=n_workers, skip_errors=True,
+                                             exifs_to_append=['gps_latitude', 'gps_latitude_ref', 'gps_longitude', 'gps_longitude_ref'])]
+    df = retriever.infer_locations([ll[0] for ll in lat_long], [ll[1] for ll in lat_long], N=N, threshold=threshold,
+                                 scale_km=scale_km)
+    print(f"Inferred locations for {df['n_neighbors'].gt(0).sum()} of {len(df)} photos without gps data")
+
+    df['written'] = df['confidence'] >= min_confidence
+    # The folder tree below the common root of the photos is kept, so photos with the same name do not collide
+    root = os.path.commonpath([os.path.dirname(filepath) for filepath in df['filepath']]) if len(df) else ''
+    for i, filepath, lat, long in df.loc[df['written'], ['filepath', 'lat', 'long']].itertuples():
+        exif_updates = {'gps_latitude': _dd2dms(abs(lat)), 'gps_latitude_ref': 'N' if lat >= 0 else 'S',
+                        'gps_longitude': _dd2dms(abs(long)), 'gps_longitude_ref': 'E' if long >= 0 else 'W'}
+        output_path = os.path.join(output_image_path, os.path.relpath(filepath, root))
+        try:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            _write_with_exif(filepath, output_path, exif_updates)
+        except Exception as e:
+            print(f"Failed to geo-tag {filepath}: {e}")
+            df.loc[i, 'written'] = False
+    print(f"Saved {df['written'].sum()} geo-tagged pictures in {output_image_path}")
+
+    if output_csv is not None:
+        df.to_csv(path_or_buf=output_csv, index=False)
+        print(f"File saved in {output_csv}")
+    return df